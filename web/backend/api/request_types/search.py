@@ -1,10 +1,17 @@
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 class ImageSearchRequest(BaseModel):
     text: Optional[str] = None
     dominant_colors: Optional[List[str]] = None  # List of hex colors
     faces: Optional[List[str]] = None  # List of Face IDs
+    face_image: Optional[str] = None  # Base64-encoded face crop to search for
+    face_threshold: Optional[float] = Field(None, ge=-1, le=1)  # Minimum cosine similarity for a face to match
     products: Optional[List[str]] = None  # List of Product IDs
+    tags: Optional[List[str]] = None  # List of Tag IDs; any tag within a category, every category
     page: Optional[int] = 1
-    page_size: Optional[int] = 20
\ No newline at end of file
+    page_size: Optional[int] = 20
+    cursor: Optional[str] = None  # next_cursor from the previous page; takes precedence over page
+    hybrid: Optional[bool] = False  # Combine text, color and face signals with rank fusion instead of using only the first
+    approximate: Optional[bool] = False  # Use the in-process ANN index instead of exact $vectorSearch for text queries
+    nprobe: Optional[int] = None  # ANN partitions to scan; higher trades latency for recall
\ No newline at end of file
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 from beanie import PydanticObjectId 
 from pydantic import BaseModel, Field
 from models.image import Dimensions
@@ -12,9 +12,16 @@ class ImageResponseModel(BaseModel):
     format: str = Field(..., description="File format of the image")
     caption: Optional[str] = Field(None, description="Caption describing the image")
 
+class TagFacet(BaseModel):
+    id: PydanticObjectId = Field(..., description="Id of the tag")
+    name: str = Field(..., description="Name of the tag")
+    count: int = Field(..., description="Number of matching images with the tag")
+
 class ImageSearchResponse(BaseModel):
     images: List[ImageResponseModel]
     total: int
     page: int
     page_size: int
-    total_pages: int
\ No newline at end of file
+    total_pages: int
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page, absent on the last page")
+    facets: Dict[str, List[TagFacet]] = Field(default_factory=dict, description="Tag counts over all matching images, by tag category")
\ No newline at end of file
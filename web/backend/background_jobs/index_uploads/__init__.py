@@ -1,3 +1,4 @@
-from .index_uploads import index_uploaded_images
+from .index_uploads import index_uploaded_images, find_interrupted_uploads, resume_interrupted_uploads
+from .ingest_pipeline import ingest_pipeline, IngestBacklogFullError
 
-__all__ = ["index_uploaded_images"]
+__all__ = ["index_uploaded_images", "find_interrupted_uploads", "resume_interrupted_uploads", "ingest_pipeline", "IngestBacklogFullError"]
@@ -1,16 +1,46 @@
+import os
 import uuid
+import asyncio
+import hashlib
 from io import BytesIO
 import base64
+from datetime import datetime
+from typing import List, Optional
 
 from beanie import PydanticObjectId
+from dotenv import load_dotenv
+from pymongo.errors import DuplicateKeyError
 
 from toolbox import Toolbox
 from toolbox.services.blob_storage import BlobStorageService
-from toolbox.services.image.process_image_for_search import ImageSearchMetadata
-from models.image import Image, Dimensions
+from toolbox.services.image.process_image_for_search import (
+    ImageSearchMetadata,
+    DecodedImage,
+    VisualFeatures,
+    SemanticFeatures,
+    decode_image,
+    inspect_image,
+    extract_visual_features,
+    extract_semantic_features,
+    combine_features
+)
+from toolbox.services.image.process_image_for_search.extract_basic_details import ImageDetails
+from toolbox.services.image.process_image_for_search.extract_faces import FacialDetails
+from toolbox.services.image.process_image_for_search.extract_products import ProductDetectionDetails
+from toolbox.services.image.process_image_for_search.tag_image import ImageTags
+from models.image import Image, Dimensions, DominantColor
 from models.face import Face
+from models.color import Color
+from models.product import Product
+from models.ingest_record import IngestRecord
 from toolbox.services.image.process_image_for_search import ImageAlreadyExistsError
-from models.tag import Tag
+from toolbox.services.image.color_palette import build_palette
+from toolbox.services.search_cache import bump_search_generation
+
+load_dotenv()
+
+# Face crops uploaded at once per image
+face_upload_concurrency = int(os.getenv("FACE_UPLOAD_CONCURRENCY", "8"))
 
 # Extracts: 
 # - dominant colors
@@ -35,35 +65,261 @@ from models.tag import Tag
 #   - time (morning, afternoon, evening, night)
 #   - weather (sunny, rainy, snowy, windy, cloudy, etc.)
 
-async def background_process_uploaded_image(toolbox: Toolbox, creation_method: str, user_id: PydanticObjectId, organization_id: PydanticObjectId, blob_path: str):
-    print("Indexing image", blob_path)
-    blob_storage = toolbox.services.blob_storage
-    image_data = await blob_storage.download_blob(blob_path, BlobStorageService.ContainerName.UPLOADS)
+class IngestJob:
+    """State of one uploaded image as it moves through the ingest stages."""
+
+    def __init__(self, creation_method: str, user_id: PydanticObjectId, organization_id: PydanticObjectId, blob_path: str):
+        self.creation_method = creation_method
+        self.user_id = user_id
+        self.organization_id = organization_id
+        self.blob_path = blob_path
+        self.attempts = 0
+        self.record: Optional[IngestRecord] = None
+        self.image_data: Optional[bytes] = None
+        self.image: Optional[DecodedImage] = None
+        self.visual: Optional[VisualFeatures] = None
+        self.semantic: Optional[SemanticFeatures] = None
+        self.caption_embedding: Optional[List[float]] = None
+
+# Checkpoints
+#
+# Every stage saves its output to the upload's IngestRecord and skips its work when the
+# record already holds it, so an upload retried after a failure (in this process or after
+# a restart) resumes from the first incomplete stage.
+
+async def open_ingest_record(job: IngestJob):
+    """Load the upload's ingest record, keyed by blob path and content hash, or start one."""
+    content_hash = hashlib.sha256(job.image_data).hexdigest()
+    match = {"blob_path": job.blob_path, "content_hash": content_hash}
+    record = await IngestRecord.find_one(match)
+    if record is None:
+        record = IngestRecord(
+            blob_path=job.blob_path,
+            content_hash=content_hash,
+            organization_id=job.organization_id,
+            user_id=job.user_id,
+            creation_method=job.creation_method
+        )
+        try:
+            await record.insert()
+        except DuplicateKeyError:
+            # Another worker opened it first
+            record = await IngestRecord.find_one(match)
+    elif record.attempts:
+        print(f"Resuming {job.blob_path} after {record.attempts} failed attempts")
+    job.record = record
+
+async def checkpoint(job: IngestJob, **fields):
+    """Save stage outputs to the job's ingest record. Failing to save only costs the resume."""
+    try:
+        await job.record.set({**fields, "updated_at": datetime.utcnow()})
+    except Exception as e:
+        print(f"Error checkpointing {', '.join(fields)} for {job.blob_path}: {str(e)}")
+        for name, value in fields.items():
+            setattr(job.record, name, value)
 
-    image_service = toolbox.services.image_service
-    
+async def record_ingest_failure(job: IngestJob, error: Exception):
+    """Count a failed attempt, on the job and on its ingest record for a later resume to find."""
+    job.attempts += 1
+    if job.record is None:
+        return
     try:
-        image_info: ImageSearchMetadata = await image_service.process_image_for_search(image_data, organization_id)
+        await job.record.set({"attempts": job.record.attempts + 1, "error": str(error), "updated_at": datetime.utcnow()})
+    except Exception as e:
+        print(f"Error recording ingest failure for {job.blob_path}: {str(e)}")
+
+async def ensure_decoded(job: IngestJob) -> DecodedImage:
+    if job.image is None:
+        job.image = await decode_image(job.image_data)
+    return job.image
+
+# Ingest stages
+#
+# Each stage fills in part of an IngestJob. They run in order, either back to back for a
+# single image or as separately throttled stages of the ingest pipeline.
+
+async def download_upload(toolbox: Toolbox, job: IngestJob):
+    print("Indexing image", job.blob_path)
+    if job.image_data is None:
+        job.image_data = await toolbox.services.blob_storage.download_blob(job.blob_path, BlobStorageService.ContainerName.UPLOADS)
+    if job.record is None:
+        await open_ingest_record(job)
+
+async def analyze_upload(toolbox: Toolbox, job: IngestJob):
+    """Decode the image, reject duplicates and extract colors and faces."""
+    record = job.record
+    if record.basic_details is None:
+        basic_details = await inspect_image(await ensure_decoded(job), job.organization_id, toolbox.services.phash_index, upload_key=job.blob_path)
+        await checkpoint(job, basic_details=basic_details.model_dump())
+    else:
+        # Checked for duplicates before it was checkpointed; hold its hash again in case
+        # the reservation was lost with a restart
+        basic_details = ImageDetails(**record.basic_details)
+        await toolbox.services.phash_index.reserve_image(job.organization_id, job.blob_path, basic_details.phash, check=False)
+
+    if record.dominant_colors is None or record.facial_details is None:
+        job.visual = await extract_visual_features(await ensure_decoded(job), job.organization_id, basic_details)
+        await checkpoint(
+            job,
+            dominant_colors=[
+                {"color_id": dominant_color.color.id, "lab_vector": dominant_color.color.lab_vector, "percentage": dominant_color.percentage}
+                for dominant_color in job.visual.dominant_colors
+            ],
+            facial_details=job.visual.facial_details.model_dump()
+        )
+    else:
+        job.visual = VisualFeatures(
+            basic_details=basic_details,
+            dominant_colors=[
+                DominantColor(
+                    color=Color(id=color["color_id"], lab_vector=color["lab_vector"], organization=job.organization_id),
+                    percentage=color["percentage"]
+                )
+                for color in record.dominant_colors
+            ],
+            facial_details=FacialDetails(**record.facial_details)
+        )
+
+async def enrich_upload(toolbox: Toolbox, job: IngestJob):
+    """Detect products and caption and tag the image with the LLM."""
+    record = job.record
+    if record.image_caption is None or record.image_tags is None or record.product_ids is None:
+        job.semantic = await extract_semantic_features(await ensure_decoded(job), job.organization_id, job.visual.basic_details)
+        await checkpoint(
+            job,
+            product_ids=[product.id for product in job.semantic.product_details.detections],
+            image_caption=job.semantic.image_caption,
+            image_tags=job.semantic.image_tags.model_dump()
+        )
         print("Image info gathering complete")
-        
-        # Re-upload the image to the PROCESSED container
-        processed_blob_path = f"{organization_id}/{uuid.uuid4()}.{image_info.basic_details.file_type.lower()}"
-        await blob_storage.upload_blob(
-            processed_blob_path,
-            image_data,
-            BlobStorageService.ContainerName.PROCESSED
+    else:
+        products = await Product.find({"_id": {"$in": record.product_ids}}).to_list() if record.product_ids else []
+        job.semantic = SemanticFeatures(
+            product_details=ProductDetectionDetails(detections=products),
+            image_caption=record.image_caption,
+            image_tags=ImageTags(**record.image_tags)
+        )
+    # Later stages only need the extracted features; the stored image is copied from the upload
+    job.image = None
+    job.image_data = None
+
+async def embed_upload(toolbox: Toolbox, job: IngestJob):
+    if job.record.caption_embedding is not None:
+        job.caption_embedding = job.record.caption_embedding
+        return
+
+    # Create an embedding for the image caption
+    llm_service = toolbox.services.llm
+    job.caption_embedding = await llm_service.create_embedding(job.semantic.image_caption)
+    await checkpoint(job, caption_embedding=job.caption_embedding)
+
+    print("Caption embedding created")
+
+async def store_faces(toolbox: Toolbox, job: IngestJob, image_info: ImageSearchMetadata, image: Image) -> List[Face]:
+    """
+    Store the image's faces, skipping duplicates of faces already in the organization.
+
+    Crops are uploaded concurrently, up to `FACE_UPLOAD_CONCURRENCY` at a time, and the new
+    Face documents are inserted in one bulk write.
+
+    Returns:
+        List[Face]: The image's faces, in detection order.
+    """
+    organization_id = job.organization_id
+    facial_details = image_info.facial_details
+    face_ids = job.record.face_ids
+    file_ext = image_info.basic_details.file_type.lower()
+
+    # Faces stored by an earlier attempt are kept as they are
+    stored_faces = {face.id: face for face in await Face.find({"_id": {"$in": face_ids}}).to_list()} if face_ids else {}
+    pending = [i for i, face_id in enumerate(face_ids) if face_id not in stored_faces]
+
+    # Skip faces already stored from a near-duplicate of this image
+    duplicates = await toolbox.services.phash_index.find_faces(
+        organization_id, [(face_ids[i], facial_details.phashes[i]) for i in pending], image.phash
+    )
+    for i in pending:
+        if face_ids[i] in duplicates:
+            print(f"Face with phash {facial_details.phashes[i]} already exists in the organization. Skipping.")
+    pending = [i for i in pending if face_ids[i] not in duplicates]
+
+    # Upload the face images to the faces container, named after their face ids
+    semaphore = asyncio.Semaphore(face_upload_concurrency)
+
+    async def upload_face(i: int) -> str:
+        face_blob_path = f"{organization_id}/{face_ids[i]}.{file_ext}"
+        async with semaphore:
+            await toolbox.services.blob_storage.upload_blob(
+                face_blob_path,
+                base64.b64decode(facial_details.aligned_faces[i]),
+                BlobStorageService.ContainerName.FACES,
+                overwrite=True
+            )
+        return face_blob_path
+
+    face_blob_paths = await asyncio.gather(*(upload_face(i) for i in pending))
+
+    print("Face images uploaded")
+
+    faces = [
+        Face(
+            id=face_ids[i],
+            organization=organization_id,
+            face_embedding=facial_details.face_embeddings[i],
+            bounding_box=facial_details.bounding_boxes[i],
+            detection_confidence=facial_details.confidence_levels[i],
+            image=image,
+            file_path=face_blob_path,
+            phash=facial_details.phashes[i]
+        )
+        for i, face_blob_path in zip(pending, face_blob_paths)
+    ]
+    if faces:
+        await Face.insert_many(faces)
+        await toolbox.services.vector_index.add_many(
+            "face", organization_id, [face.id for face in faces], [face.face_embedding for face in faces]
         )
+        for face in faces:
+            toolbox.services.phash_index.add_face(organization_id, face.id, face.phash, image.phash)
+        stored_faces.update({face.id: face for face in faces})
+
+    print("Face documents created")
+
+    return [stored_faces[face_id] for face_id in face_ids if face_id in stored_faces]
 
-        print("Image re-uploaded to processed container")
+async def store_upload(toolbox: Toolbox, job: IngestJob):
+    """Write the processed image, its tags and faces, then remove the upload."""
+    blob_storage = toolbox.services.blob_storage
+    image_info: ImageSearchMetadata = combine_features(job.visual, job.semantic)
+    organization_id = job.organization_id
+    user_id = job.user_id
+    creation_method = job.creation_method
+    caption_embedding = job.caption_embedding
+    record = job.record
+    file_ext = image_info.basic_details.file_type.lower()
+
+    if record.image_id is None:
+        # Fix every id and blob path up front, so a retried store overwrites its own writes
+        await checkpoint(
+            job,
+            image_id=PydanticObjectId(),
+            face_ids=[PydanticObjectId() for _ in image_info.facial_details.aligned_faces],
+            processed_blob_path=f"{organization_id}/{uuid.uuid4()}.{file_ext}"
+        )
+    processed_blob_path = record.processed_blob_path
 
-        # Create an embedding for the image caption
-        llm_service = toolbox.services.llm
-        caption_embedding = await llm_service.create_embedding(image_info.image_caption)
+    if not record.image_saved:
+        # Copy the upload to the PROCESSED container, server side
+        await blob_storage.copy_blob(
+            job.blob_path,
+            processed_blob_path,
+            BlobStorageService.ContainerName.UPLOADS,
+            BlobStorageService.ContainerName.PROCESSED
+        )
 
-        print("Caption embedding created")
+        print("Image copied to processed container")
 
-        # Create or get existing tags
-        tags = []
+        # Resolve tags from the organization's tag dictionary, creating any new ones
         tag_categories = [
             ("people", image_info.image_tags.people),
             ("lighting", image_info.image_tags.lighting),
@@ -76,22 +332,17 @@ async def background_process_uploaded_image(toolbox: Toolbox, creation_method: s
             ("time", image_info.image_tags.time),
             ("weather", image_info.image_tags.weather)
         ]
-
-        for category, tag_names in tag_categories:
-            for tag_name in tag_names:
-                full_tag_name = f"{category}-{tag_name}"
-                existing_tag = await Tag.find_one({"name": full_tag_name, "category": category, "organization": organization_id})
-                if existing_tag:
-                    tags.append(existing_tag)
-                else:
-                    new_tag = Tag(name=full_tag_name, category=category, organization=organization_id)
-                    await new_tag.save()
-                    tags.append(new_tag)
+        tags = await toolbox.services.tag_dictionary.resolve(organization_id, [
+            (category, f"{category}-{tag_name}")
+            for category, tag_names in tag_categories
+            for tag_name in tag_names
+        ])
 
         print("Tags created or retrieved")
 
-        # Create and save Image document
+        # Build the Image document; it is written once, after its faces
         image = Image(
+            id=record.image_id,
             organization=organization_id,
             created_by_user=user_id,
             creation_method=creation_method,
@@ -105,87 +356,53 @@ async def background_process_uploaded_image(toolbox: Toolbox, creation_method: s
             resolution=image_info.basic_details.resolution,
             format=image_info.basic_details.file_type,
             dominant_colors=image_info.dominant_colors,
+            palette=build_palette(image_info.dominant_colors),
             detected_products=image_info.product_details.detections,
             caption=image_info.image_caption,
             caption_embedding=caption_embedding,
             tags=tags
         )
+        image.faces = await store_faces(toolbox, job, image_info, image)
+
+        # With its id fixed, saving again replaces it
         await image.save()
+        await toolbox.services.vector_index.add("caption", organization_id, image.id, caption_embedding)
+        await toolbox.services.tag_index.add(organization_id, image.id, tags)
+        toolbox.services.phash_index.add_image(organization_id, image.id, image.phash)
+        await bump_search_generation(organization_id)
+        await checkpoint(job, image_saved=True)
 
         print("Image document created")
 
-        # Upload face images to the faces container
-        face_file_paths = []
-        for i, aligned_face_base64 in enumerate(image_info.facial_details.aligned_faces):
-            
-            # Decode the base64 string to bytes
-            face_image_bytes = base64.b64decode(aligned_face_base64)
-
-            # Generate a unique filename for the face image
-            file_ext = image_info.basic_details.file_type.lower()
-            face_filename = f"{uuid.uuid4()}.{file_ext}"
-            # Use only the organization ID in the path
-            face_blob_path = f"{organization_id}/{face_filename}"
-
-            # Upload the face image to the faces container
-            await blob_storage.upload_blob(
-                face_blob_path,
-                face_image_bytes,
-                BlobStorageService.ContainerName.FACES
-            )
-            face_file_paths.append(face_blob_path)
-
-        print("Face images uploaded")
-
-        # Create and save Face documents
-        for i, _ in enumerate(image_info.facial_details.aligned_faces):
-            # Check if a face with the same phash already exists in the organization
-            face_phash = image_info.facial_details.phashes[i]
-            existing_face = await Face.find_one({
-                "organization": organization_id,
-                "phash": face_phash,
-                "image.phash": image_info.basic_details.phash
-            })
-
-            if existing_face:
-                print(f"Face with phash {face_phash} already exists in the organization. Skipping.")
-                # Delete the existing face image from blob storage
-                try:
-                    await blob_storage.delete_blob(existing_face.file_path, BlobStorageService.ContainerName.FACES)
-                    print(f"Deleted existing face image: {existing_face.file_path}")
-                except Exception as e:
-                    print(f"Error deleting existing face image: {str(e)}")
-                continue
-            
-            face = Face(
-                image=image,
-                file_path=face_file_paths[i],
-                organization=organization_id,
-                face_embedding=image_info.facial_details.face_embeddings[i],
-                bounding_box=image_info.facial_details.bounding_boxes[i],
-                detection_confidence=image_info.facial_details.confidence_levels[i],
-                phash=image_info.facial_details.phashes[i]
-            )
-            await face.save()
-            image.faces.append(face)
-
-        print("Face documents created")
+    # Finished; nothing left to resume. Dropped before the upload, which a resume would need
+    await record.delete()
 
-        # Update Image document with face references
-        await image.save()
+    await blob_storage.delete_blob(job.blob_path, BlobStorageService.ContainerName.UPLOADS)
 
-        print("Image document updated")
+    print("Image deleted from uploads container")
 
-    except ImageAlreadyExistsError as e:
-        print(f"Duplicate image detected: {str(e)}")
-        # Remove the image from the uploads container
-        try:
-            await blob_storage.delete_blob(blob_path, BlobStorageService.ContainerName.UPLOADS)
-            print(f"Duplicate image removed from uploads container: {blob_path}")
-        except Exception as delete_error:
-            print(f"Error removing duplicate image from uploads container: {str(delete_error)}")
-        return
+async def discard_duplicate_upload(toolbox: Toolbox, job: IngestJob, error: ImageAlreadyExistsError):
+    print(f"Duplicate image detected: {str(error)}")
+    # Remove the image from the uploads container
+    try:
+        await toolbox.services.blob_storage.delete_blob(job.blob_path, BlobStorageService.ContainerName.UPLOADS)
+        print(f"Duplicate image removed from uploads container: {job.blob_path}")
+    except Exception as delete_error:
+        print(f"Error removing duplicate image from uploads container: {str(delete_error)}")
+    if job.record is not None:
+        await job.record.delete()
 
-    await blob_storage.delete_blob(blob_path, BlobStorageService.ContainerName.UPLOADS)
+INGEST_STAGES = [download_upload, analyze_upload, enrich_upload, embed_upload, store_upload]
 
-    print("Image deleted from uploads container")
\ No newline at end of file
+async def background_process_uploaded_image(toolbox: Toolbox, creation_method: str, user_id: PydanticObjectId, organization_id: PydanticObjectId, blob_path: str):
+    job = IngestJob(creation_method, user_id, organization_id, blob_path)
+    try:
+        for stage in INGEST_STAGES:
+            await stage(toolbox, job)
+    except ImageAlreadyExistsError as e:
+        await discard_duplicate_upload(toolbox, job, e)
+    except Exception as e:
+        await record_ingest_failure(job, e)
+        raise
+    finally:
+        toolbox.services.phash_index.release_image(organization_id, blob_path)
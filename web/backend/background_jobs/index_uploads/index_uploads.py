@@ -1,27 +1,78 @@
 import asyncio
+from datetime import datetime, timedelta
+from typing import List
 
 from beanie import PydanticObjectId
+from models import IngestRecord
 from toolbox import Toolbox
-from .index_image import background_process_uploaded_image
+from .index_image import IngestJob
+from .ingest_pipeline import ingest_pipeline
+
+async def _submit_all(toolbox: Toolbox, jobs: List[IngestJob]) -> List[asyncio.Future]:
+    """
+    Submit jobs whose backlog capacity is reserved, waiting whenever the first stage is
+    full. Capacity reserved for jobs that never got submitted, because submitting failed
+    or the caller was cancelled, is released here.
+    """
+    results = []
+    try:
+        ingest_pipeline.start(toolbox)
+        for job in jobs:
+            results.append(await ingest_pipeline.submit(job))
+    finally:
+        if len(results) < len(jobs):
+            ingest_pipeline.release(jobs[len(results)].organization_id, len(jobs) - len(results))
+    return results
 
 async def index_uploaded_images(toolbox: Toolbox, organization_id: PydanticObjectId, user_id: PydanticObjectId, image_filepaths: list[str]):
+    """
+    Index uploaded images through the shared ingest pipeline.
+
+    Backlog capacity for every file must already be reserved with `ingest_pipeline.reserve`,
+    which is how callers find out the pipeline is full before accepting the upload.
+    """
     print(f"Indexing {len(image_filepaths)} images for organization {organization_id}")
-    async def process_image(filepath: str):
-        try:
-            await background_process_uploaded_image(
-                toolbox,
-                creation_method="upload",
-                user_id=user_id,
-                organization_id=organization_id,
-                blob_path=filepath
-            )
-        except Exception as e:
-            print(f"Error processing image {filepath}: {str(e)}")
-
-    # Create tasks for each image filepath
-    tasks = [process_image(filepath) for filepath in image_filepaths]
-
-    # Run all tasks concurrently
-    await asyncio.gather(*tasks)
-
-    print(f"Finished indexing {len(image_filepaths)} images for organization {organization_id}")
+
+    # Submitting waits whenever the first stage is full, so only a bounded number of this
+    # upload's images are in memory at once
+    results = await _submit_all(toolbox, [
+        IngestJob(creation_method="upload", user_id=user_id, organization_id=organization_id, blob_path=filepath)
+        for filepath in image_filepaths
+    ])
+    indexed = await asyncio.gather(*results)
+
+    print(f"Finished indexing {sum(indexed)} of {len(image_filepaths)} images for organization {organization_id}")
+
+async def find_interrupted_uploads(organization_id: PydanticObjectId, idle_minutes: int = 30) -> List[IngestRecord]:
+    """
+    Ingest records of the organization's uploads whose indexing stopped part way.
+
+    A record outlives its upload only if indexing failed after every retry or the process
+    stopped mid-upload. Records updated within `idle_minutes` may still be in progress and
+    are left alone.
+    """
+    return await IngestRecord.find({
+        "organization_id": organization_id,
+        "updated_at": {"$lt": datetime.utcnow() - timedelta(minutes=idle_minutes)}
+    }).sort("updated_at").to_list()
+
+async def resume_interrupted_uploads(toolbox: Toolbox, records: List[IngestRecord]):
+    """
+    Index interrupted uploads again through the ingest pipeline, each from its last
+    checkpoint. This runs in the API process so the in-memory search indexes it shares
+    with search requests pick the images up. Backlog capacity must already be reserved.
+    """
+    print(f"Resuming {len(records)} interrupted uploads")
+
+    results = await _submit_all(toolbox, [
+        IngestJob(
+            creation_method=record.creation_method,
+            user_id=record.user_id,
+            organization_id=record.organization_id,
+            blob_path=record.blob_path
+        )
+        for record in records
+    ])
+    indexed = await asyncio.gather(*results)
+
+    print(f"Finished resuming {sum(indexed)} of {len(records)} interrupted uploads")
@@ -0,0 +1,218 @@
+import os
+import asyncio
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+from beanie import PydanticObjectId
+from dotenv import load_dotenv
+
+from toolbox import Toolbox
+from toolbox.services.image.process_image_for_search import ImageAlreadyExistsError
+from toolbox.services.image.process_image_for_search.cpu_pool import cpu_pool
+from .index_image import (
+    IngestJob,
+    download_upload,
+    analyze_upload,
+    enrich_upload,
+    embed_upload,
+    store_upload,
+    discard_duplicate_upload,
+    record_ingest_failure
+)
+
+load_dotenv()
+
+# Uploads accepted but not yet finished, across all organizations
+max_backlog = int(os.getenv("INGEST_MAX_BACKLOG", "5000"))
+# Attempts per upload before it is left for the resume endpoint; failed stages are
+# retried from their checkpoint after an exponential backoff starting at this many seconds
+max_attempts = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+retry_delay = float(os.getenv("INGEST_RETRY_DELAY", "2"))
+
+class IngestBacklogFullError(Exception):
+    def __init__(self, backlog: int, requested: int):
+        self.backlog = backlog
+        self.requested = requested
+        # Shown to the uploader, so it leaves out the other organizations' pending uploads
+        super().__init__(f"Ingest backlog is full ({requested} requested, limit {max_backlog})")
+
+class Stage:
+    """
+    One step of the ingest pipeline: `concurrency` workers pulling jobs from a bounded queue.
+
+    A full queue blocks the stage before it, so a slow stage holds back everything upstream
+    instead of letting downloaded images pile up in memory.
+    """
+
+    def __init__(self, name: str, handler: Callable, concurrency: int, queue_size: int):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.active = 0
+
+    @classmethod
+    def from_env(cls, name: str, handler: Callable, default_concurrency: int) -> "Stage":
+        concurrency = int(os.getenv(f"INGEST_{name.upper()}_CONCURRENCY", str(default_concurrency)))
+        queue_size = int(os.getenv(f"INGEST_{name.upper()}_QUEUE_SIZE", str(2 * concurrency)))
+        return cls(name, handler, concurrency, queue_size)
+
+class IngestPipeline:
+    """
+    Staged, bounded-concurrency indexing of uploaded images:
+
+        download -> analyze (decode, dedupe, colors, faces) -> enrich (LLM products, caption,
+        tags) -> embed -> store (blob and database writes)
+
+    Every stage has its own worker count and input queue, so downloads, CPU work and each
+    external API are throttled independently and throughput settles at the slowest stage.
+    Admission is bounded too: callers reserve backlog capacity before submitting and are
+    turned away once `INGEST_MAX_BACKLOG` uploads are in flight.
+
+    The pipeline runs on the background I/O thread's event loop; only `reserve` and `release`
+    may be called from other threads.
+    """
+
+    def __init__(self):
+        self.stages: List[Stage] = [
+            Stage.from_env("download", download_upload, 16),
+            # One image per CPU worker keeps the pool busy without queueing decoded images in it
+            Stage.from_env("analyze", analyze_upload, cpu_pool.size),
+            Stage.from_env("enrich", enrich_upload, 8),
+            # Workers mostly wait on the embedding batcher, so many of them share each request
+            Stage.from_env("embed", embed_upload, 64),
+            Stage.from_env("store", store_upload, 8),
+        ]
+        self.backlog = 0
+        # The same, by organization, so each one only sees its own uploads in the stats
+        self.organization_backlogs: Dict[PydanticObjectId, int] = {}
+        self.backlog_lock = threading.Lock()
+        self.toolbox: Optional[Toolbox] = None
+        self.workers: List[asyncio.Task] = []
+        # Pending retries, referenced so they are not garbage collected mid-backoff
+        self.retries: Set[asyncio.Task] = set()
+
+    def reserve(self, organization_id: PydanticObjectId, count: int):
+        """
+        Claim backlog capacity for `count` of an organization's uploads; each is released
+        when it finishes.
+
+        Raises:
+            IngestBacklogFullError: If accepting them would exceed the backlog limit.
+        """
+        with self.backlog_lock:
+            if self.backlog + count > max_backlog:
+                raise IngestBacklogFullError(self.backlog, count)
+            self.backlog += count
+            self.organization_backlogs[organization_id] = self.organization_backlogs.get(organization_id, 0) + count
+
+    def release(self, organization_id: PydanticObjectId, count: int = 1):
+        with self.backlog_lock:
+            self.backlog -= count
+            remaining = self.organization_backlogs.get(organization_id, 0) - count
+            if remaining > 0:
+                self.organization_backlogs[organization_id] = remaining
+            else:
+                self.organization_backlogs.pop(organization_id, None)
+
+    def start(self, toolbox: Toolbox):
+        if self.workers:
+            return
+        self.toolbox = toolbox
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+        for position, stage in enumerate(self.stages):
+            next_stage = self.stages[position + 1] if position + 1 < len(self.stages) else None
+            self.workers += [asyncio.create_task(self._work(stage, next_stage)) for _ in range(stage.concurrency)]
+        print("Ingest pipeline started: " + ", ".join(f"{stage.name} x{stage.concurrency}" for stage in self.stages))
+
+    async def _work(self, stage: Stage, next_stage: Optional[Stage]):
+        while True:
+            job, done = await stage.queue.get()
+            stage.active += 1
+            # Unless the job moves on to another stage or a retry, its future is resolved here,
+            # whatever happens while handling it, so its backlog slot is always released
+            indexed = False
+            handed_off = forward = False
+            try:
+                await stage.handler(self.toolbox, job)
+                if next_stage is None:
+                    indexed = True
+                else:
+                    handed_off = forward = True
+            except ImageAlreadyExistsError as e:
+                try:
+                    await discard_duplicate_upload(self.toolbox, job, e)
+                except Exception as discard_error:
+                    print(f"Error discarding duplicate upload {job.blob_path}: {str(discard_error)}")
+            except Exception as e:
+                print(f"Error in ingest stage {stage.name} for {job.blob_path}: {str(e)}")
+                try:
+                    await record_ingest_failure(job, e)
+                    if job.attempts < max_attempts:
+                        # Outside the worker, so waiting out the backoff does not hold a slot
+                        retry = asyncio.create_task(self._retry(stage, job, done))
+                        self.retries.add(retry)
+                        retry.add_done_callback(self.retries.discard)
+                        handed_off = True
+                except Exception as retry_error:
+                    print(f"Error scheduling retry for {job.blob_path}: {str(retry_error)}")
+            finally:
+                stage.active -= 1
+                stage.queue.task_done()
+                if not handed_off and not done.done():
+                    done.set_result(indexed)
+
+            if forward:
+                # Blocks while the next stage is saturated, which is what bounds memory
+                await next_stage.queue.put((job, done))
+
+    async def _retry(self, stage: Stage, job: IngestJob, done: asyncio.Future):
+        try:
+            await asyncio.sleep(retry_delay * 2 ** (job.attempts - 1))
+            print(f"Retrying ingest stage {stage.name} for {job.blob_path} (attempt {job.attempts + 1} of {max_attempts})")
+            await stage.queue.put((job, done))
+        except BaseException:
+            # Cancelled before the job was requeued; give up on it
+            if not done.done():
+                done.set_result(False)
+            raise
+
+    async def submit(self, job: IngestJob) -> asyncio.Future:
+        """
+        Queue a job for the first stage, waiting while that stage is full. Capacity for the
+        job must already be reserved; it is released, along with the job's phash reservation,
+        when the returned future resolves to whether the image was indexed. If submitting
+        fails, the job was never queued and its capacity is still the caller's to release.
+        """
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda _: self.release(job.organization_id))
+        done.add_done_callback(lambda _: self.toolbox.services.phash_index.release_image(job.organization_id, job.blob_path))
+        await self.stages[0].queue.put((job, done))
+        return done
+
+    def organization_stats(self, organization_id: PydanticObjectId) -> dict:
+        return {
+            "backlog": self.organization_backlogs.get(organization_id, 0),
+            "max_backlog": max_backlog
+        }
+
+    def stats(self) -> dict:
+        """Process-wide stats, covering every organization's uploads."""
+        return {
+            "backlog": self.backlog,
+            "max_backlog": max_backlog,
+            "retrying": len(self.retries),
+            "stages": {
+                stage.name: {
+                    "concurrency": stage.concurrency,
+                    "active": stage.active,
+                    "queued": stage.queue.qsize() if stage.queue else 0,
+                    "queue_size": stage.queue_size
+                }
+                for stage in self.stages
+            }
+        }
+
+ingest_pipeline = IngestPipeline()
@@ -1,12 +1,61 @@
-from fastapi import Request
+import json
+import base64
+import asyncio
+from typing import List, Optional, Tuple
+from fastapi import HTTPException, Request
 from beanie import PydanticObjectId
 import numpy as np
 import skimage.color
-from models import Image, Color
+from models import Image, Face
 from toolbox import Toolbox
-from api.request_types.search import ImageSearchRequest 
+from api.request_types.search import ImageSearchRequest
 from api.response_types.search import ImageSearchResponse
 from toolbox.services.blob_storage import BlobStorageService, BlobSasPermissions
+from toolbox.services.search_cache import search_result_cache, search_query_cache, search_cache_key, get_search_generation
+from toolbox.services.image.color_palette import bins_within, rank_palettes, COLOR_CUTOFF_DISTANCE
+from toolbox.services.image.process_image_for_search.extract_faces import embed_face_crop
+
+# Reciprocal rank fusion constant and per-signal candidate depth for hybrid search
+RRF_K = 60
+HYBRID_CANDIDATES = 200
+
+# Text search returns at most this many results, ranked once per search
+TEXT_SEARCH_DEPTH = 1000
+
+# FaceNet cosine similarity above which two faces are treated as the same person, and the
+# number of nearest faces considered per query face
+FACE_SIMILARITY_THRESHOLD = 0.6
+FACE_CANDIDATES = 1000
+
+# Pagination
+#
+# Every mode is paginated with a keyset cursor instead of $skip. Results are ordered by
+# (score desc, _id desc) for ranked modes and by _id desc otherwise, and the cursor records
+# the sort key of the last result returned, so the next page is a range scan that costs the
+# same at any depth. The total is computed once on the first page and carried in the cursor.
+
+def encode_cursor(last_id: PydanticObjectId, score: Optional[float], seen: int, total: int) -> str:
+    payload = {"id": str(last_id), "score": score, "seen": seen, "total": total}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        payload["id"] = PydanticObjectId(payload["id"])
+        return payload
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid search cursor")
+
+def keyset_match(cursor: Optional[dict], score_field: Optional[str] = None) -> dict:
+    """Match documents that sort strictly after the cursor."""
+    if not cursor:
+        return {}
+    if score_field is None:
+        return {"_id": {"$lt": cursor["id"]}}
+    return {"$or": [
+        {score_field: {"$lt": cursor["score"]}},
+        {score_field: cursor["score"], "_id": {"$lt": cursor["id"]}}
+    ]}
 
 async def perform_image_search(
     organization_id: str,
@@ -14,260 +63,349 @@ async def perform_image_search(
     image_search_request: ImageSearchRequest,
     toolbox
 ) -> ImageSearchResponse:
-    toolbox: Toolbox = request.state.toolbox 
-    
-    query = [{"$match": {"organization.$id": PydanticObjectId(organization_id)}}]
+    toolbox: Toolbox = request.state.toolbox
+    page_size = image_search_request.page_size
+
+    # Serve repeated searches from the result cache until the organization's library changes
+    generation = await get_search_generation(PydanticObjectId(organization_id))
+    cache_key = search_cache_key(organization_id, generation, image_search_request)
+    cached = search_result_cache.get(cache_key)
+    if cached is not None:
+        hits, total, page, next_cursor, facets = cached
+        images = await hydrate_ranked(hits)
+        return await build_response(toolbox, images, total, page, page_size, next_cursor, facets)
+
+    # State shared by every page of this search: facets and the ranking of the scored modes
+    query_key = search_cache_key(organization_id, generation, image_search_request, paged=False)
+    query_state = search_query_cache.get(query_key) or {}
+
+    cursor = decode_cursor(image_search_request.cursor) if image_search_request.cursor else None
+    # Without a cursor, a page number still works as an offset (used when jumping to a page)
+    seen = cursor["seen"] if cursor else (image_search_request.page - 1) * page_size
+    skip = 0 if cursor else seen
+    total = cursor["total"] if cursor else None
+    score_field = None
+
+    base_match = {"organization.$id": PydanticObjectId(organization_id)}
+    if image_search_request.products:
+        base_match["detected_products.$id"] = {"$in": [PydanticObjectId(product_id) for product_id in image_search_request.products]}
 
     def hex_to_rgb(hex_color):
         hex_color = hex_color.lstrip('#')
         return np.array([int(hex_color[i:i+2], 16) for i in (0, 2, 4)]) / 255.0
 
-    rgb_colors = np.array([hex_to_rgb(color) for color in image_search_request.dominant_colors])
+    rgb_colors = np.array([hex_to_rgb(color) for color in image_search_request.dominant_colors or []])
     lab_colors = skimage.color.rgb2lab(rgb_colors.reshape(1, -1, 3)).reshape(-1, 3)
 
-    if image_search_request.text:
+    has_faces = bool(image_search_request.faces or image_search_request.face_image)
 
-        # Vectorize the search query using LLMService
-        llm_service = toolbox.services.llm
-        query_embedding = await llm_service.create_embedding(image_search_request.text)
+    # Tag filters are resolved against the in-memory inverted index; `allowed` holds the
+    # binary ids of matching images and every mode restricts its results to it
+    tag_index = await toolbox.services.tag_index.get_index(PydanticObjectId(organization_id))
+    allowed = None
+    if image_search_request.tags:
+        allowed = set(tag_index.ids_of(tag_index.match([PydanticObjectId(tag_id) for tag_id in image_search_request.tags])))
+    # Images the facet counts are taken over; None means the filter set (org, products and tags)
+    facet_ids = None
 
-        # Search in caption or tags
-        query = [{
-            "$vectorSearch": {
-                "exact": True,
-                "filter": {
-                    "organization.$id": PydanticObjectId(organization_id)
-                },
-                "index": "qckfx_image_vector_index",
-                "limit": image_search_request.page_size,
-                # "numCandidates": image_search_request.page_size * 20,
-                "path": "caption_embedding",
-                "queryVector": query_embedding,
-            }
-        }]
+    if image_search_request.hybrid and (image_search_request.text or image_search_request.dominant_colors or has_faces):
+        score_field = "score"
+
+        # Every signal contributes its top HYBRID_CANDIDATES; the product filter is already in
+        # base_match. The fused ranking is built once, on the first page, so every page is a
+        # keyset slice of the same order and total.
+        ranked = query_state.get("ranked")
+        if ranked is None:
+            rankers = []
+            if image_search_request.text:
+                rankers.append(rank_text(toolbox, organization_id, base_match, image_search_request, HYBRID_CANDIDATES, allowed))
+            if image_search_request.dominant_colors:
+                rankers.append(rank_colors(base_match, lab_colors))
+            if has_faces:
+                rankers.append(rank_faces(toolbox, organization_id, base_match, image_search_request))
+            rankings = await asyncio.gather(*rankers)
+
+            fused = reciprocal_rank_fusion([restrict(ranking, allowed)[:HYBRID_CANDIDATES] for ranking in rankings])
+            ranked = sorted(fused.items(), key=lambda hit: (hit[1], hit[0].binary), reverse=True)
+            query_state["ranked"] = ranked
+        total = len(ranked)
+        facet_ids = [image_id for image_id, _ in ranked]
+        images = await hydrate_ranked(after_cursor(ranked, cursor)[skip:skip + page_size])
+
+    elif image_search_request.text:
+        score_field = "score"
+
+        # Vector search has no offset, so the best TEXT_SEARCH_DEPTH matches are ranked once,
+        # on the first page, and every page is a keyset slice of that ranking. Text results
+        # end there, and the total and facets count the ranked matches.
+        ranked = query_state.get("ranked")
+        if ranked is None:
+            ranked = await rank_text(toolbox, organization_id, base_match, image_search_request, TEXT_SEARCH_DEPTH, allowed)
+            query_state["ranked"] = ranked
+        total = len(ranked)
+        facet_ids = [image_id for image_id, _ in ranked]
+        images = await hydrate_ranked(after_cursor(ranked, cursor)[skip:skip + page_size])
+
+    elif has_faces:
+        score_field = "score"
 
+        ranked = query_state.get("ranked")
+        if ranked is None:
+            ranked = restrict(await rank_faces(toolbox, organization_id, base_match, image_search_request), allowed)
+            query_state["ranked"] = ranked
+        total = len(ranked)
+        facet_ids = [image_id for image_id, _ in ranked]
+        images = await hydrate_ranked(after_cursor(ranked, cursor)[skip:skip + page_size])
+
+    elif allowed is not None:
+        # The filter set is already in memory, so page through it there in _id order
+        matching = allowed
         if image_search_request.products:
-            query[0]["$vectorSearch"]["filter"]["detected_products.$id"] = {"$in": [PydanticObjectId(product_id) for product_id in image_search_request.products]}
+            matching = allowed & {image_id.binary for image_id in await matching_ids(base_match)}
+        ranked = [(PydanticObjectId(image_id), None) for image_id in sorted(matching, reverse=True)]
+        total = len(ranked)
+        facet_ids = [image_id for image_id, _ in ranked]
+        if cursor:
+            ranked = [hit for hit in ranked if hit[0] < cursor["id"]]
+        images = await hydrate_ranked(ranked[skip:skip + page_size])
 
     elif image_search_request.products:
         print("Product Search")
         query = [
-            {
-                "$match": {
-                    "detected_products.$id": {"$in": [PydanticObjectId(product_id) for product_id in image_search_request.products]}
-                }
-            },
-            {
-                "$match": {
-                    "organization.$id": PydanticObjectId(organization_id)
-                }
-            },
-            {
-                "$skip": (image_search_request.page - 1) * image_search_request.page_size
-            },
-            {
-                "$limit": image_search_request.page_size
-            }
+            {"$match": {**base_match, **keyset_match(cursor)}},
+            {"$sort": {"_id": -1}}
         ]
+        images, total = await aggregate_page(query, skip, page_size, total)
 
     elif image_search_request.dominant_colors:
         print("Color Search")
-        cutoff_distance = 25.0  # Define a cutoff distance in Lab space
-        query = [{
-            "$vectorSearch": {
-                "exact": True,
-                "filter": {
-                    "organization.$id": PydanticObjectId(organization_id)
-                },
-                "index": "qckfx_color_vector_index",
-                "limit": image_search_request.page_size,
-                # "numCandidates": image_search_request.page_size * 20,
-                "path": "lab_vector",
-                "queryVector": lab_colors[0].tolist(),
-            }
-        }]
-        
-        # Aggregate to find colors within the cutoff distance
-        colors = await Color.aggregate([
-            {
-                "$vectorSearch": {
-                    "exact": True,
-                    "filter": {
-                        "organization.$id": PydanticObjectId(organization_id)
-                    },
-                    "index": "qckfx_color_vector_index",
-                    "limit": 100,  # Increase limit to fetch more candidates
-                    "path": "lab_vector",
-                    "queryVector": lab_colors[0].tolist(),
-                }
-            },
-            {
-                "$addFields": {
-                    "distance": {
-                        "$sqrt": {
-                            "$add": [  # Use $add instead of $sum for proper aggregation
-                                {"$pow": [
-                                    {"$subtract": [
-                                        {"$arrayElemAt": ["$lab_vector", 0]}, 
-                                        lab_colors[0][0]
-                                    ]}, 
-                                    2
-                                ]},
-                                {"$pow": [
-                                    {"$subtract": [
-                                        {"$arrayElemAt": ["$lab_vector", 1]}, 
-                                        lab_colors[0][1]
-                                    ]}, 
-                                    2
-                                ]},
-                                {"$pow": [
-                                    {"$subtract": [
-                                        {"$arrayElemAt": ["$lab_vector", 2]}, 
-                                        lab_colors[0][2]
-                                    ]}, 
-                                    2
-                                ]}
-                            ]
-                        }
-                    }
-                }
-            },
-            {
-                "$match": {
-                    "distance": {"$lte": cutoff_distance}
-                }
-            },
-            {
-                "$project": {
-                    "_id": 1,
-                    "distance": 1
-                }
-            }
-        ]).to_list()
-
-        print(colors)
+        score_field = "score"
 
-        if not colors:
-            # If no colors are within the cutoff distance, return empty response early
-            return ImageSearchResponse(
-                images=[],
-                total=0,
-                page=image_search_request.page,
-                page_size=image_search_request.page_size,
-                total_pages=0
-            )
+        ranked = query_state.get("ranked")
+        if ranked is None:
+            ranked = restrict(await rank_colors(base_match, lab_colors), allowed)
+            query_state["ranked"] = ranked
+        total = len(ranked)
+        facet_ids = [image_id for image_id, _ in ranked]
+        images = await hydrate_ranked(after_cursor(ranked, cursor)[skip:skip + page_size])
 
-        # Assign weights based on distance and percentage
+    else:
         query = [
-            {
-                "$match": {
-                    "organization.$id": PydanticObjectId(organization_id),
-                    "dominant_colors.color._id": {"$in": [color["_id"] for color in colors]}
-                }
-            },
-            {
-                "$addFields": {
-                    "weightedColorMatches": {
-                        "$map": {
-                            "input": colors,
-                            "as": "color",
-                            "in": {
-                                "colorId": "$$color._id",
-                                "distance": "$$color.distance",
-                                "weight": {
-                                    "$cond": [
-                                        {"$gt": ["$$color.distance", 0]},
-                                        {"$divide": [cutoff_distance, "$$color.distance"]},
-                                        1
-                                    ]
-                                }
-                            }
-                        }
-                    },
-                    "maxWeightedColorPercentage": {
-                        "$reduce": {
-                            "input": "$dominant_colors",
-                            "initialValue": 0,
-                            "in": {
-                                "$max": [
-                                    "$$value",
-                                    {
-                                        "$let": {
-                                            "vars": {
-                                                "matchingColor": {
-                                                    "$arrayElemAt": [
-                                                        {
-                                                            "$filter": {
-                                                                "input": "$weightedColorMatches",
-                                                                "as": "match",
-                                                                "cond": {"$eq": ["$$match.colorId", "$$this.color._id"]}
-                                                            }
-                                                        }, 
-                                                        0
-                                                    ]
-                                                }
-                                            },
-                                            "in": {
-                                                "$multiply": [
-                                                    "$$matchingColor.weight",
-                                                    "$$this.percentage"
-                                                ]
-                                            }
-                                        }
-                                    }
-                                ]
-                            }
-                        }
-                    }
-                }
-            },
-            {
-                "$sort": {"maxWeightedColorPercentage": -1}
-            },
-            {
-                "$skip": (image_search_request.page - 1) * image_search_request.page_size
-            },
-            {
-                "$limit": image_search_request.page_size
-            }
+            {"$match": {**base_match, **keyset_match(cursor)}},
+            {"$sort": {"_id": -1}}
         ]
+        images, total = await aggregate_page(query, skip, page_size, total)
 
-    # if search.dominant_colors:
-    #     # Example: Match any dominant color vectors (simplistic approach)
-    #     color_queries = [{"dominant_colors.vector": {"$all": color}} for color in search.dominant_colors]
-    #     query["$and"] = color_queries
+    page = seen // page_size + 1
+    seen += len(images)
+    next_cursor = None
+    if images and seen < total:
+        last = images[-1]
+        next_cursor = encode_cursor(last["_id"], last.get(score_field) if score_field else None, seen, total)
 
-    # if search.faces:
-    #     query["faces"] = {"$in": search.faces}
+    # Facets cover the whole result set, so they are counted once per search
+    facets = query_state.get("facets")
+    if facets is None:
+        if facet_ids is not None:
+            facets = tag_index.facets(tag_index.ordinals_of(facet_ids))
+        elif image_search_request.products:
+            product_ids = await matching_ids(base_match)
+            facets = tag_index.facets(tag_index.ordinals_of(product_ids))
+        else:
+            facets = tag_index.facets()
+        query_state["facets"] = facets
+    search_query_cache.put(query_key, query_state)
 
-    # page = search.page if search.page and search.page > 0 else 1
-    # page_size = search.page_size if search.page_size and search.page_size > 0 else 20
-    # skip = (page - 1) * page_size
+    hits = [(image["_id"], image.get(score_field) if score_field else None) for image in images]
+    search_result_cache.put(cache_key, (hits, total, page, next_cursor, facets))
 
-    images = await Image.aggregate(query).to_list()
+    return await build_response(toolbox, images, total, page, page_size, next_cursor, facets)
 
-    # Generate SAS tokens for each image
+async def build_response(toolbox: Toolbox, images: list, total: int, page: int, page_size: int, next_cursor: Optional[str], facets: dict) -> ImageSearchResponse:
+    # Sign the whole page at once
     blob_service = toolbox.services.blob_storage
-    for image in images:
-        sas_url = await blob_service.generate_blob_sas(
-            blob_name=image["file_path"],
-            container_name=BlobStorageService.ContainerName.PROCESSED,
-            expiry_mins=15,  # Token expires in 15 minutes
-            permission=BlobSasPermissions(read=True)
-        )
+    sas_urls = await blob_service.generate_blob_sas_batch(
+        [image["file_path"] for image in images],
+        container_name=BlobStorageService.ContainerName.PROCESSED,
+        expiry_mins=15,  # Tokens stay valid for at least 15 minutes
+        permission=BlobSasPermissions(read=True)
+    )
+    for image, sas_url in zip(images, sas_urls):
         image["url"] = sas_url
-    
-    # total_pages = (total + image_search_request.page_size - 1) // image_search_request.page_size
 
     return ImageSearchResponse(
         images=images,
-        total=1000,
-        page=image_search_request.page,
-        page_size=image_search_request.page_size,
-        total_pages=100
+        total=total,
+        page=page,
+        page_size=page_size,
+        total_pages=(total + page_size - 1) // page_size,
+        next_cursor=next_cursor,
+        facets=facets
     )
 
+async def aggregate_page(query: list, skip: int, page_size: int, total: Optional[int]) -> tuple[list, int]:
+    """
+    Run a sorted image query for one page. When the total is not yet known it is counted in
+    the same round trip with a $facet over the already-filtered stream.
+    """
+    page = ([{"$skip": skip}] if skip else []) + [{"$limit": page_size}]
+    if total is not None:
+        return await Image.aggregate(query + page).to_list(), total
+
+    result = (await Image.aggregate(query + [{
+        "$facet": {
+            "images": page,
+            "total": [{"$count": "count"}]
+        }
+    }]).to_list())[0]
+    return result["images"], (result["total"][0]["count"] if result["total"] else 0)
+
+# Rankers
+#
+# Each ranker returns [(image id, score)] for one signal, best first, restricted to base_match.
+
+async def rank_text(toolbox: Toolbox, organization_id: str, base_match: dict, image_search_request: ImageSearchRequest, limit: int, allowed: Optional[set] = None) -> List[Tuple[PydanticObjectId, float]]:
+    # Vectorize the search query using LLMService
+    llm_service = toolbox.services.llm
+    query_embedding = await llm_service.create_query_embedding(image_search_request.text)
+
+    if image_search_request.approximate:
+        filtered = len(base_match) > 1 or allowed is not None
+        # Over-fetch when filtering so the page can still be filled after the filter is applied
+        hits = await toolbox.services.vector_index.search(
+            "caption",
+            PydanticObjectId(organization_id),
+            query_embedding,
+            limit=limit * (10 if filtered else 1),
+            nprobe=image_search_request.nprobe
+        )
+        # The index never drops deleted images, so hits are always checked against Mongo
+        if hits:
+            matching = await Image.aggregate([
+                {"$match": {**base_match, "_id": {"$in": [image_id for image_id, _ in hits]}}},
+                {"$project": {"_id": 1}}
+            ]).to_list()
+            matching = {doc["_id"] for doc in matching}
+            hits = [hit for hit in hits if hit[0] in matching]
+        hits = restrict(hits, allowed)
+        hits.sort(key=lambda hit: (hit[1], hit[0].binary), reverse=True)
+        return hits[:limit]
+
+    # Search in caption or tags
+    hits = await Image.aggregate([
+        {
+            "$vectorSearch": {
+                "exact": True,
+                "filter": base_match,
+                "index": "qckfx_image_vector_index",
+                # Tag filters are applied afterwards, so over-fetch to still fill the page
+                "limit": limit * (10 if allowed is not None else 1),
+                # "numCandidates": image_search_request.page_size * 20,
+                "path": "caption_embedding",
+                "queryVector": query_embedding,
+            }
+        },
+        {"$project": {"_id": 1, "score": {"$meta": "vectorSearchScore"}}},
+        {"$sort": {"score": -1, "_id": -1}}
+    ]).to_list()
+    return restrict([(hit["_id"], hit["score"]) for hit in hits], allowed)[:limit]
+
+async def rank_colors(base_match: dict, lab_colors: np.ndarray) -> List[Tuple[PydanticObjectId, float]]:
+    # One indexed lookup for every image with a palette color in a cell near any query color
+    candidate_bins = sorted({bin_id for lab in lab_colors for bin_id in bins_within(lab, COLOR_CUTOFF_DISTANCE)})
+    candidates = await Image.aggregate([
+        {"$match": {**base_match, "palette.bin": {"$in": candidate_bins}}},
+        {"$project": {"palette": 1}}
+    ]).to_list()
+    # Scoring every candidate palette is CPU-bound, so it stays off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, rank_palettes, lab_colors, candidates)
+
+async def rank_faces(toolbox: Toolbox, organization_id: str, base_match: dict, image_search_request: ImageSearchRequest) -> List[Tuple[PydanticObjectId, float]]:
+    query_embeddings = []
+    if image_search_request.faces:
+        faces = await Face.aggregate([
+            {"$match": {
+                "_id": {"$in": [PydanticObjectId(face_id) for face_id in image_search_request.faces]},
+                "organization.$id": PydanticObjectId(organization_id)
+            }},
+            {"$project": {"face_embedding": 1}}
+        ]).to_list()
+        query_embeddings += [face["face_embedding"] for face in faces]
+    if image_search_request.face_image:
+        try:
+            face_image = base64.b64decode(image_search_request.face_image)
+        except Exception:
+            raise HTTPException(status_code=400, detail="face_image must be base64-encoded")
+        query_embeddings.append(await embed_face_crop(face_image))
+    if not query_embeddings:
+        return []
+
+    # Nearest stored faces for every query face; a face's score is its best similarity to any of them
+    threshold = FACE_SIMILARITY_THRESHOLD if image_search_request.face_threshold is None else image_search_request.face_threshold
+    searches = await asyncio.gather(*[
+        toolbox.services.vector_index.search("face", PydanticObjectId(organization_id), embedding, limit=FACE_CANDIDATES)
+        for embedding in query_embeddings
+    ])
+    face_scores = {}
+    for hits in searches:
+        for face_id, score in hits:
+            if score >= threshold and score > face_scores.get(face_id, 0.0):
+                face_scores[face_id] = score
+    if not face_scores:
+        return []
+
+    # Map matching faces back to the images that link them, scoring each image by its best face.
+    # Aggregation field paths cannot address DBRef `$id`s, so the scoring happens here.
+    face_ids = list(face_scores.keys())
+    images = Image.get_motor_collection().find({**base_match, "faces.$id": {"$in": face_ids}}, {"faces": 1})
+    hits = [(image["_id"], max(face_scores.get(face.id, 0.0) for face in image["faces"])) async for image in images]
+    hits.sort(key=lambda hit: (hit[1], hit[0].binary), reverse=True)
+    return hits
+
+async def matching_ids(match: dict) -> List[PydanticObjectId]:
+    """Ids of every image matching a query, read from the index alone."""
+    docs = await Image.aggregate([{"$match": match}, {"$project": {"_id": 1}}]).to_list()
+    return [doc["_id"] for doc in docs]
+
+def restrict(ranked: List[Tuple[PydanticObjectId, float]], allowed: Optional[set]) -> List[Tuple[PydanticObjectId, float]]:
+    """Keep the hits whose binary id is in `allowed`; None allows everything."""
+    if allowed is None:
+        return ranked
+    return [hit for hit in ranked if hit[0].binary in allowed]
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[PydanticObjectId, float]]], k: int = RRF_K) -> dict:
+    """Fuse rankings into {image id: sum of 1 / (k + rank)} over every ranking the image appears in."""
+    fused = {}
+    for ranking in rankings:
+        for rank, (image_id, _) in enumerate(ranking, start=1):
+            fused[image_id] = fused.get(image_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+def after_cursor(ranked: List[Tuple[PydanticObjectId, float]], cursor: Optional[dict]) -> List[Tuple[PydanticObjectId, float]]:
+    """Drop hits that sort at or before the cursor from a ranking ordered by (score, _id) descending."""
+    if not cursor:
+        return ranked
+    return [
+        (image_id, score) for image_id, score in ranked
+        if score < cursor["score"] or (score == cursor["score"] and image_id < cursor["id"])
+    ]
+
+async def hydrate_ranked(hits: List[Tuple[PydanticObjectId, Optional[float]]]) -> list:
+    """Load the images for a page of (id, score) hits, preserving the order of the hits."""
+    if not hits:
+        return []
+    hit_ids = [image_id for image_id, _ in hits]
+    return await Image.aggregate([
+        {"$match": {"_id": {"$in": hit_ids}}},
+        {"$addFields": {
+            "rank": {"$indexOfArray": [hit_ids, "$_id"]},
+            "score": {"$arrayElemAt": [[score for _, score in hits], {"$indexOfArray": [hit_ids, "$_id"]}]}
+        }},
+        {"$sort": {"rank": 1}}
+    ]).to_list()
+
 # Helper functions
 def hex_to_rgb(hex_color: str) -> np.ndarray:
     hex_color = hex_color.lstrip('#')
-    return np.array([int(hex_color[i:i+2], 16) for i in (0, 2, 4)]) / 255.0
\ No newline at end of file
+    return np.array([int(hex_color[i:i+2], 16) for i in (0, 2, 4)]) / 255.0
@@ -25,13 +25,14 @@ from middleware.session import SessionMiddleware
 from background_jobs.generate_product_image.background_generate_product_image import background_generate_product_image
 from background_jobs.refine_product_image.background_refine_product_image import background_refine_product_image
 from background_jobs.train_product_lora import train_product_lora
-from background_jobs.index_uploads import index_uploaded_images
+from background_jobs.index_uploads import index_uploaded_images, find_interrupted_uploads, resume_interrupted_uploads, ingest_pipeline, IngestBacklogFullError
 import background_jobs.background_io_thread as background_io_thread
 from toolbox import Toolbox
 from azure.storage.blob import ContainerSasPermissions, BlobSasPermissions
 
 from toolbox.services.blob_storage import BlobStorageService
 from controllers.image_search import perform_image_search
+from toolbox.services.embedding_cache import get_embedding_cache
 from api.response_types.avatar import AvatarListResponse, AvatarResponse, AvatarPreviewImage
 load_dotenv()
 
@@ -71,19 +72,20 @@ async def startup_event():
 @app.get("/api/image/{image_id}", response_model=ImageResponseModel)
 async def get_image_by_id(image_id: str, request: Request):
     toolbox: Toolbox = request.state.toolbox 
-    image = (await Image.get(image_id)).model_dump(by_alias=True)
+    image = await Image.get(image_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    image = image.model_dump(by_alias=True)
 
     blob_service = toolbox.services.blob_storage
-    sas_url = await blob_service.generate_blob_sas(
-            blob_name=image["file_path"],
+    sas_url, = await blob_service.generate_blob_sas_batch(
+            [image["file_path"]],
             container_name=BlobStorageService.ContainerName.PROCESSED,
-            expiry_mins=15,  # Token expires in 15 minutes
+            expiry_mins=15,  # Tokens stay valid for at least 15 minutes
             permission=BlobSasPermissions(read=True)
         )
     image["url"] = sas_url
     
-    if not image:
-        raise HTTPException(status_code=404, detail="Image not found")
     return image
 
 @app.post("/api/{organization_id}/image/search", response_model=ImageSearchResponse)
@@ -95,6 +97,33 @@ async def search_images(
 ):
     return await perform_image_search(organization_id, request, image_search_request, request.state.toolbox)
 
+# The embedding cache is shared by every organization, so only admins see its stats
+@app.get("/api/search/embedding-cache/stats")
+async def get_embedding_cache_stats(session: dict = Depends(verify_session)):
+    if session.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin role required")
+    return get_embedding_cache().stats()
+
+@app.get("/api/organizations/{organization_id}/ingest/stats")
+async def get_ingest_stats(organization_id: str, session: dict = Depends(verify_session)):
+    user_id = session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+
+    # Verify the user belongs to the organization
+    membership = await OrganizationMembership.find_one(
+        OrganizationMembership.user_id == PydanticObjectId(user_id),
+        OrganizationMembership.organization_id == PydanticObjectId(organization_id)
+    )
+    if not membership:
+        raise HTTPException(status_code=403, detail="User does not belong to this organization")
+
+    stats = ingest_pipeline.organization_stats(PydanticObjectId(organization_id))
+    # Stage load covers every organization's uploads, so only admins see it
+    if session.get("role") == "admin":
+        stats["pipeline"] = ingest_pipeline.stats()
+    return stats
+
 # Gets scoped sas for image upload
 @app.get("/api/organizations/{organization_id}/upload-url")
 async def create_upload_url(
@@ -143,6 +172,12 @@ async def notify_uploaded_files(
     if not membership:
         raise HTTPException(status_code=403, detail="User does not belong to this organization")
 
+    # Turn the upload away up front rather than queueing more than the pipeline can hold
+    try:
+        ingest_pipeline.reserve(PydanticObjectId(organization_id), len(uploaded_files))
+    except IngestBacklogFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "60"})
+
     # Schedule the indexing task on the background I/O thread
     asyncio.create_task(
         background_io_thread.run_async_task(
@@ -158,6 +193,41 @@ async def notify_uploaded_files(
 
     return {"message": f"Successfully queued processing of {len(uploaded_files)} uploaded files"}
 
+@app.post("/api/organizations/{organization_id}/uploaded-files/resume")
+async def resume_uploaded_files(
+    organization_id: str,
+    idle_minutes: int = Body(30, embed=True),
+    session: dict = Depends(verify_session)
+):
+    user_id = session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+
+    # Verify the user belongs to the organization
+    membership = await OrganizationMembership.find_one(
+        OrganizationMembership.user_id == PydanticObjectId(user_id),
+        OrganizationMembership.organization_id == PydanticObjectId(organization_id)
+    )
+    if not membership:
+        raise HTTPException(status_code=403, detail="User does not belong to this organization")
+
+    records = await find_interrupted_uploads(PydanticObjectId(organization_id), idle_minutes)
+    if not records:
+        return {"message": "No interrupted uploads to resume"}
+
+    try:
+        ingest_pipeline.reserve(PydanticObjectId(organization_id), len(records))
+    except IngestBacklogFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "60"})
+
+    # Resumed on the background I/O thread, like new uploads, so this process's search
+    # indexes and result cache see the images
+    asyncio.create_task(background_io_thread.run_async_task(resume_interrupted_uploads, records))
+
+    print(f"Resuming {len(records)} interrupted uploads for organization {organization_id}")
+
+    return {"message": f"Resuming {len(records)} interrupted uploads"}
+
 
 @app.get("/api/user/organization")
 async def get_user_organizations(request: Request, session: dict = Depends(verify_session)):
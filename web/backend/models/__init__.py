@@ -4,9 +4,11 @@ from .generation_job import GenerationJob
 from .generated_image import GeneratedImage, ImageStatus
 from .generated_image_group import GeneratedImageGroup
 from .image import Image
+from .ingest_record import IngestRecord
 from .organization import Organization, OrganizationMembership
 from .person import Person
 from .product import Product
+from .search_generation import SearchGeneration
 from .tag import Tag
 from .user import User
 from .waitlist import WaitlistEntry
@@ -36,10 +38,12 @@ async def init_beanie_models():
             GeneratedImage,
             GeneratedImageGroup,
             Image,
+            IngestRecord,
             Organization,
             OrganizationMembership,
             Person,
             Product,
+            SearchGeneration,
             Tag,
             User,
             WaitlistEntry
@@ -1,4 +1,5 @@
 from beanie import Document, Link
+from beanie.odm.fields import IndexModel
 from pydantic import Field
 from typing import List
 
@@ -11,6 +12,8 @@ class Color(Document):
         indexes = [
             "lab_vector",
             "organization",
+            # One document per color; lets concurrent indexing workers upsert without duplicates
+            IndexModel([("organization", 1), ("lab_vector", 1)], unique=True)
         ]
 
     class Config:
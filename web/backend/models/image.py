@@ -1,12 +1,18 @@
 from datetime import datetime
 from typing import List, Optional
 from beanie import Document, Link
+from beanie.odm.fields import IndexModel
 from pydantic import BaseModel, Field
 
 class DominantColor(BaseModel):
     color: Link["Color"]
     percentage: float
 
+class PaletteEntry(BaseModel):
+    bin: int = Field(..., description="Id of the quantized Lab grid cell containing the color")
+    lab: List[float] = Field(..., description="LAB color vector [L, A, B]")
+    percentage: float
+
 class Dimensions(BaseModel):
     width: int = Field(..., description="Width of the image in pixels")
     height: int = Field(..., description="Height of the image in pixels")
@@ -22,6 +28,7 @@ class Image(Document):
     resolution: int = Field(..., description="Resolution of the image in DPI")
     format: str = Field(..., description="File format of the image")
     dominant_colors: List[DominantColor] = Field(default_factory=list, description="List of dominant colors in the image")
+    palette: List[PaletteEntry] = Field(default_factory=list, description="Dominant colors binned on a fixed Lab grid for color search")
     detected_products: List[Link["Product"]] = Field(default_factory=list, description="List of detected product IDs in the image")
     caption: Optional[str] = Field(None, description="Caption describing the image")
     caption_embedding: Optional[List[float]] = Field(None, description="Vector embedding of the image caption")
@@ -41,7 +48,12 @@ class Image(Document):
             "created_at",
             "updated_at",
             "creation_method",
-            "phash"
+            "phash",
+            # Keyset pagination scans these in _id order within an organization
+            IndexModel([("organization.$id", 1), ("_id", -1)]),
+            IndexModel([("organization.$id", 1), ("detected_products.$id", 1), ("_id", -1)]),
+            IndexModel([("organization.$id", 1), ("palette.bin", 1)]),
+            IndexModel([("organization.$id", 1), ("faces.$id", 1)])
         ]
 
     class Config:
@@ -0,0 +1,45 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from beanie import Document, PydanticObjectId
+from beanie.odm.fields import IndexModel
+from pydantic import Field
+
+class IngestRecord(Document):
+    """
+    Checkpoints of one upload's progress through the ingest stages, so a retry resumes from
+    the first incomplete stage instead of re-running every extractor. Stage outputs are kept
+    in plain form and rebuilt into extractor results by the indexer.
+    """
+    blob_path: str = Field(..., description="Path of the upload in the uploads container")
+    content_hash: str = Field(..., description="SHA-256 of the uploaded bytes")
+    organization_id: PydanticObjectId
+    user_id: PydanticObjectId
+    creation_method: str
+    attempts: int = Field(0, description="Failed attempts so far")
+    error: Optional[str] = Field(None, description="Error of the latest failed attempt")
+
+    # analyze
+    basic_details: Optional[Dict[str, Any]] = None
+    dominant_colors: Optional[List[Dict[str, Any]]] = None  # color_id, lab_vector, percentage
+    facial_details: Optional[Dict[str, Any]] = None
+    # enrich
+    product_ids: Optional[List[PydanticObjectId]] = None
+    image_caption: Optional[str] = None
+    image_tags: Optional[Dict[str, List[str]]] = None
+    # embed
+    caption_embedding: Optional[List[float]] = None
+    # store; ids and paths are fixed before any write so repeated writes land on the same documents and blobs
+    image_id: Optional[PydanticObjectId] = None
+    face_ids: List[PydanticObjectId] = Field(default_factory=list)
+    processed_blob_path: Optional[str] = None
+    image_saved: bool = False
+
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "ingest_records"
+        indexes = [
+            IndexModel([("blob_path", 1), ("content_hash", 1)], unique=True),
+            IndexModel([("organization_id", 1), ("updated_at", 1)])
+        ]
@@ -0,0 +1,13 @@
+from beanie import Document
+from pydantic import Field
+
+class SearchGeneration(Document):
+    """
+    An organization's search generation, keyed by the organization's id. Bumped whenever
+    its image library changes, invalidating cached searches. Kept apart from Organization
+    so saving an organization can never write back a stale generation.
+    """
+    generation: int = Field(0, description="Number of library changes so far")
+
+    class Settings:
+        name = "search_generations"
@@ -1,4 +1,5 @@
 from beanie import Document, Link
+from beanie.odm.fields import IndexModel
 from pydantic import Field
 
 class Tag(Document):
@@ -12,6 +13,8 @@ class Tag(Document):
             "name",
             "category",
             "organization",
+            # One document per tag; lets concurrent indexing workers upsert without duplicates
+            IndexModel([("organization", 1), ("category", 1), ("name", 1)], unique=True)
         ]
 
     class Config:
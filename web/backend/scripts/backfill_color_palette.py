@@ -0,0 +1,53 @@
+import asyncio
+from pymongo import UpdateOne
+from models import init_beanie_models, Image, Color
+from models.image import DominantColor
+from toolbox.services.image.color_palette import build_palette
+
+BATCH_SIZE = 500
+
+async def backfill_color_palette(rebuild: bool = False):
+    """
+    Populate `Image.palette` from each image's dominant colors.
+
+    Args:
+        rebuild (bool): Re-bin every image, e.g. after changing LAB_BIN_SIZE.
+    """
+    await init_beanie_models()
+
+    match = {} if rebuild else {"palette": {"$in": [None, []]}}
+    images = Image.get_motor_collection().find(match, {"dominant_colors": 1})
+
+    updated = 0
+    batch = []
+    async for image in images:
+        batch.append(image)
+        if len(batch) == BATCH_SIZE:
+            updated += await _backfill_batch(batch)
+            batch = []
+    if batch:
+        updated += await _backfill_batch(batch)
+
+    print(f"Backfilled color palettes for {updated} images")
+
+async def _backfill_batch(images: list) -> int:
+    color_ids = {dominant_color["color"].id for image in images for dominant_color in image.get("dominant_colors", [])}
+    colors = {color.id: color for color in await Color.find({"_id": {"$in": list(color_ids)}}).to_list()}
+
+    updates = []
+    for image in images:
+        dominant_colors = [
+            DominantColor(color=colors[dominant_color["color"].id], percentage=dominant_color["percentage"])
+            for dominant_color in image.get("dominant_colors", [])
+            if dominant_color["color"].id in colors
+        ]
+        palette = [entry.model_dump() for entry in build_palette(dominant_colors)]
+        updates.append(UpdateOne({"_id": image["_id"]}, {"$set": {"palette": palette}}))
+
+    if updates:
+        await Image.get_motor_collection().bulk_write(updates, ordered=False)
+    return len(updates)
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(backfill_color_palette(rebuild="--rebuild" in sys.argv))
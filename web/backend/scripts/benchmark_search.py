@@ -0,0 +1,505 @@
+"""
+Search latency benchmark against a synthetic organization.
+
+    # Create an organization with 100k images in the database named by MONGODB_URL
+    python -m scripts.benchmark_search generate --images 100000
+
+    # Run every search mode and save the results
+    python -m scripts.benchmark_search run <organization_id> --output bench/after.json --baseline bench/before.json
+
+    # Remove the organization and everything generated for it
+    python -m scripts.benchmark_search clean <organization_id>
+
+Point MONGODB_URL at a local MongoDB, never a tenant cluster. Exact text search uses Atlas
+$vectorSearch, so on a plain mongod that scenario reports errors and the approximate one is
+the meaningful number. SAS signing needs an AZURE_STORAGE_CONNECTION_STRING with an account
+key; the Azurite development string works because signing never leaves the process.
+"""
+import os
+
+# Keep benchmark queries out of the real embedding cache; must be set before toolbox is imported
+os.environ.setdefault("EMBEDDING_CACHE_PATH", "cache/benchmark_embeddings.sqlite3")
+
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from bson import DBRef, ObjectId
+from beanie import PydanticObjectId
+
+from models import init_beanie_models, Image, Color, Tag, Face, Organization, Product, SearchGeneration
+from toolbox import Toolbox
+from toolbox.services.llm import EMBEDDING_MODEL
+from toolbox.services.embedding_cache import get_embedding_cache
+from toolbox.services.search_cache import search_result_cache, search_query_cache
+from toolbox.services.blob_storage import BlobStorageService, BlobSasPermissions, sas_url_cache
+from toolbox.services.vector_index import index_root
+from toolbox.services.image.color_palette import lab_bin
+from api.request_types.search import ImageSearchRequest
+from controllers.image_search import perform_image_search
+
+BATCH_SIZE = 2000
+CAPTION_DIM = 1536
+FACE_DIM = 128
+
+TAG_CATEGORIES = ["people", "lighting", "emotions", "event", "objects", "regions", "orientation", "focus", "time", "weather"]
+TAGS_PER_CATEGORY = 40
+COLOR_POOL_SIZE = 2000
+PRODUCT_COUNT = 20
+QUERY_COUNT = 50
+
+def _zipf_choice(rng: np.random.Generator, n: int, size, exponent: float = 1.1) -> np.ndarray:
+    """Draw indexes in [0, n) with a long-tailed popularity, like real tags, topics and people."""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+class Corpus:
+    """
+    Seeded generator for a synthetic organization's documents.
+
+    Caption embeddings are drawn around a long-tailed set of topics and face embeddings around
+    a long-tailed set of people, so vector searches have real neighbourhoods. Palettes are
+    drawn from a shared pool of colors clustered in Lab space, as product photography is.
+    """
+
+    def __init__(self, image_count: int, seed: int):
+        self.image_count = image_count
+        self.rng = np.random.default_rng(seed)
+        self.topics = _normalize(self.rng.normal(size=(max(image_count // 500, 20), CAPTION_DIM)))
+        self.people = _normalize(self.rng.normal(size=(max(image_count // 50, 10), FACE_DIM)))
+
+        color_centers = np.column_stack([
+            self.rng.uniform(20, 90, 40), self.rng.uniform(-60, 60, 40), self.rng.uniform(-60, 60, 40)
+        ])
+        centers = color_centers[self.rng.integers(0, len(color_centers), COLOR_POOL_SIZE)]
+        self.color_pool = np.clip(centers + self.rng.normal(scale=8, size=centers.shape), [0, -128, -128], [100, 127, 127])
+
+    def query_embeddings(self, count: int) -> np.ndarray:
+        topics = self.topics[_zipf_choice(self.rng, len(self.topics), count)]
+        return _normalize(topics + self.rng.normal(scale=1.0 / np.sqrt(CAPTION_DIM), size=topics.shape))
+
+    def caption_embeddings(self, count: int) -> tuple[np.ndarray, np.ndarray]:
+        topic_ids = _zipf_choice(self.rng, len(self.topics), count)
+        noise = self.rng.normal(scale=1.0 / np.sqrt(CAPTION_DIM), size=(count, CAPTION_DIM))
+        return topic_ids, _normalize(self.topics[topic_ids] + noise)
+
+    def face_embeddings(self, count: int) -> np.ndarray:
+        people = self.people[_zipf_choice(self.rng, len(self.people), count)]
+        return _normalize(people + self.rng.normal(scale=0.5 / np.sqrt(FACE_DIM), size=people.shape))
+
+async def generate(image_count: int, seed: int) -> PydanticObjectId:
+    """
+    Insert a synthetic organization with `image_count` images and their colors, tags, faces
+    and products.
+
+    Args:
+        image_count (int): Number of Image documents to create.
+        seed (int): Random seed, so runs at the same scale see the same corpus.
+
+    Returns:
+        PydanticObjectId: The new organization's id.
+    """
+    await init_beanie_models()
+    corpus = Corpus(image_count, seed)
+    rng = corpus.rng
+    now = datetime.utcnow()
+
+    organization_id = ObjectId()
+    await Organization.get_motor_collection().insert_one({
+        "_id": organization_id,
+        "workos_id": f"benchmark-{organization_id}",
+        "name": f"Search benchmark ({image_count} images)",
+        "created_at": now,
+        "updated_at": now,
+        "allow_profiles_outside_organization": False,
+        "domains": []
+    })
+    organization = DBRef("organizations", organization_id)
+    user = DBRef("users", ObjectId())
+
+    color_ids = [ObjectId() for _ in range(COLOR_POOL_SIZE)]
+    await Color.get_motor_collection().insert_many([
+        {"_id": color_id, "lab_vector": lab.tolist(), "organization": organization}
+        for color_id, lab in zip(color_ids, corpus.color_pool)
+    ])
+
+    tag_ids = {category: [ObjectId() for _ in range(TAGS_PER_CATEGORY)] for category in TAG_CATEGORIES}
+    await Tag.get_motor_collection().insert_many([
+        {"_id": tag_id, "name": f"{category}-tag{i}", "category": category, "organization": organization}
+        for category, ids in tag_ids.items() for i, tag_id in enumerate(ids)
+    ])
+
+    product_ids = [ObjectId() for _ in range(PRODUCT_COUNT)]
+    await Product.get_motor_collection().insert_many([
+        {
+            "_id": product_id, "name": f"benchmark product {i}", "organization_id": organization_id,
+            "created_by_user_id": user.id, "primary_image_url": "", "stage": "completed",
+            "trigger_word": f"BENCH{i}", "created_at": now, "updated_at": now
+        }
+        for i, product_id in enumerate(product_ids)
+    ])
+
+    start = time.perf_counter()
+    for batch_start in range(0, image_count, BATCH_SIZE):
+        count = min(BATCH_SIZE, image_count - batch_start)
+        topic_ids, caption_embeddings = corpus.caption_embeddings(count)
+        face_counts = rng.poisson(0.6, count).clip(0, 4)
+        face_embeddings = corpus.face_embeddings(int(face_counts.sum()))
+
+        faces, images = [], []
+        face_offset = 0
+        for i in range(count):
+            image_faces = []
+            for embedding in face_embeddings[face_offset:face_offset + face_counts[i]]:
+                face_id = ObjectId()
+                faces.append({
+                    "_id": face_id,
+                    "file_path": f"benchmark/{organization_id}/faces/{face_id}.jpg",
+                    "phash": os.urandom(8).hex(),
+                    "organization": organization,
+                    "face_embedding": embedding.tolist(),
+                    "bounding_box": {"x": 0.0, "y": 0.0, "width": 100.0, "height": 100.0},
+                    "detection_confidence": 0.99,
+                    "created_at": now
+                })
+                image_faces.append(DBRef("faces", face_id))
+            face_offset += face_counts[i]
+
+            pool_ids = _zipf_choice(rng, COLOR_POOL_SIZE, rng.integers(3, 7), exponent=0.8)
+            percentages = rng.dirichlet(np.ones(len(pool_ids)))
+            image_tags = [
+                DBRef("tags", tag_ids[category][j])
+                for category in rng.choice(TAG_CATEGORIES, size=rng.integers(3, 8), replace=False).tolist()
+                for j in set(_zipf_choice(rng, TAGS_PER_CATEGORY, rng.integers(1, 3)).tolist())
+            ]
+            products = [product_ids[j] for j in rng.choice(PRODUCT_COUNT, size=rng.integers(1, 3), replace=False)] if rng.random() < 0.3 else []
+
+            images.append({
+                "organization": organization,
+                "created_by_user": user,
+                "creation_method": "uploaded",
+                "file_path": f"benchmark/{organization_id}/{batch_start + i}.jpg",
+                "phash": os.urandom(8).hex(),
+                "dimensions": {"width": 1920, "height": 1080, "aspect_ratio": 1.78},
+                "resolution": 72,
+                "format": "JPEG",
+                "dominant_colors": [
+                    {"color": DBRef("colors", color_ids[pool_id]), "percentage": float(percentage)}
+                    for pool_id, percentage in zip(pool_ids, percentages)
+                ],
+                "palette": [
+                    {"bin": lab_bin(corpus.color_pool[pool_id]), "lab": corpus.color_pool[pool_id].tolist(), "percentage": float(percentage)}
+                    for pool_id, percentage in zip(pool_ids, percentages)
+                ],
+                "detected_products": [DBRef("products", product_id) for product_id in products],
+                "caption": f"Synthetic image about topic {topic_ids[i]}",
+                "caption_embedding": caption_embeddings[i].tolist(),
+                "tags": image_tags,
+                "faces": image_faces,
+                "created_at": now,
+                "updated_at": now
+            })
+
+        if faces:
+            await Face.get_motor_collection().insert_many(faces, ordered=False)
+        await Image.get_motor_collection().insert_many(images, ordered=False)
+
+        done = batch_start + count
+        print(f"Inserted {done}/{image_count} images ({done / (time.perf_counter() - start):.0f}/s)")
+
+    print(f"Benchmark organization: {organization_id}")
+    return PydanticObjectId(organization_id)
+
+async def clean(organization_id: PydanticObjectId):
+    """Delete a benchmark organization, its documents and its on-disk vector indexes."""
+    await init_beanie_models()
+    organization = await Organization.get_motor_collection().find_one({"_id": organization_id})
+    if not organization or not organization["workos_id"].startswith("benchmark-"):
+        raise ValueError(f"{organization_id} is not a benchmark organization")
+
+    for model in (Image, Face, Color, Tag):
+        result = await model.get_motor_collection().delete_many({"organization.$id": organization_id})
+        print(f"Deleted {result.deleted_count} {model.Settings.name}")
+    await Product.get_motor_collection().delete_many({"organization_id": organization_id})
+    await SearchGeneration.get_motor_collection().delete_one({"_id": organization_id})
+    await Organization.get_motor_collection().delete_one({"_id": organization_id})
+    for name in ("caption", "face"):
+        shutil.rmtree(os.path.join(index_root, name, str(organization_id)), ignore_errors=True)
+
+class Scenario:
+    def __init__(self, name: str, make_request: Callable[[int], ImageSearchRequest], cached: bool = False):
+        self.name = name
+        self.make_request = make_request
+        self.cached = cached
+
+def _percentiles(latencies: List[float]) -> dict:
+    values = np.array(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "mean_ms": round(float(values.mean()), 2)
+    }
+
+async def _measure(call: Callable[[int], "asyncio.Future"], iterations: int, concurrency: int) -> dict:
+    """Run `call(i)` for every iteration with `concurrency` in flight and summarize the latencies."""
+    latencies, errors = [], []
+    queue = iter(range(iterations))
+
+    async def worker():
+        for i in queue:
+            start = time.perf_counter()
+            try:
+                await call(i)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {str(e)[:200]}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    result = {"iterations": iterations, "errors": len(errors)}
+    if errors:
+        result["first_error"] = errors[0]
+    if latencies:
+        result.update(_percentiles(latencies))
+        result["throughput_rps"] = round(len(latencies) / elapsed, 2)
+    return result
+
+async def _cursor_at_depth(organization_id: str, request: SimpleNamespace, make_request: Callable[[int], ImageSearchRequest], depth: int) -> Optional[str]:
+    """Follow next_cursor through `depth` pages and return the cursor for the page after."""
+    cursor = None
+    for _ in range(depth):
+        search_request = make_request(0)
+        search_request.cursor = cursor
+        response = await perform_image_search(organization_id, request, search_request, request.state.toolbox)
+        cursor = response.next_cursor
+        if cursor is None:
+            return None
+    return cursor
+
+async def run(organization_id: PydanticObjectId, iterations: int, concurrency: int, page_size: int, depth: int, seed: int) -> dict:
+    """
+    Run every search scenario against a benchmark organization.
+
+    Args:
+        organization_id (PydanticObjectId): Organization created by `generate`.
+        iterations (int): Measured searches per scenario.
+        concurrency (int): Searches in flight at once.
+        page_size (int): Results per page.
+        depth (int): Page number used by the deep pagination scenarios.
+        seed (int): Random seed for the generated queries.
+
+    Returns:
+        dict: Run metadata and per-scenario latency percentiles and throughput.
+    """
+    await init_beanie_models()
+    rng = np.random.default_rng(seed)
+    toolbox = Toolbox()
+    request = SimpleNamespace(state=SimpleNamespace(toolbox=toolbox))
+    org = str(organization_id)
+
+    image_count = await Image.find({"organization.$id": organization_id}).count()
+    if not image_count:
+        raise ValueError(f"Organization {organization_id} has no images; run `generate` first")
+
+    # Query embeddings are seeded into the (benchmark-only) embedding cache under synthetic
+    # query strings, so text search runs its real path without calling OpenAI
+    corpus = Corpus(image_count, seed)
+    queries = [f"benchmark query {i}" for i in range(QUERY_COUNT)]
+    for query, embedding in zip(queries, corpus.query_embeddings(QUERY_COUNT)):
+        async def create(_, embedding=embedding):
+            return embedding.tolist()
+        await get_embedding_cache().get_or_create(EMBEDDING_MODEL, query, create)
+
+    colors = [f"#{''.join(f'{channel:02x}' for channel in rng.integers(0, 256, 3))}" for _ in range(QUERY_COUNT)]
+    face_ids = [str(face["_id"]) async for face in Face.get_motor_collection().aggregate([
+        {"$match": {"organization.$id": organization_id}}, {"$sample": {"size": QUERY_COUNT}}, {"$project": {"_id": 1}}
+    ])]
+    product_ids = [str(product["_id"]) async for product in Product.get_motor_collection().find({"organization_id": organization_id}, {"_id": 1})]
+    tags_by_category: Dict[str, List[str]] = {}
+    async for tag in Tag.get_motor_collection().find({"organization.$id": organization_id}, {"category": 1}):
+        tags_by_category.setdefault(tag["category"], []).append(str(tag["_id"]))
+    categories = sorted(tags_by_category)
+
+    def pick(values: list, i: int):
+        return values[i % len(values)] if values else None
+
+    def tag_filter(i: int) -> List[str]:
+        chosen = [categories[(i + offset) % len(categories)] for offset in range(1 + i % 2)]
+        return [pick(tags_by_category[category], i) for category in chosen]
+
+    def search(**fields) -> Callable[[int], ImageSearchRequest]:
+        def make_request(i: int) -> ImageSearchRequest:
+            values = {key: value(i) if callable(value) else value for key, value in fields.items()}
+            return ImageSearchRequest(page_size=page_size, **values)
+        return make_request
+
+    text = lambda i: pick(queries, i)
+    scenarios = [
+        Scenario("list", search()),
+        Scenario("list_offset_deep", search(page=depth)),
+        Scenario("text_exact", search(text=text)),
+        Scenario("text_approximate", search(text=text, approximate=True)),
+        Scenario("text_approximate_offset_deep", search(text=text, approximate=True, page=depth)),
+        Scenario("colors", search(dominant_colors=lambda i: colors[i % len(colors):i % len(colors) + 1 + i % 3])),
+        Scenario("products", search(products=lambda i: [pick(product_ids, i)])),
+        Scenario("tags", search(tags=tag_filter)),
+        Scenario("text_tags", search(text=text, approximate=True, tags=tag_filter)),
+        Scenario("hybrid", search(text=text, approximate=True, dominant_colors=lambda i: [pick(colors, i)], hybrid=True)),
+        Scenario("list_cached", search(), cached=True),
+        Scenario("text_approximate_cached", search(text=lambda i: queries[0], approximate=True), cached=True),
+    ]
+    if face_ids:
+        scenarios.append(Scenario("faces", search(faces=lambda i: [pick(face_ids, i)])))
+
+    results = {}
+    for scenario in scenarios:
+        async def call(i: int, scenario=scenario, cursor=None):
+            if not scenario.cached:
+                search_result_cache.entries.clear()
+                search_query_cache.entries.clear()
+            search_request = scenario.make_request(i)
+            search_request.cursor = cursor
+            return await perform_image_search(org, request, search_request, toolbox)
+
+        # The first search loads the organization's vector and tag indexes; report it separately
+        start = time.perf_counter()
+        try:
+            await call(0)
+            first_call_ms = round((time.perf_counter() - start) * 1000, 2)
+        except Exception as e:
+            first_call_ms = None
+            print(f"{scenario.name}: first search failed: {type(e).__name__}: {e}")
+
+        results[scenario.name] = {"first_call_ms": first_call_ms, **await _measure(call, iterations, concurrency)}
+        print(f"{scenario.name}: {results[scenario.name]}")
+
+    # Keyset pagination: page `depth` reached by following cursors, measured at that depth
+    for name, make_request in [("list_cursor_deep", search()), ("colors_cursor_deep", search(dominant_colors=lambda i: [colors[0]]))]:
+        search_result_cache.entries.clear()
+        cursor = await _cursor_at_depth(org, request, make_request, depth - 1)
+        if cursor is None:
+            print(f"{name}: fewer than {depth} pages, skipped")
+            continue
+
+        async def call(i: int, make_request=make_request, cursor=cursor):
+            search_result_cache.entries.clear()
+            search_request = make_request(i)
+            search_request.cursor = cursor
+            return await perform_image_search(org, request, search_request, toolbox)
+
+        results[name] = await _measure(call, iterations, concurrency)
+        print(f"{name}: {results[name]}")
+
+    # SAS signing for one page of results, with and without the URL cache
+    blob_service = toolbox.services.blob_storage
+    file_paths = [f"benchmark/{organization_id}/{i}.jpg" for i in range(image_count)]
+    for name, cold in [("sas_sign_cold", True), ("sas_sign_warm", False)]:
+        async def call(i: int, cold=cold):
+            if cold:
+                sas_url_cache.entries.clear()
+            start = (i * page_size) % max(image_count - page_size, 1) if cold else 0
+            await blob_service.generate_blob_sas_batch(
+                file_paths[start:start + page_size],
+                container_name=BlobStorageService.ContainerName.PROCESSED,
+                permission=BlobSasPermissions(read=True)
+            )
+
+        results[name] = await _measure(call, iterations, concurrency)
+        print(f"{name}: {results[name]}")
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "meta": {
+            "organization_id": str(organization_id),
+            "images": image_count,
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "page_size": page_size,
+            "depth": depth,
+            "commit": commit,
+            "timestamp": datetime.utcnow().isoformat()
+        },
+        "scenarios": results
+    }
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print per-scenario latency changes against a baseline run.
+
+    Returns:
+        bool: False if any scenario's p95 regressed by more than `threshold` (a fraction).
+    """
+    ok = True
+    print(f"\n{'scenario':32} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18}")
+    for name, result in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before or "p95_ms" not in result or "p95_ms" not in before:
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = (result[key] - before[key]) / before[key] if before[key] else 0.0
+            cells.append(f"{result[key]:8.1f} ({change:+6.1%})")
+        regressed = before["p95_ms"] and (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] > threshold
+        ok = ok and not regressed
+        print(f"{name:32} {' '.join(f'{cell:>18}' for cell in cells)}{'  REGRESSED' if regressed else ''}")
+    return ok
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark image search against a synthetic organization.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Create a synthetic organization")
+    generate_parser.add_argument("--images", type=int, default=10000, help="Number of images (e.g. 10000 to 1000000)")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="Run every search mode and report latency")
+    run_parser.add_argument("organization_id")
+    run_parser.add_argument("--iterations", type=int, default=200)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--page-size", type=int, default=20)
+    run_parser.add_argument("--depth", type=int, default=50, help="Page number for the deep pagination scenarios")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="Write results as JSON to this path")
+    run_parser.add_argument("--baseline", help="Compare against a previous --output file")
+    run_parser.add_argument("--threshold", type=float, default=0.2, help="Fail if any p95 regresses by more than this fraction")
+
+    clean_parser = subparsers.add_parser("clean", help="Delete a synthetic organization")
+    clean_parser.add_argument("organization_id")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        await generate(args.images, args.seed)
+    elif args.command == "clean":
+        await clean(PydanticObjectId(args.organization_id))
+    else:
+        results = await run(PydanticObjectId(args.organization_id), args.iterations, args.concurrency, args.page_size, args.depth, args.seed)
+        if args.output:
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if not compare(results, baseline, args.threshold):
+                raise SystemExit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
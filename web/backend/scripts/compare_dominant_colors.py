@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+
+import numpy as np
+import skimage
+from PIL import Image
+from sklearn.cluster import KMeans
+
+from toolbox.services.image.process_image_for_search.decoded_image import DecodedImage
+from toolbox.services.image.process_image_for_search.extract_dominant_colors import compute_palette
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+def reference_palette(image_data: bytes, num_colors: int = 10):
+    """The original extractor: full-resolution KMeans in RGB, converted to Lab afterwards."""
+    pixels = np.float32(np.array(Image.open(BytesIO(image_data)).convert('RGB')).reshape((-1, 3)))
+    kmeans = KMeans(n_clusters=num_colors, random_state=42)
+    kmeans.fit(pixels)
+    counts = np.bincount(kmeans.labels_)
+    order = np.argsort(counts)[::-1]
+    labs = skimage.color.rgb2lab((kmeans.cluster_centers_[order] / 255.0).reshape(1, -1, 3)).reshape(-1, 3)
+    return labs, counts[order] / len(kmeans.labels_)
+
+def palette_distance(reference_labs, reference_percentages, labs, percentages) -> dict:
+    """
+    Compare two palettes in both directions. Each color is matched to its nearest color in the
+    other palette and the Lab distances are averaged, weighted by pixel share.
+    """
+    distances = np.linalg.norm(reference_labs[:, None, :] - labs[None, :, :], axis=2)
+    return {
+        "reference_to_fast": float(np.sum(distances.min(axis=1) * reference_percentages)),
+        "fast_to_reference": float(np.sum(distances.min(axis=0) * percentages)),
+        "dominant": float(np.linalg.norm(reference_labs[0] - labs[0]))
+    }
+
+def compare_dominant_colors(folder: str, limit: int, num_colors: int, max_distance: float) -> bool:
+    """
+    Check the fast palette engine against the original full-resolution extractor.
+
+    Args:
+        folder (str): Folder of sample images.
+        limit (int): Maximum number of images to compare.
+        num_colors (int): Palette size.
+        max_distance (float): Largest acceptable mean weighted Lab distance.
+
+    Returns:
+        bool: Whether the mean distance in both directions is within `max_distance`.
+    """
+    paths = sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
+
+    results = []
+    for path in paths:
+        with open(path, "rb") as f:
+            image_data = f.read()
+
+        start = time.perf_counter()
+        reference_labs, reference_percentages = reference_palette(image_data, num_colors)
+        reference_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image = DecodedImage.decode(image_data)
+        labs, percentages = compute_palette(image.working, num_colors)
+        fast_seconds = time.perf_counter() - start
+
+        result = palette_distance(reference_labs, reference_percentages, labs, percentages)
+        result.update(reference_seconds=reference_seconds, fast_seconds=fast_seconds)
+        results.append(result)
+        print(
+            f"{os.path.basename(path)}: {image.width}x{image.height}, "
+            f"distance {result['reference_to_fast']:.2f} / {result['fast_to_reference']:.2f}, "
+            f"dominant {result['dominant']:.2f}, {reference_seconds:.2f}s -> {fast_seconds:.3f}s"
+        )
+
+    if not results:
+        print(f"No images found in {folder}")
+        return False
+
+    mean = {key: float(np.mean([result[key] for result in results])) for key in results[0]}
+    print(
+        f"\n{len(results)} images: mean distance {mean['reference_to_fast']:.2f} / {mean['fast_to_reference']:.2f}, "
+        f"dominant {mean['dominant']:.2f}, mean time {mean['reference_seconds']:.2f}s -> {mean['fast_seconds']:.3f}s "
+        f"({mean['reference_seconds'] / mean['fast_seconds']:.0f}x)"
+    )
+    return mean["reference_to_fast"] <= max_distance and mean["fast_to_reference"] <= max_distance
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fast dominant color extractor with the original one.")
+    parser.add_argument("folder", help="Folder of sample images")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--num-colors", type=int, default=10)
+    parser.add_argument("--max-distance", type=float, default=5.0, help="Largest acceptable mean weighted Lab distance")
+    args = parser.parse_args()
+
+    if not compare_dominant_colors(args.folder, args.limit, args.num_colors, args.max_distance):
+        sys.exit(1)
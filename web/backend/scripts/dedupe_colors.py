@@ -0,0 +1,70 @@
+import os
+import asyncio
+from bson import DBRef
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateMany
+
+async def dedupe_colors(dry_run: bool = False):
+    """
+    Merge duplicate colors into one document per (organization, lab_vector).
+
+    Concurrent indexing workers could both upsert the same new color before the unique
+    color index existed, leaving copies of it. For each group the oldest color is kept,
+    image dominant colors and unfinished ingest records pointing at the copies are
+    relinked to it and the copies are deleted. Run this before deploying the unique color
+    index, which cannot be built while duplicates exist. Palettes store Lab values, not
+    color ids, so they need no changes.
+
+    Args:
+        dry_run (bool): Only report the duplicates.
+    """
+    # Not init_beanie_models: it would try to build the unique index this script makes possible
+    load_dotenv()
+    database = AsyncIOMotorClient(os.getenv("MONGODB_URL")).qckfx
+    colors, images, ingest_records = database.colors, database.images, database.ingest_records
+
+    groups = colors.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {"organization": "$organization", "lab_vector": "$lab_vector"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    merged = removed = 0
+    async for group in groups:
+        keep, duplicates = group["ids"][0], group["ids"][1:]
+        merged += 1
+        removed += len(duplicates)
+        if dry_run:
+            continue
+
+        duplicate_refs = [DBRef("colors", duplicate) for duplicate in duplicates]
+        await images.bulk_write([
+            UpdateMany(
+                {"dominant_colors.color": {"$in": duplicate_refs}},
+                {"$set": {"dominant_colors.$[entry].color": DBRef("colors", keep)}},
+                array_filters=[{"entry.color": {"$in": duplicate_refs}}]
+            )
+        ])
+        # Resumed uploads rebuild their dominant colors from these checkpoints
+        await ingest_records.bulk_write([
+            UpdateMany(
+                {"dominant_colors.color_id": {"$in": duplicates}},
+                {"$set": {"dominant_colors.$[entry].color_id": keep}},
+                array_filters=[{"entry.color_id": {"$in": duplicates}}]
+            )
+        ])
+        await colors.delete_many({"_id": {"$in": duplicates}})
+
+    action = "Would merge" if dry_run else "Merged"
+    print(f"{action} {removed} duplicate colors into {merged} colors")
+    if not dry_run:
+        print("Restart the API and indexers to clear their in-memory color dictionaries")
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(dedupe_colors(dry_run="--dry-run" in sys.argv))
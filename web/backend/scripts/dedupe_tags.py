@@ -0,0 +1,58 @@
+import os
+import asyncio
+from bson import DBRef
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateMany
+
+async def dedupe_tags(dry_run: bool = False):
+    """
+    Merge duplicate tags into one document per (organization, category, name).
+
+    Indexing used to create a new tag whenever its lookup missed, so most organizations
+    hold many copies of each tag. For each group the oldest tag is kept, images linking to
+    the copies are relinked to it and the copies are deleted. Run this before deploying the
+    unique tag index, which cannot be built while duplicates exist.
+
+    Args:
+        dry_run (bool): Only report the duplicates.
+    """
+    # Not init_beanie_models: it would try to build the unique index this script makes possible
+    load_dotenv()
+    database = AsyncIOMotorClient(os.getenv("MONGODB_URL")).qckfx
+    tags, images = database.tags, database.images
+
+    groups = tags.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {"organization": "$organization", "category": "$category", "name": "$name"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    merged = removed = 0
+    async for group in groups:
+        keep, duplicates = group["ids"][0], group["ids"][1:]
+        merged += 1
+        removed += len(duplicates)
+        if dry_run:
+            continue
+
+        keep_ref = DBRef("tags", keep)
+        linked = {"tags.$id": {"$in": duplicates}}
+        await images.bulk_write([
+            UpdateMany(linked, {"$addToSet": {"tags": keep_ref}}),
+            UpdateMany(linked, {"$pull": {"tags": {"$id": {"$in": duplicates}}}})
+        ], ordered=True)
+        await tags.delete_many({"_id": {"$in": duplicates}})
+
+    action = "Would merge" if dry_run else "Merged"
+    print(f"{action} {removed} duplicate tags into {merged} tags")
+    if not dry_run:
+        print("Restart the API and indexers to rebuild their in-memory tag indexes and dictionaries")
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(dedupe_tags(dry_run="--dry-run" in sys.argv))
@@ -1,13 +1,61 @@
 import os
+import asyncio
+import threading
+from collections import OrderedDict
 from enum import Enum
 from azure.storage.blob.aio import BlobServiceClient
 from dotenv import load_dotenv
 from azure.storage.blob import generate_container_sas, ContainerSasPermissions, BlobSasPermissions, generate_blob_sas
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from typing import List
 
 load_dotenv()
 
 connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+sas_cache_size = int(os.getenv("SAS_CACHE_SIZE", "100000"))
+# Server-side copies are polled at this interval until they finish or time out
+copy_poll_interval = float(os.getenv("BLOB_COPY_POLL_INTERVAL", "0.5"))
+copy_timeout = float(os.getenv("BLOB_COPY_TIMEOUT", "300"))
+
+class BlobCopyError(Exception):
+    pass
+
+class SasUrlCache:
+    """
+    Bounded LRU of signed blob URLs, shared by every BlobStorageService in the process.
+
+    Entries are keyed by the expiry window they were signed for, so a URL is reused until
+    its window rolls over and identical requests get byte-identical URLs that browsers and
+    the CDN can cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            url = self.entries.get(key)
+            if url is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return url
+
+    def put(self, key, url: str):
+        with self.lock:
+            self.entries[key] = url
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+sas_url_cache = SasUrlCache(sas_cache_size)
 
 class BlobStorageService:
     class ContainerName(Enum):
@@ -32,9 +80,9 @@ class BlobStorageService:
         blob_client = self.get_blob_client(blob_name, container_name)
         return blob_client.url
 
-    async def upload_blob(self, blob_name, data, container_name: ContainerName = None):
+    async def upload_blob(self, blob_name, data, container_name: ContainerName = None, overwrite: bool = False):
         blob_client = self.get_blob_client(blob_name, container_name)
-        await blob_client.upload_blob(data)
+        await blob_client.upload_blob(data, overwrite=overwrite)
         return blob_name
 
     async def upload_blob_from_url(self, blob_name, source_url, container_name: ContainerName = None):
@@ -42,6 +90,45 @@ class BlobStorageService:
         await blob_client.upload_blob_from_url(source_url)
         return blob_name
 
+    async def copy_blob(self, source_blob_name, destination_blob_name, source_container: ContainerName = None, destination_container: ContainerName = None):
+        """
+        Copy a blob within the storage account without moving its bytes through this host.
+
+        The copy is started from a short-lived SAS URL of the source and polled until
+        storage reports it finished. Copies within an account usually finish immediately.
+        An existing destination blob is replaced.
+
+        Args:
+            source_blob_name (str): Blob to copy.
+            destination_blob_name (str): Name of the copy.
+            source_container (ContainerName): Container holding the source.
+            destination_container (ContainerName): Container to copy into.
+
+        Returns:
+            str: The destination blob name.
+
+        Raises:
+            BlobCopyError: If the copy fails, or is aborted after `BLOB_COPY_TIMEOUT` seconds.
+        """
+        expiry_mins = max(15, int(copy_timeout // 60) + 5)
+        source_url = await self.generate_blob_sas(source_blob_name, source_container, expiry_mins=expiry_mins)
+        blob_client = self.get_blob_client(destination_blob_name, destination_container)
+
+        copy = await blob_client.start_copy_from_url(source_url)
+        copy_id, status, description = copy["copy_id"], copy["copy_status"], None
+        deadline = asyncio.get_running_loop().time() + copy_timeout
+        while status == "pending":
+            if asyncio.get_running_loop().time() > deadline:
+                await blob_client.abort_copy(copy_id)
+                raise BlobCopyError(f"Copy of {source_blob_name} to {destination_blob_name} timed out after {copy_timeout}s")
+            await asyncio.sleep(copy_poll_interval)
+            properties = await blob_client.get_blob_properties()
+            status, description = properties.copy.status, properties.copy.status_description
+
+        if status != "success":
+            raise BlobCopyError(f"Copy of {source_blob_name} to {destination_blob_name} ended {status}: {description}")
+        return destination_blob_name
+
     async def download_blob_to_stream(self, blob_name, stream, container_name: ContainerName = None):
         blob_client = self.get_blob_client(blob_name, container_name)
         await blob_client.download_blob().readinto(stream)
@@ -80,6 +167,54 @@ class BlobStorageService:
         blob_url_with_sas = f"{blob_url}?{sas_token}"
         return blob_url_with_sas
 
+    async def generate_blob_sas_batch(self, blob_names: List[str], container_name: ContainerName = None, expiry_mins: int = 15, permission: BlobSasPermissions = BlobSasPermissions(read=True)) -> List[str]:
+        """
+        Sign a list of blobs in one pass, reusing cached URLs where possible.
+
+        Expiry times are rounded to `expiry_mins` windows: every URL signed within a window
+        expires at the end of the following one, so each URL stays valid for between
+        `expiry_mins` and twice that, and repeat views within a window get the same URL.
+
+        Args:
+            blob_names (List[str]): Blobs to sign.
+            container_name (ContainerName): Container holding the blobs.
+            expiry_mins (int): Minimum remaining lifetime of the returned URLs.
+            permission (BlobSasPermissions): Permissions granted by the SAS.
+
+        Returns:
+            List[str]: Signed URLs in the same order as `blob_names`.
+        """
+        if container_name is None:
+            container_name = self.default_container
+
+        window = timedelta(minutes=expiry_mins)
+        now = datetime.now(timezone.utc)
+        window_start = datetime.fromtimestamp(now.timestamp() // window.total_seconds() * window.total_seconds(), timezone.utc)
+        expiry = window_start + 2 * window
+        permission_str = str(permission)
+
+        account_name = self.client.account_name
+        account_key = self.client.credential.account_key
+        container_url = f"{self.client.url}{container_name.value}"
+
+        urls = []
+        for blob_name in blob_names:
+            key = (container_name.value, blob_name, permission_str, expiry)
+            url = sas_url_cache.get(key)
+            if url is None:
+                sas_token = generate_blob_sas(
+                    account_name=account_name,
+                    container_name=container_name.value,
+                    blob_name=blob_name,
+                    account_key=account_key,
+                    permission=permission,
+                    expiry=expiry
+                )
+                url = f"{container_url}/{blob_name}?{sas_token}"
+                sas_url_cache.put(key, url)
+            urls.append(url)
+        return urls
+
     async def generate_container_sas(self, container_name: ContainerName = None, expiry_hours: int = 1, permission: ContainerSasPermissions = ContainerSasPermissions(read=True)):
         if container_name is None:
             container_name = self.default_container
@@ -0,0 +1,158 @@
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+memory_cache_size = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "10000"))
+disk_cache_size = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "1000000"))
+disk_cache_path = os.getenv("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3")
+
+def normalize_query(text: str) -> str:
+    """Case-fold and collapse whitespace so trivially different queries share an entry."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip().casefold()
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed by (model, normalized text).
+
+    The first tier is an in-process LRU. The second is a SQLite database in WAL mode, so every
+    API worker on a host shares it and it survives restarts. Both tiers are bounded; the disk
+    tier drops its least recently used rows once it grows past its limit.
+    """
+
+    def __init__(self, path: str, memory_size: int, disk_size: int):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, text))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.db_lock = threading.Lock()
+        self.writes_since_prune = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.seconds_saved = 0.0
+        self.avg_miss_seconds: Optional[float] = None
+
+    def _remember(self, key, vector: List[float]):
+        with self.lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+                self.memory_evictions += 1
+
+    def _disk_get(self, model: str, text: str) -> Optional[List[float]]:
+        with self.db_lock:
+            row = self.db.execute("SELECT vector FROM embeddings WHERE model = ? AND text = ?", (model, text)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE embeddings SET last_used = ? WHERE model = ? AND text = ?", (time.time(), model, text))
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def _disk_put(self, model: str, text: str, vector: List[float]):
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO embeddings (model, text, vector, last_used) VALUES (?, ?, ?, ?)",
+                (model, text, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+            )
+            self.writes_since_prune += 1
+            # Counting rows is a full scan, so only check the bound every so often
+            if self.writes_since_prune < 1000:
+                return
+            self.writes_since_prune = 0
+            excess = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.disk_size
+            if excess > 0:
+                self.db.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+                self.disk_evictions += excess
+
+    async def get_or_create(self, model: str, text: str, create) -> List[float]:
+        """
+        Return the cached embedding for `text`, calling `create(text)` on a miss.
+
+        Args:
+            model (str): Embedding model name, part of the cache key.
+            text (str): The query text.
+            create (Callable[[str], Awaitable[List[float]]]): Computes the embedding on a miss.
+
+        Returns:
+            List[float]: The embedding vector.
+        """
+        start = time.perf_counter()
+        key = (model, normalize_query(text))
+
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+        if vector is None:
+            vector = await asyncio.to_thread(self._disk_get, *key)
+            if vector is not None:
+                self.disk_hits += 1
+                self._remember(key, vector)
+
+        if vector is not None:
+            if self.avg_miss_seconds is not None:
+                self.seconds_saved += max(self.avg_miss_seconds - (time.perf_counter() - start), 0.0)
+            return vector
+
+        vector = await create(key[1])
+        elapsed = time.perf_counter() - start
+        self.misses += 1
+        self.avg_miss_seconds = elapsed if self.avg_miss_seconds is None else 0.9 * self.avg_miss_seconds + 0.1 * elapsed
+
+        self._remember(key, vector)
+        await asyncio.to_thread(self._disk_put, *key, vector)
+        return vector
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+            "memory_evictions": self.memory_evictions,
+            "disk_evictions": self.disk_evictions,
+            "seconds_saved": round(self.seconds_saved, 3),
+            "avg_miss_seconds": round(self.avg_miss_seconds, 4) if self.avg_miss_seconds is not None else None
+        }
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(disk_cache_path, memory_cache_size, disk_cache_size)
+        return _embedding_cache
@@ -0,0 +1,91 @@
+from typing import List, Tuple
+import numpy as np
+from beanie import PydanticObjectId
+
+from models.image import DominantColor, PaletteEntry
+
+# Edge length of a Lab grid cell. Changing this invalidates every stored `palette.bin`, so
+# existing images must be re-binned with scripts/backfill_color_palette.py afterwards.
+LAB_BIN_SIZE = 10.0
+L_BINS = int(np.ceil(100 / LAB_BIN_SIZE)) + 1
+A_BINS = B_BINS = int(np.ceil(256 / LAB_BIN_SIZE)) + 1
+LAB_ORIGIN = np.array([0.0, -128.0, -128.0])
+LAB_SHAPE = np.array([L_BINS, A_BINS, B_BINS])
+
+# Colors further than this from a query color (Euclidean Lab distance) do not match it
+COLOR_CUTOFF_DISTANCE = 25.0
+
+def lab_bin(lab_vector: List[float]) -> int:
+    """Return the id of the grid cell containing a Lab color."""
+    cell = np.clip(((np.asarray(lab_vector) - LAB_ORIGIN) // LAB_BIN_SIZE).astype(int), 0, LAB_SHAPE - 1)
+    return int(np.ravel_multi_index(cell, LAB_SHAPE))
+
+def bins_within(lab_vector: List[float], radius: float) -> List[int]:
+    """
+    Return every grid cell that has at least one point within `radius` of a Lab color.
+
+    Args:
+        lab_vector (List[float]): The query color.
+        radius (float): Maximum Lab distance.
+
+    Returns:
+        List[int]: Cell ids to look up.
+    """
+    lab = np.asarray(lab_vector, dtype=float)
+    low = np.clip(((lab - radius - LAB_ORIGIN) // LAB_BIN_SIZE).astype(int), 0, LAB_SHAPE - 1)
+    high = np.clip(((lab + radius - LAB_ORIGIN) // LAB_BIN_SIZE).astype(int), 0, LAB_SHAPE - 1)
+
+    cells = np.stack(np.meshgrid(*[np.arange(lo, hi + 1) for lo, hi in zip(low, high)], indexing="ij"), axis=-1).reshape(-1, 3)
+    cell_low = LAB_ORIGIN + cells * LAB_BIN_SIZE
+    cell_high = cell_low + LAB_BIN_SIZE
+    # Distance from the query to the nearest point of each cell
+    gap = np.maximum(np.maximum(cell_low - lab, lab - cell_high), 0)
+    cells = cells[np.linalg.norm(gap, axis=1) <= radius]
+
+    return np.ravel_multi_index(cells.T, LAB_SHAPE).tolist()
+
+def build_palette(dominant_colors: List[DominantColor]) -> List[PaletteEntry]:
+    """Denormalize an image's dominant colors into binned palette entries."""
+    return [
+        PaletteEntry(
+            bin=lab_bin(dominant_color.color.lab_vector),
+            lab=dominant_color.color.lab_vector,
+            percentage=dominant_color.percentage
+        )
+        for dominant_color in dominant_colors
+    ]
+
+def rank_palettes(query_labs: np.ndarray, candidates: List[dict], cutoff_distance: float = COLOR_CUTOFF_DISTANCE) -> List[Tuple[PydanticObjectId, float]]:
+    """
+    Score candidate images against one or more query colors.
+
+    Each palette entry contributes `percentage * (1 - distance / cutoff)` to a query color,
+    an image's score for that color is its best entry, and the image's score is the sum over
+    query colors, so images containing all of the requested colors rank first.
+
+    Args:
+        query_labs (np.ndarray): (Q, 3) query colors in Lab.
+        candidates (List[dict]): Documents with `_id` and `palette`.
+        cutoff_distance (float): Lab distance at which a color stops matching.
+
+    Returns:
+        List[Tuple[PydanticObjectId, float]]: Matching images ordered by (score, _id) descending.
+    """
+    entries = [(i, entry["lab"], entry["percentage"]) for i, doc in enumerate(candidates) for entry in doc.get("palette", [])]
+    if not entries:
+        return []
+
+    owners = np.array([owner for owner, _, _ in entries])
+    labs = np.array([lab for _, lab, _ in entries], dtype=float)
+    percentages = np.array([percentage for _, _, percentage in entries], dtype=float)
+
+    distances = np.linalg.norm(labs[:, None, :] - np.asarray(query_labs, dtype=float)[None, :, :], axis=2)
+    weights = np.clip(1 - distances / cutoff_distance, 0, None) * percentages[:, None]
+
+    per_color = np.zeros((len(candidates), len(query_labs)))
+    np.maximum.at(per_color, owners, weights)
+    scores = per_color.sum(axis=1)
+
+    ranked = [(doc["_id"], float(score)) for doc, score in zip(candidates, scores) if score > 0]
+    ranked.sort(key=lambda hit: (hit[1], hit[0].binary), reverse=True)
+    return ranked
@@ -8,6 +8,7 @@ import fal_client
 import httpx
 from toolbox.services.flags import FeatureFlags
 from toolbox.services.comfy import ComfyService
+from toolbox.services.phash_index import PhashIndexService
 from .process_image_for_search import process_image_for_search, ImageSearchMetadata
 
 class ImageService:
@@ -79,12 +80,14 @@ class ImageService:
         except Exception as e:
             raise Exception(f"Error in model fine-tuning: {str(e)}")
         
-    async def process_image_for_search(self, image_data: bytes, organization_id: PydanticObjectId) -> ImageSearchMetadata:
+    async def process_image_for_search(self, image_data: bytes, organization_id: PydanticObjectId, phash_index: PhashIndexService) -> ImageSearchMetadata:
         """
         Process an image for search indexing.
 
         Args:
             image_data (bytes): The image data to process.
+            organization_id (PydanticObjectId): The organization the image belongs to.
+            phash_index (PhashIndexService): The toolbox's phash index, used to reject duplicates.
 
         Returns:
             ImageSearchMetadata: An object containing the processed image information.
@@ -93,7 +96,7 @@ class ImageService:
             Exception: If there's an error during image processing.
         """
         try:
-            result = await process_image_for_search(image_data, organization_id)
+            result = await process_image_for_search(image_data, organization_id, phash_index)
             return result
         except Exception as e:
             raise Exception(f"Error in processing image for search: {str(e)}")
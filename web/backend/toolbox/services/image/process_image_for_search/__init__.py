@@ -1,3 +1,27 @@
-from .process_image_for_search import process_image_for_search, ImageSearchMetadata, ImageAlreadyExistsError
+from .process_image_for_search import (
+    process_image_for_search,
+    decode_image,
+    inspect_image,
+    extract_visual_features,
+    extract_semantic_features,
+    combine_features,
+    ImageSearchMetadata,
+    VisualFeatures,
+    SemanticFeatures,
+    ImageAlreadyExistsError
+)
+from .decoded_image import DecodedImage
 
-__all__ = ["process_image_for_search", "ImageSearchMetadata", "ImageAlreadyExistsError"]
+__all__ = [
+    "process_image_for_search",
+    "decode_image",
+    "inspect_image",
+    "extract_visual_features",
+    "extract_semantic_features",
+    "combine_features",
+    "ImageSearchMetadata",
+    "VisualFeatures",
+    "SemanticFeatures",
+    "ImageAlreadyExistsError",
+    "DecodedImage"
+]
@@ -0,0 +1,96 @@
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+from beanie import PydanticObjectId
+from bson import DBRef
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+load_dotenv()
+
+# Edge length of the Lab grid palette colors are snapped to before they are stored. Coarser
+# grids keep the colors collection smaller; at 4 no color moves by more than 3.5 Lab units.
+color_quantum = float(os.getenv("COLOR_QUANTUM", "4"))
+
+DUPLICATE_KEY_ERROR = 11000
+
+ColorCell = Tuple[int, int, int]
+
+def quantize(lab_vector: np.ndarray) -> ColorCell:
+    """The grid cell a Lab color snaps to."""
+    return tuple(int(v) for v in np.round(np.asarray(lab_vector) / color_quantum))
+
+def cell_lab(cell: ColorCell) -> List[float]:
+    """The stored Lab vector of a grid cell."""
+    return [float(v * color_quantum) for v in cell]
+
+class ColorDictionary:
+    """
+    Process-wide, per-organization map from snapped Lab colors to Color ids.
+
+    Known colors resolve in memory. Unknown ones are upserted together, one unordered bulk
+    write per image, and remembered. Because colors are snapped to a grid, an organization's
+    colors collection is bounded by the grid size instead of growing with every upload.
+    Dictionaries start empty and fill as colors are used; upserts and the unique
+    (organization, lab_vector) index make that safe.
+    """
+
+    def __init__(self):
+        self._dictionaries: Dict[str, Dict[ColorCell, PydanticObjectId]] = {}
+        self._lock = threading.Lock()
+
+    async def resolve(self, organization_id: PydanticObjectId, cells: List[ColorCell]) -> Dict[ColorCell, PydanticObjectId]:
+        """
+        Get or create the organization's Color documents for the given grid cells.
+
+        Args:
+            organization_id (PydanticObjectId): The organization owning the colors.
+            cells (List[ColorCell]): Snapped colors, from `quantize`.
+
+        Returns:
+            Dict[ColorCell, PydanticObjectId]: The Color id of every cell.
+        """
+        from models import Color, Organization
+
+        with self._lock:
+            dictionary = self._dictionaries.setdefault(str(organization_id), {})
+            missing = [cell for cell in dict.fromkeys(cells) if cell not in dictionary]
+
+        if missing:
+            collection = Color.get_motor_collection()
+            organization = DBRef(Organization.Settings.name, organization_id)
+            try:
+                result = await collection.bulk_write([
+                    UpdateOne(
+                        {"organization": organization, "lab_vector": cell_lab(cell)},
+                        {"$setOnInsert": {"lab_vector": cell_lab(cell)}},
+                        upsert=True
+                    )
+                    for cell in missing
+                ], ordered=False)
+                upserted = result.upserted_ids
+            except BulkWriteError as e:
+                # Another worker inserted some of these colors between our upserts' match and insert
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                    raise
+                upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+
+            created = {missing[position]: color_id for position, color_id in upserted.items()}
+            existing = [cell for cell in missing if cell not in created]
+            if existing:
+                # Matched rather than inserted: stored before this process first saw them, or
+                # by another worker meanwhile
+                colors = collection.find(
+                    {"organization": organization, "lab_vector": {"$in": [cell_lab(cell) for cell in existing]}},
+                    {"lab_vector": 1}
+                )
+                created.update({quantize(color["lab_vector"]): color["_id"] async for color in colors})
+            with self._lock:
+                dictionary.update(created)
+
+        return {cell: dictionary[cell] for cell in cells if cell in dictionary}
+
+color_dictionary = ColorDictionary()
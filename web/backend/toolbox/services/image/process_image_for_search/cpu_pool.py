@@ -0,0 +1,115 @@
+import os
+import atexit
+import asyncio
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "thread" runs CPU-bound extractors on a thread pool in this process; "process" runs them in
+# worker processes with their own interpreters, so TensorFlow and numpy work stop contending
+# for the GIL with the event loop
+cpu_pool_mode = os.getenv("CPU_POOL_MODE", "thread").lower()
+cpu_pool_size = int(os.getenv("CPU_POOL_SIZE", str(os.cpu_count() or 4) if cpu_pool_mode == "process" else "4"))
+
+
+class BackgroundThreadQueue:
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def submit(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args, **kwargs)
+
+# In thread mode this pool also runs the CPU-bound extractors, so it takes the configured size
+background_thread_queue = BackgroundThreadQueue(cpu_pool_size if cpu_pool_mode == "thread" else 4)
+
+
+def _warm_worker():
+    """Process pool initializer: load the face models once per worker instead of per image."""
+    try:
+        from deepface import DeepFace
+        DeepFace.build_model(model_name="Facenet")
+        DeepFace.build_model(model_name="retinaface", task="face_detector")
+        print(f"CPU worker {os.getpid()} ready")
+    except Exception as e:
+        print(f"CPU worker {os.getpid()} failed to warm face models: {str(e)}")
+
+
+def _call_with_shared_array(func: Callable, name: str, shape: Tuple[int, ...], dtype: str, args: tuple):
+    """Run `func(array, *args)` in a worker on an array attached from shared memory."""
+    shared = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+    array.flags.writeable = False
+    try:
+        return func(array, *args)
+    finally:
+        # The view must be gone before the segment can be closed
+        del array
+        shared.close()
+
+
+class CpuPool:
+    """
+    Executor for the CPU-bound extractors (face detection and embedding, color clustering).
+
+    In "process" mode, images are copied once into a shared memory segment and the worker maps
+    it, instead of pickling pixel data through the pool's pipe. Workers are spawned, not forked,
+    since TensorFlow is not fork-safe, and each loads its models when it starts.
+    """
+
+    def __init__(self, mode: str, size: int):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"CPU_POOL_MODE must be 'thread' or 'process', not '{mode}'")
+        self.mode = mode
+        self.size = size
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _process_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_worker
+                )
+                atexit.register(self._executor.shutdown, wait=False, cancel_futures=True)
+                print(f"Started {self.size} CPU worker processes")
+            return self._executor
+
+    async def submit_array(self, func: Callable, array: np.ndarray, *args):
+        """
+        Run `func(array, *args)` on the pool.
+
+        Args:
+            func (Callable): A module-level function, so it can be sent to a worker process.
+            array (np.ndarray): The image; workers receive a read-only view of it.
+            *args: Further picklable arguments.
+
+        Returns:
+            The function's result.
+        """
+        if self.mode == "thread":
+            return await background_thread_queue.submit(func, array, *args)
+
+        array = np.ascontiguousarray(array)
+        shared = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shared.buf)[...] = array
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._process_executor(),
+                _call_with_shared_array, func, shared.name, array.shape, array.dtype.str, args
+            )
+        finally:
+            shared.close()
+            shared.unlink()
+
+cpu_pool = CpuPool(cpu_pool_mode, cpu_pool_size)
@@ -0,0 +1,85 @@
+import os
+import threading
+from io import BytesIO
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Longest edge of the working copy used by extractors that do not need full resolution
+working_size = int(os.getenv("IMAGE_WORKING_SIZE", "1024"))
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
+
+class DecodedImage:
+    """
+    An upload decoded once and shared, read-only, by every feature extractor.
+
+    Holds the original encoded bytes (for LLM payloads and re-uploads), the header metadata,
+    a downscaled RGB working copy and, on demand, the full-resolution RGB array. JPEGs are
+    decoded for the working copy in draft mode, where libjpeg scales during the DCT, so a
+    50 MP photo costs a fraction of a full decode; the full-resolution array is only decoded
+    the first time an extractor asks for it. Arrays are marked read-only so extractors can
+    share them without copying.
+    """
+
+    def __init__(self, data: bytes, format: str, width: int, height: int, dpi: Tuple[float, float], exif: dict,
+                 working_image: Image.Image, rgb: Optional[np.ndarray] = None):
+        self.data = data
+        self.format = format
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.exif = exif
+        self.working_image = working_image
+        self.working = _read_only(np.asarray(working_image))
+        # Multiply working-copy coordinates by this to get full-resolution coordinates
+        self.working_scale = width / working_image.width
+        self._rgb = rgb
+        self._rgb_lock = threading.Lock()
+
+    @classmethod
+    def decode(cls, data: bytes) -> "DecodedImage":
+        """
+        Decode image bytes. CPU-bound; run it off the event loop.
+
+        Args:
+            data (bytes): The encoded image.
+
+        Returns:
+            DecodedImage: The shared representation.
+        """
+        image = Image.open(BytesIO(data))
+        format, (width, height) = image.format, image.size
+        dpi = image.info.get('dpi', (72, 72))  # Default to 72 DPI if not available
+        exif = dict(image.getexif())
+
+        rgb = None
+        if format == "JPEG":
+            image.draft("RGB", (working_size, working_size))
+            working_image = image.convert("RGB")
+        else:
+            # No reduced decode for other formats, so keep the full decode for later use
+            full_image = image.convert("RGB")
+            rgb = _read_only(np.asarray(full_image))
+            working_image = full_image.copy()
+        working_image.thumbnail((working_size, working_size))
+
+        return cls(data, format, width, height, dpi, exif, working_image, rgb)
+
+    @property
+    def rgb(self) -> np.ndarray:
+        """The full-resolution (height, width, 3) uint8 RGB array."""
+        with self._rgb_lock:
+            if self._rgb is None:
+                self._rgb = _read_only(np.asarray(Image.open(BytesIO(self.data)).convert("RGB")))
+            return self._rgb
+
+    @property
+    def file_type(self) -> str:
+        return self.format.lower()
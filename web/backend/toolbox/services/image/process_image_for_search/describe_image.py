@@ -0,0 +1,102 @@
+import os
+import asyncio
+import sys
+from typing import Tuple
+from pydantic import BaseModel, Field
+from dotenv import load_dotenv
+from toolbox.services.llm import LLMService
+
+from .caption_image import caption_image, CAPTION_INSTRUCTIONS
+from .tag_image import tag_image, ImageTags, TAG_INSTRUCTIONS
+from .vision_payload import VisionPayload
+
+load_dotenv()
+
+# "combined" asks for the caption and tags in one vision request; "separate" keeps the
+# original caption and tag requests, for comparing output quality between the two
+description_mode = os.getenv("IMAGE_DESCRIPTION_MODE", "combined").lower()
+
+class ImageDescription(BaseModel):
+    caption: str = ""
+    tags: ImageTags = Field(default_factory=ImageTags)
+
+class ImageDescriber:
+    def __init__(self):
+        self.llm_service = LLMService()
+
+    async def describe_image(self, image: VisionPayload) -> ImageDescription:
+        chat = self.llm_service.create_chat(
+            system_prompt="You are an advanced image analysis assistant specializing in search-friendly captions and detailed attribute tags for images in a digital asset management system. Your analysis should be comprehensive, capturing all relevant details that could be useful for search purposes. You power the best image search engine in the world and are proud of your thorough and detailed analysis. The images are the property of the company using our service, you do not need to consider copyright or permissions."
+        )
+
+        chat.messages.append(self.llm_service.create_user_message(
+            image.content(self.llm_service),
+            self.llm_service.create_text_content(
+                "Analyze this image and provide a caption and tags.\n\n"
+                "Caption: provide a detailed caption for this image. " + CAPTION_INSTRUCTIONS + "\n\n"
+                "Tags: provide tags for the following categories:\n" + TAG_INSTRUCTIONS + "\n"
+                "Respond with a JSON object with the caption under \"caption\" and, under \"tags\", an object with these categories as keys and arrays of relevant tags as values. Do not include any other text in your response."
+            )
+        ))
+
+        response: ImageDescription = await chat.chat_completion(max_tokens=3000, pydantic_object=ImageDescription)
+        if not response:
+            print("Error: Invalid JSON response from LLM")
+            return ImageDescription()
+
+        return response
+
+async def describe_image(image: VisionPayload) -> Tuple[str, ImageTags]:
+    """
+    Caption and tag an image.
+
+    In "combined" mode this is one structured vision request, which halves the image tokens
+    and rate-limit usage of captioning and tagging separately. If that request fails or comes
+    back without a caption, the image is captioned and tagged with the separate requests.
+
+    Args:
+        image (VisionPayload): The image, encoded for the LLM.
+
+    Returns:
+        Tuple[str, ImageTags]: The caption and the tags.
+    """
+    if description_mode == "combined":
+        try:
+            description = await ImageDescriber().describe_image(image)
+            if description.caption.strip():
+                return description.caption.strip(), description.tags
+            print("Combined image description returned no caption, falling back to separate requests")
+        except Exception as e:
+            print(f"Error in combined image description, falling back to separate requests: {str(e)}")
+
+    caption, tags = await asyncio.gather(
+        caption_image(image),
+        tag_image(image)
+    )
+    return caption, tags
+
+async def main():
+    if len(sys.argv) != 2:
+        print("Usage: python describe_image.py <path_to_image>")
+        return
+
+    image_path = sys.argv[1]
+
+    try:
+        with open(image_path, "rb") as image_file:
+            image_data = image_file.read()
+
+        # Determine image format based on file extension
+        image_format = f"image/{image_path.split('.')[-1].lower()}"
+
+        caption, tags = await describe_image(VisionPayload.from_bytes(image_data, image_format))
+        print("Image Caption:")
+        print(caption)
+        print(tags.model_dump_json(indent=2))
+    except FileNotFoundError:
+        print(f"Error: Image file not found at {image_path}")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
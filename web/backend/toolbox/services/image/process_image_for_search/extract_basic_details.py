@@ -1,8 +1,9 @@
 from typing import Tuple
-from io import BytesIO
-from PIL import Image
 from pydantic import BaseModel, Field
 import imagehash
+from PIL import Image
+
+from .decoded_image import DecodedImage
 
 class ImageDetails(BaseModel):
     aspect_ratio: float = Field(..., description="The aspect ratio of the image")
@@ -13,37 +14,35 @@ class ImageDetails(BaseModel):
     resolution: int = Field(..., description="The resolution of the image in DPI (average of width and height)")
     phash: str = Field(..., description="The perceptual hash of the image")
 
-def extract_basic_details(image_data: bytes) -> ImageDetails:
+def extract_basic_details(image: DecodedImage) -> ImageDetails:
     """
-    Extract basic details from image data.
+    Extract basic details from a decoded image.
     
     Args:
-    image_data (bytes): Image data in bytes.
+    image (DecodedImage): The decoded image.
     
     Returns:
     ImageDetails: Object containing basic image details.
     """
-    # Read the image from bytes
-    image = Image.open(BytesIO(image_data))
-    
     # Get image dimensions
-    width, height = image.size
+    width, height = image.width, image.height
     
     # Calculate aspect ratio
     aspect_ratio = width / height
     
     # Get file size
-    file_size = len(image_data)
+    file_size = len(image.data)
     
     # Get file type
     file_type = image.format
     
     # Get file resolution (DPI)
-    resolution = image.info.get('dpi', (72, 72))  # Default to 72 DPI if not available
+    resolution = image.dpi
     avg_resolution = int(sum(resolution) / len(resolution))
     
-    # Calculate perceptual hash
-    phash = str(imagehash.phash(image))
+    # Calculate perceptual hash from the full-resolution pixels. Stored hashes were computed
+    # that way, and hashing the downscaled working copy shifts some of them by a few bits.
+    phash = str(imagehash.phash(Image.fromarray(image.rgb)))
     
     return ImageDetails(
         aspect_ratio=round(aspect_ratio, 2),
@@ -75,7 +74,7 @@ if __name__ == "__main__":
         print(f"Error: Unable to read the file '{image_path}'.")
         sys.exit(1)
 
-    details = extract_basic_details(image_data)
+    details = extract_basic_details(DecodedImage.decode(image_data))
 
     for field in details.__dataclass_fields__:
         value = getattr(details, field)
@@ -1,87 +1,96 @@
 import skimage
 import numpy as np
-from sklearn.cluster import KMeans
-from typing import List, Dict
-from io import BytesIO
-from PIL import Image
+from sklearn.cluster import MiniBatchKMeans
+from typing import List, Dict, Tuple
 from pydantic import BaseModel, Field
 from models.color import Color
 from beanie import PydanticObjectId
 from models.image import DominantColor
 import asyncio
 
+from .decoded_image import DecodedImage
+from .cpu_pool import cpu_pool
+from .color_dictionary import color_dictionary, quantize, cell_lab
+
+# Pixels clustered per image, whatever its resolution, and the mini-batch size used to do it
+PALETTE_SAMPLE_SIZE = 20000
+PALETTE_BATCH_SIZE = 4096
+
 class LABColor(BaseModel):
     l: float = Field(..., ge=0, le=100)
     a: float = Field(..., ge=-128, le=127)
     b: float = Field(..., ge=-128, le=127)
 
-async def extract_dominant_colors(image_data: bytes, organization_id: PydanticObjectId, num_colors: int = 10) -> List[DominantColor]:
+def compute_palette(pixels: np.ndarray, num_colors: int = 10, sample_size: int = PALETTE_SAMPLE_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster an image's pixels into a palette in Lab space.
+
+    At most `sample_size` pixels are clustered, taken on a fixed stride so the result is
+    deterministic, which bounds the cost per image regardless of resolution. CPU-bound;
+    run it off the event loop.
+
+    Args:
+    pixels (np.ndarray): (..., 3) uint8 RGB pixels.
+    num_colors (int): Number of clusters.
+    sample_size (int): Maximum number of pixels to cluster.
+
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: (k, 3) Lab colors and their pixel fractions, most common
+        first. Empty clusters are dropped, so k may be less than `num_colors`.
+    """
+    pixels = pixels.reshape((-1, 3))
+    stride = max(len(pixels) // sample_size, 1)
+    sample = pixels[::stride][:sample_size]
+
+    # Cluster in Lab so distances match the ones search uses
+    lab_pixels = skimage.color.rgb2lab(sample.reshape(1, -1, 3) / 255.0).reshape(-1, 3)
+    kmeans = MiniBatchKMeans(
+        n_clusters=min(num_colors, len(lab_pixels)),
+        batch_size=PALETTE_BATCH_SIZE,
+        n_init=3,
+        random_state=42
+    )
+    labels = kmeans.fit_predict(lab_pixels)
+
+    # Sort colors by cluster size
+    counts = np.bincount(labels, minlength=kmeans.n_clusters)
+    sorted_indices = np.argsort(counts)[::-1]
+    sorted_indices = sorted_indices[counts[sorted_indices] > 0]
+
+    return kmeans.cluster_centers_[sorted_indices], counts[sorted_indices] / len(labels)
+
+async def extract_dominant_colors(image: DecodedImage, organization_id: PydanticObjectId, num_colors: int = 10) -> List[DominantColor]:
     """
-    Extract the dominant colors from image data, convert them to LAB color space,
-    and store them in the database if they don't exist.
+    Extract the dominant colors from a decoded image in LAB color space, snapped to the
+    `COLOR_QUANTUM` grid, and store them in the database if they don't exist.
     
     Args:
-    image_data (bytes): Image data in bytes.
+    image (DecodedImage): The decoded image; its working copy is clustered.
     organization_id (PydanticObjectId): ID of the organization.
     num_colors (int): Number of dominant colors to extract (default is 10).
     
     Returns:
     List[DominantColor]: List of dominant colors with their percentages.
     """
-    # Read the image from bytes
-    image = Image.open(BytesIO(image_data))
-    
-    # Convert image to RGB mode if it's not already
-    image = image.convert('RGB')
-    
-    # Convert image to numpy array
-    image_array = np.array(image)
-    
-    # Reshape the image to be a list of pixels
-    pixels = image_array.reshape((-1, 3))
-    
-    # Convert to float type
-    pixels = np.float32(pixels)
-    
-    # Perform k-means clustering
-    kmeans = KMeans(n_clusters=num_colors, random_state=42)
-    kmeans.fit(pixels)
-    
-    # Get the colors
-    colors = kmeans.cluster_centers_
-    
-    # Convert colors to 0-1 range
-    colors = colors / 255.0
-    
-    # Sort colors by cluster size
-    labels = kmeans.labels_
-    counts = np.bincount(labels)
-    sorted_indices = np.argsort(counts)[::-1]
-    
-    sorted_colors = colors[sorted_indices]
-    
-    # Convert RGB colors to LAB
-    lab_colors = skimage.color.rgb2lab(sorted_colors.reshape(1, -1, 3)).reshape(-1, 3)
-    
-    # Calculate the percentage of each color
-    percentages = counts[sorted_indices] / len(labels)
-
-    dominant_colors = []
+    # Clustering is CPU-bound, so keep it off the event loop
+    lab_colors, percentages = await cpu_pool.submit_array(compute_palette, image.working, num_colors)
 
+    # Snap to the color grid; clusters that land in the same cell are merged
+    shares: Dict[tuple, float] = {}
     for lab_vector, percentage in zip(lab_colors, percentages):
-        # Check if the color already exists in the database
-        existing_color = await Color.find_one({"lab_vector": lab_vector.tolist(), "organization": organization_id})
-        
-        if existing_color:
-            color = existing_color
-        else:
-            # Create a new Color document
-            color = Color(lab_vector=lab_vector.tolist(), organization=organization_id)
-            await color.insert()
+        cell = quantize(lab_vector)
+        shares[cell] = shares.get(cell, 0.0) + float(percentage)
 
-        dominant_colors.append(DominantColor(color=color, percentage=float(percentage)))
+    color_ids = await color_dictionary.resolve(organization_id, list(shares))
 
-    return dominant_colors
+    return [
+        DominantColor(
+            color=Color(id=color_ids[cell], lab_vector=cell_lab(cell), organization=organization_id),
+            percentage=percentage
+        )
+        for cell, percentage in sorted(shares.items(), key=lambda item: -item[1])
+        if cell in color_ids
+    ]
 
 # Example usage
 if __name__ == "__main__":
@@ -114,7 +123,7 @@ if __name__ == "__main__":
         # Use a dummy organization ID for this example
         organization_id = PydanticObjectId("5f7b5e7a1c9d440000d5a3b1")
 
-        dominant_colors = await extract_dominant_colors(image_data, organization_id)
+        dominant_colors = await extract_dominant_colors(DecodedImage.decode(image_data), organization_id)
 
         # Display the dominant colors
         plt.imshow([[color.color.lab_vector for color in dominant_colors]])
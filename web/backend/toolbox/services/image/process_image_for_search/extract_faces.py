@@ -1,14 +1,27 @@
+import math
+import asyncio
 import numpy as np
 from typing import List, Any
 from io import BytesIO
 from PIL import Image
 from deepface import DeepFace
+from deepface.modules import preprocessing
 import matplotlib.pyplot as plt
 import base64
 from pydantic import BaseModel, Field
 from models.face import BoundingBox
 import imagehash  
 
+from .cpu_pool import background_thread_queue, cpu_pool
+from .decoded_image import DecodedImage
+
+# Detection and alignment run on a margin this much larger than the face box, so rotating
+# a tilted face does not pull in empty corners
+ALIGNMENT_MARGIN = 0.5
+# FaceNet's (height, width) input. Fixed here so preparing crops does not load the model,
+# which in process mode only the CPU pool workers should hold.
+FACENET_INPUT_SIZE = (160, 160)
+
 class FacialDetails(BaseModel):
     face_embeddings: List[List[float]] = Field(default_factory=list)
     aligned_faces: List[str] = Field(default_factory=list)
@@ -16,89 +29,191 @@ class FacialDetails(BaseModel):
     bounding_boxes: List[BoundingBox] = Field(default_factory=list)
     phashes: List[str] = Field(default_factory=list)  
 
-def extract_facial_details(image_data: bytes) -> FacialDetails:
+async def extract_facial_details(image: DecodedImage) -> FacialDetails:
     """
-    Extract facial details from image data using DeepFace and FaceNet.
+    Extract facial details from a decoded image using RetinaFace and FaceNet.
+
+    Faces are detected once, on the downscaled working copy. Their boxes are scaled back
+    to full resolution, the aligned crops are cut from the full-resolution image, and all
+    crops are embedded in a single FaceNet batch, so `face_embeddings[i]` is always the
+    embedding of `aligned_faces[i]`. Images without faces never need a full-resolution decode.
 
     Args:
-        image_data (bytes): Image data in bytes.
+        image (DecodedImage): The decoded image.
 
     Returns:
         FacialDetails: Object containing face embeddings, aligned facial images, and confidence levels.
     """
-    # Convert image bytes to PIL Image
-    image = Image.open(BytesIO(image_data)).convert('RGB')
-
-    # Convert PIL Image to numpy array
-    img_array = np.array(image)
-
-    # Get face embeddings using FaceNet
     try:
-        represent = DeepFace.represent(
-            img_path=img_array,
-            model_name='Facenet',
-            enforce_detection=False,
-            detector_backend='retinaface'
-        )
-        # Extract only the embedding vectors
-        embeddings = [item['embedding'] for item in represent] if isinstance(represent, list) else [represent['embedding']]
+        faces = await cpu_pool.submit_array(locate_faces, image.working)
     except Exception as e:
-        print(f"Error in DeepFace.represent: {e}")
-        embeddings = []
+        print(f"Error detecting faces: {e}")
+        faces = []
+
+    if not faces:
+        return FacialDetails()
+
+    crops, batch = await background_thread_queue.submit(crop_faces, image, faces)
 
-    # Extract aligned facial images and confidence levels
     try:
-        faces = DeepFace.extract_faces(
-            img_path=img_array,
-            align=True,
-            enforce_detection=False,
-            detector_backend='retinaface'
-        )
+        embeddings = await cpu_pool.submit_array(embed_face_batch, batch)
     except Exception as e:
-        print(f"Error in DeepFace.extract_faces: {e}")
-        faces = []
+        print(f"Error embedding faces: {e}")
+        return FacialDetails()
 
     aligned_faces = []
     confidence_levels = []
     bounding_boxes = []
-    phashes = []  # Add this list
-    for face in faces:
-        face_array = face['face'][:, :, ::-1]  # Convert BGR to RGB
-        # Check the data type and scale if necessary
-        if face_array.dtype != np.uint8:
-            # If the pixel values are in [0, 1], scale to [0, 255]
-            if face_array.max() <= 1.0:
-                face_array = (face_array * 255).astype(np.uint8)
-            else:
-                face_array = face_array.astype(np.uint8)
-        aligned_face = Image.fromarray(face_array)
-        
+    phashes = []
+    for face, crop in zip(faces, crops):
+        aligned_face = Image.fromarray(crop)
+
         # Convert PIL Image to base64 encoded string
         buffered = BytesIO()
         aligned_face.save(buffered, format="PNG")
-        aligned_face_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        aligned_faces.append(aligned_face_base64)
-        confidence_levels.append(face['confidence'])  # Add this line
-        bounding_boxes.append(BoundingBox(  # Updated to use the BoundingBox class
-            x=face['facial_area']['x'],
-            y=face['facial_area']['y'],
-            width=face['facial_area']['w'],
-            height=face['facial_area']['h']
-        ))
-        
+        aligned_faces.append(base64.b64encode(buffered.getvalue()).decode('utf-8'))
+
+        confidence_levels.append(face['confidence'])
+        x, y, w, h = scale_box(face['box'], image.working_scale)
+        bounding_boxes.append(BoundingBox(x=x, y=y, width=w, height=h))
+
         # Calculate and store the pHash
-        phash = str(imagehash.phash(aligned_face))
-        phashes.append(phash)
+        phashes.append(str(imagehash.phash(aligned_face)))
 
     return FacialDetails(
         face_embeddings=embeddings,
         aligned_faces=aligned_faces,
         confidence_levels=confidence_levels,
         bounding_boxes=bounding_boxes,
-        phashes=phashes  # Add this field
+        phashes=phashes
     )
 
+def locate_faces(img_array: np.ndarray) -> List[dict]:
+    """
+    Detect faces with RetinaFace, without cropping or aligning them. Takes the bare array so
+    it can run in a CPU pool worker on an image passed through shared memory.
+
+    Args:
+        img_array (np.ndarray): (height, width, 3) uint8 RGB image.
+
+    Returns:
+        List[dict]: One entry per face with its `box` (x, y, w, h), `left_eye` and `right_eye`
+        points (or None) and `confidence`, all in the coordinates of `img_array`.
+    """
+    faces = DeepFace.extract_faces(
+        img_path=img_array,
+        align=False,
+        enforce_detection=False,
+        detector_backend='retinaface'
+    )
+
+    located = []
+    for face in faces:
+        # With enforce_detection off, an image without faces comes back as a single
+        # whole-image region with zero confidence
+        if not face['confidence']:
+            continue
+        area = face['facial_area']
+        located.append({
+            'box': (area['x'], area['y'], area['w'], area['h']),
+            'left_eye': area.get('left_eye'),
+            'right_eye': area.get('right_eye'),
+            'confidence': float(face['confidence'])
+        })
+    return located
+
+def scale_box(box: tuple, scale: float) -> tuple:
+    """Map an (x, y, w, h) box from working-copy to full-resolution pixel coordinates."""
+    x, y, w, h = box
+    return int(round(x * scale)), int(round(y * scale)), int(round(w * scale)), int(round(h * scale))
+
+def crop_faces(image: DecodedImage, faces: List[dict]):
+    """Cut the aligned crops from the full-resolution image and prepare them for FaceNet."""
+    rgb = image.rgb
+    crops = [align_face(rgb, face, image.working_scale) for face in faces]
+    return crops, prepare_face_batch(crops)
+
+def align_face(rgb: np.ndarray, face: dict, scale: float) -> np.ndarray:
+    """
+    Cut a face out of the full-resolution image, rotated so the eyes are level.
+
+    Args:
+        rgb (np.ndarray): The full-resolution (height, width, 3) uint8 RGB image.
+        face (dict): A face from `locate_faces`, in working-copy coordinates.
+        scale (float): Working-copy to full-resolution scale factor.
+
+    Returns:
+        np.ndarray: The aligned (h, w, 3) uint8 RGB crop.
+    """
+    x, y, w, h = scale_box(face['box'], scale)
+    height, width = rgb.shape[:2]
+    margin_x, margin_y = int(w * ALIGNMENT_MARGIN), int(h * ALIGNMENT_MARGIN)
+    left, top = max(x - margin_x, 0), max(y - margin_y, 0)
+    right, bottom = min(x + w + margin_x, width), min(y + h + margin_y, height)
+    region = Image.fromarray(np.ascontiguousarray(rgb[top:bottom, left:right]))
+
+    center = (x + w / 2 - left, y + h / 2 - top)
+    if face['left_eye'] and face['right_eye']:
+        # Level the line from the eye on the image's left to the one on its right
+        (x1, y1), (x2, y2) = sorted([face['left_eye'], face['right_eye']])
+        angle = math.degrees(math.atan2(y2 - y1, x2 - x1))
+        region = region.rotate(angle, resample=Image.BILINEAR, center=center)
+
+    crop = region.crop((
+        int(round(center[0] - w / 2)), int(round(center[1] - h / 2)),
+        int(round(center[0] + w / 2)), int(round(center[1] + h / 2))
+    ))
+    return np.array(crop)
+
+def prepare_face_batch(crops: List[np.ndarray]) -> np.ndarray:
+    """
+    Resize and pad face crops to FaceNet's input size, as DeepFace does for a single face.
+
+    Args:
+        crops (List[np.ndarray]): uint8 RGB face crops of any size.
+
+    Returns:
+        np.ndarray: A (len(crops), height, width, 3) float32 batch scaled to [0, 1].
+    """
+    return np.concatenate([
+        preprocessing.resize_image(img=crop, target_size=FACENET_INPUT_SIZE)
+        for crop in crops
+    ]).astype(np.float32)
+
+def embed_face_batch(batch: np.ndarray) -> List[List[float]]:
+    """
+    Embed a batch of prepared face crops with one FaceNet forward pass. Takes the bare array
+    so it can run in a CPU pool worker.
+
+    Args:
+        batch (np.ndarray): Output of `prepare_face_batch`.
+
+    Returns:
+        List[List[float]]: One embedding per crop, in batch order.
+    """
+    model = DeepFace.build_model(model_name='Facenet')
+    return np.asarray(model.model(batch, training=False)).tolist()
+
+def decode_face_crop(image_data: bytes) -> np.ndarray:
+    """Decode an uploaded face crop and prepare it as a single-face FaceNet batch."""
+    crop = np.array(Image.open(BytesIO(image_data)).convert('RGB'))
+    return prepare_face_batch([crop])
+
+async def embed_face_crop(image_data: bytes) -> List[float]:
+    """
+    Embed an already-cropped face with FaceNet, skipping detection. Like uploads, the
+    forward pass runs in the CPU pool.
+
+    Args:
+        image_data (bytes): Image data of a single face crop in bytes.
+
+    Returns:
+        List[float]: The face embedding, comparable with `FacialDetails.face_embeddings`.
+    """
+    batch = await background_thread_queue.submit(decode_face_crop, image_data)
+    return (await cpu_pool.submit_array(embed_face_batch, batch))[0]
+
+
 def display_facial_details(face_embeddings: List[List[float]],
                            aligned_faces: List[str],  # Changed to List[str]
                            confidence_levels: List[float],
@@ -181,7 +296,7 @@ def main():
         print(f"Error: Unable to read the file '{image_path}'.")
         sys.exit(1)
 
-    results = extract_facial_details(image_data)
+    results = asyncio.run(extract_facial_details(DecodedImage.decode(image_data)))
 
     # Display the results
     display_facial_details(results.face_embeddings, results.aligned_faces, results.confidence_levels, results.bounding_boxes, Image.open(image_path))  # Update this line
@@ -1,76 +1,111 @@
 from beanie import PydanticObjectId
 import numpy as np
-from typing import List
+from typing import List, Tuple
 from io import BytesIO
 from PIL import Image
 from pydantic import BaseModel, Field
 import matplotlib.pyplot as plt
 import asyncio
-import requests
-import base64
-from urllib.parse import urlparse
 import os
+from dotenv import load_dotenv
 
 from models.product import Product
 from toolbox.services.llm import LLMService
+from .decoded_image import DecodedImage
+from .cpu_pool import background_thread_queue
+from .vision_payload import VisionPayload
+from .product_references import product_reference_cache, ProductReference, window_histograms, similarity_scores
+
+load_dotenv()
+
+# Products sent to the LLM for verification per image, after ranking by local color similarity
+shortlist_size = int(os.getenv("PRODUCT_SHORTLIST_SIZE", "8"))
+# Products scoring below this color similarity (0 to 1) are never sent for verification
+min_similarity = float(os.getenv("PRODUCT_MIN_SIMILARITY", "0"))
 
 class ProductDetectionDetails(BaseModel):
     detections: List[Product] = Field(default_factory=list)
 
+class ProductVerification(BaseModel):
+    products_present: List[int] = Field(default_factory=list)
+
 class ProductExtractor:
     def __init__(self):
         # Initialize LLM Service
         self.llm_service = LLMService()
 
-    def load_image(self, image_data: bytes) -> np.ndarray:
-        image = Image.open(BytesIO(image_data)).convert('RGB')
-        return np.array(image)
-
-    async def check_product_in_image(self, product: Product, image_data: bytes, image_format: str = "jpeg") -> bool:
-        # Fetch product image
-        try:
-            product_image_response = requests.get(product.primary_image_url)
-            product_image_response.raise_for_status()
-            product_image_data = product_image_response.content
-        except requests.RequestException as e:
-            print(f"Error fetching product image for {product.name}: {e}")
-            return False
-
-        # Extract file extension from product image URL
-        product_image_ext = os.path.splitext(urlparse(product.primary_image_url).path)[1][1:]
-        if not product_image_ext:
-            product_image_ext = "png"  # Default to png if no extension found
-
-        # Create chat with LLM
+    async def shortlist_products(self, image: DecodedImage, organization_id: PydanticObjectId, products: List[Product]) -> List[Tuple[Product, ProductReference]]:
+        """
+        Rank the organization's products by how well their reference colors match some region
+        of the image, and keep the best `PRODUCT_SHORTLIST_SIZE` for LLM verification.
+
+        Returns:
+            List[Tuple[Product, ProductReference]]: Shortlisted products with their references, best first.
+        """
+        references = await product_reference_cache.get_references(organization_id, products)
+        products_by_id = {product.id: product for product in products}
+        if len(references) <= shortlist_size:
+            return [(products_by_id[reference.product_id], reference) for reference in references]
+
+        windows = await background_thread_queue.submit(window_histograms, image.working_image)
+        scores = similarity_scores(np.stack([reference.histogram for reference in references]), windows)
+        ranked = np.argsort(-scores, kind="stable")[:shortlist_size]
+        return [
+            (products_by_id[references[i].product_id], references[i])
+            for i in ranked if scores[i] >= min_similarity
+        ]
+
+    async def verify_products(self, candidates: List[Tuple[Product, ProductReference]], payload: VisionPayload) -> List[Product]:
+        """Ask the LLM, in a single request, which of the shortlisted products the image shows."""
         chat = self.llm_service.create_chat(
             system_prompt="You are an image analysis assistant."
         )
 
-        product_image_base64 = base64.b64encode(product_image_data).decode('utf-8')
-        image_data_base64 = base64.b64encode(image_data).decode('utf-8')
-        chat.messages.append(self.llm_service.create_user_message(
-            self.llm_service.create_image_content(product_image_base64, f"image/{product_image_ext}"),
-            self.llm_service.create_image_content(image_data_base64, f"image/{image_format}"),
+        content = [
+            payload.content(self.llm_service),
             self.llm_service.create_text_content(
-                "Does the first image depict a product shown in the second image? Be as accurate as possible, answer yes only if you are absolutely sure. Prefer to be conservative and answer no if you are not sure. Emphasize precision over recall. Answer with only a 'yes' or 'no'."
+                "The image above is a photo. Each image below is a reference photo of one product, labelled with its number and name. "
+                "Which of these products are shown in the photo? Be as accurate as possible, include a product only if you are absolutely sure. "
+                "Prefer to be conservative and leave a product out if you are not sure. Emphasize precision over recall. "
+                "Answer with the numbers of the products shown in the photo, or an empty list if there are none."
             )
-        ))
-        response = await chat.chat_completion()
-        response_clean = response.strip().lower()
-        print(f"LLM response for {product.name}: {response_clean}")
-        return 'yes' in response_clean
-
-    async def extract_products(self, image_data: bytes, products: List[Product], image_format: str = "jpeg") -> ProductDetectionDetails:
-        # Create a list of coroutines for each product check
-        check_coroutines = [self.check_product_in_image(product, image_data, image_format) for product in products]
-        
-        # Await all coroutines concurrently
-        results = await asyncio.gather(*check_coroutines)
-        
-        # Create a list of detected products based on the results
-        detected_products = [product for product, is_present in zip(products, results) if is_present]
-        
-        return ProductDetectionDetails(detections=detected_products)
+        ]
+        for number, (product, reference) in enumerate(candidates, 1):
+            content.append(self.llm_service.create_text_content(f"Product {number}: {product.name}"))
+            content.append(self.llm_service.create_image_content(reference.thumbnail_base64, reference.media_type, detail=payload.detail))
+        chat.messages.append(self.llm_service.create_user_message(*content))
+
+        response: ProductVerification = await chat.chat_completion(max_tokens=200, pydantic_object=ProductVerification)
+        present = set(response.products_present) if response else set()
+        detected = [product for number, (product, _) in enumerate(candidates, 1) if number in present]
+        print(f"LLM verified {len(detected)} of {len(candidates)} shortlisted products: {', '.join(product.name for product in detected)}")
+        return detected
+
+    async def extract_products(self, image: DecodedImage, payload: VisionPayload, organization_id: PydanticObjectId, products: List[Product]) -> ProductDetectionDetails:
+        """
+        Detect the organization's products in an image.
+
+        References are served from the per-organization cache, a local color comparison
+        shortlists the likeliest products, and one LLM request verifies the shortlist, so the
+        cost per image no longer grows with the size of the catalog.
+
+        Args:
+            image (DecodedImage): The decoded upload.
+            payload (VisionPayload): The upload, encoded for the LLM.
+            organization_id (PydanticObjectId): The organization whose products to look for.
+            products (List[Product]): The organization's products.
+
+        Returns:
+            ProductDetectionDetails: The detected products.
+        """
+        if not products:
+            return ProductDetectionDetails()
+
+        candidates = await self.shortlist_products(image, organization_id, products)
+        if not candidates:
+            return ProductDetectionDetails()
+
+        return ProductDetectionDetails(detections=await self.verify_products(candidates, payload))
 
 def display_product_detections(image_data: bytes, detections: ProductDetectionDetails):
     image = Image.open(BytesIO(image_data)).convert('RGB')
@@ -122,7 +157,8 @@ async def main():
             print(f"Product with ID {pid} not found.")
 
     extractor = ProductExtractor()
-    detection_details = await extractor.extract_products(image_data, products)
+    image = DecodedImage.decode(image_data)
+    detection_details = await extractor.extract_products(image, VisionPayload.from_image(image), products[0].organization_id, products) if products else ProductDetectionDetails()
 
     # Display the results
     display_product_detections(image_data, detection_details)
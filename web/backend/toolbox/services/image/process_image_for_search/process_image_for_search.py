@@ -1,6 +1,5 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from typing import List
+from typing import List, Optional
 from beanie import PydanticObjectId
 from pydantic import BaseModel
 
@@ -8,10 +7,14 @@ from .extract_basic_details import extract_basic_details, ImageDetails
 from .extract_dominant_colors import extract_dominant_colors, LABColor
 from .extract_faces import extract_facial_details, FacialDetails
 from .extract_products import ProductExtractor, ProductDetectionDetails
-from .caption_image import caption_image
-from .tag_image import tag_image, ImageTags
+from .tag_image import ImageTags
+from .describe_image import describe_image
+from .vision_payload import VisionPayload
+from .decoded_image import DecodedImage
+from .cpu_pool import background_thread_queue
 from models.product import Product
-from models.image import DominantColor, Image
+from models.image import DominantColor
+from toolbox.services.phash_index import PhashIndexService
 
 class ImageSearchMetadata(BaseModel):
     basic_details: ImageDetails
@@ -30,67 +33,90 @@ class ImageAlreadyExistsError(Exception):
     def __str__(self):
         return f'{self.message} (phash: {self.phash})'
 
+class VisualFeatures(BaseModel):
+    basic_details: ImageDetails
+    dominant_colors: List[DominantColor]
+    facial_details: FacialDetails
+
+class SemanticFeatures(BaseModel):
+    product_details: ProductDetectionDetails
+    image_caption: str
+    image_tags: ImageTags
 
-class BackgroundThreadQueue:
-    def __init__(self):
-        max_workers = 4
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-      
-    async def submit(self, func, *args, **kwargs):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self.executor, func, *args, **kwargs)
-    
-background_thread_queue = BackgroundThreadQueue()
-    
-async def process_image_for_search(image_data: bytes, organization_id: PydanticObjectId) -> ImageSearchMetadata:
-    # Extract basic details
-    basic_details = extract_basic_details(image_data)
-
-    # Check if an image with the same phash already exists for this organization
-    existing_image = await Image.find_one({
-        "organization.$id": organization_id,
-        "phash": basic_details.phash
-    })
-
-    if existing_image:
+async def decode_image(image_data: bytes) -> DecodedImage:
+    """Decode an upload once, off the event loop, for every extractor to share."""
+    return await background_thread_queue.submit(DecodedImage.decode, image_data)
+
+async def inspect_image(image: DecodedImage, organization_id: PydanticObjectId, phash_index: PhashIndexService, upload_key: Optional[str] = None) -> ImageDetails:
+    """
+    Extract basic details and reject images the organization already has.
+
+    Args:
+        image (DecodedImage): The decoded upload.
+        organization_id (PydanticObjectId): The uploading organization.
+        phash_index (PhashIndexService): The toolbox's phash index, `toolbox.services.phash_index`.
+        upload_key (Optional[str]): If given, the image's hash is reserved under this key until
+            the caller releases it, so uploads indexed at the same time also count.
+
+    Raises:
+        ImageAlreadyExistsError: If the organization has an image whose phash is within
+            `PHASH_IMAGE_DISTANCE` bits of this one.
+    """
+    basic_details = await background_thread_queue.submit(extract_basic_details, image)
+
+    # Near-duplicates (re-encoded or resized copies) count as existing images too
+    if upload_key is not None:
+        duplicate = not await phash_index.reserve_image(organization_id, upload_key, basic_details.phash)
+    else:
+        duplicate = await phash_index.find_image(organization_id, basic_details.phash) is not None
+
+    if duplicate:
         raise ImageAlreadyExistsError(basic_details.phash)
 
-    # Get image format for caption and tag functions
-    image_format = basic_details.file_type.lower()
+    return basic_details
 
-    # Extract dominant colors
-    dominant_colors_task = extract_dominant_colors(image_data=image_data, organization_id=organization_id)
+async def extract_visual_features(image: DecodedImage, organization_id: PydanticObjectId, basic_details: ImageDetails) -> VisualFeatures:
+    """Run the local, CPU-bound extractors: dominant colors and faces."""
+    dominant_colors, facial_details = await asyncio.gather(
+        extract_dominant_colors(image=image, organization_id=organization_id),
+        extract_facial_details(image)
+    )
+    return VisualFeatures(basic_details=basic_details, dominant_colors=dominant_colors, facial_details=facial_details)
 
-    # Extract facial details
-    facial_details_task = background_thread_queue.submit(extract_facial_details, image_data)
+async def extract_semantic_features(image: DecodedImage, organization_id: PydanticObjectId, basic_details: ImageDetails) -> SemanticFeatures:
+    """Run the LLM-backed extractors: product detection, caption and tags."""
+    # One bounded-size encoding of the image, shared by every LLM request about it
+    payload = await background_thread_queue.submit(VisionPayload.from_image, image)
 
-    # Extract products, caption image, and tag image concurrently
     products = await Product.find(Product.organization_id == organization_id).to_list()
     product_extractor = ProductExtractor()
-    
-    product_details_task = product_extractor.extract_products(image_data, products, image_format)
-    image_caption_task = caption_image(image_data, f"image/{image_format}")
-    image_tags_task = tag_image(image_data, f"image/{image_format}")
-    
-    product_details, image_caption, image_tags, dominant_colors, facial_details = await asyncio.gather(
-        product_details_task,
-        image_caption_task,
-        image_tags_task,
-        dominant_colors_task,
-        facial_details_task
-    )
 
-    # Compile all results
-    results = ImageSearchMetadata(
-        basic_details=basic_details,
-        dominant_colors=dominant_colors,
-        facial_details=facial_details,
-        product_details=product_details,
-        image_caption=image_caption,
-        image_tags=image_tags
+    product_details, (image_caption, image_tags) = await asyncio.gather(
+        product_extractor.extract_products(image, payload, organization_id, products),
+        describe_image(payload)
     )
+    return SemanticFeatures(product_details=product_details, image_caption=image_caption, image_tags=image_tags)
+
+def combine_features(visual: VisualFeatures, semantic: SemanticFeatures) -> ImageSearchMetadata:
+    return ImageSearchMetadata(
+        basic_details=visual.basic_details,
+        dominant_colors=visual.dominant_colors,
+        facial_details=visual.facial_details,
+        product_details=semantic.product_details,
+        image_caption=semantic.image_caption,
+        image_tags=semantic.image_tags
+    )
+
+async def process_image_for_search(image_data: bytes, organization_id: PydanticObjectId, phash_index: PhashIndexService) -> ImageSearchMetadata:
+    image = await decode_image(image_data)
+    basic_details = await inspect_image(image, organization_id, phash_index)
 
-    return results
+    # Local and LLM extractors are independent, so run them concurrently
+    visual, semantic = await asyncio.gather(
+        extract_visual_features(image, organization_id, basic_details),
+        extract_semantic_features(image, organization_id, basic_details)
+    )
+    return combine_features(visual, semantic)
 
 # Example usage
 async def main():
@@ -101,7 +127,7 @@ async def main():
     with open(image_path, "rb") as f:
         image_data = f.read()
 
-    results = await process_image_for_search(image_data, organization_id)
+    results = await process_image_for_search(image_data, organization_id, PhashIndexService())
     print(results)
 
 if __name__ == "__main__":
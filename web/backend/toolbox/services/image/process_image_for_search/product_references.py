@@ -0,0 +1,215 @@
+import os
+import base64
+import asyncio
+import threading
+from datetime import datetime
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image
+from beanie import PydanticObjectId
+from dotenv import load_dotenv
+
+from models.product import Product
+from .cpu_pool import background_thread_queue
+
+load_dotenv()
+
+# Longest edge of the reference thumbnails sent to the LLM
+reference_thumbnail_size = int(os.getenv("PRODUCT_REFERENCE_SIZE", "512"))
+# Concurrent reference downloads while filling an organization's cache
+reference_fetch_concurrency = int(os.getenv("PRODUCT_REFERENCE_FETCH_CONCURRENCY", "8"))
+
+# Colors are binned by hue, saturation and value; low-saturation pixels only by value
+HUE_BINS, SATURATION_BINS, VALUE_BINS, GRAY_BINS = 12, 3, 3, 4
+CHROMATIC_BINS = HUE_BINS * SATURATION_BINS * VALUE_BINS
+HISTOGRAM_BINS = CHROMATIC_BINS + GRAY_BINS
+MIN_SATURATION, MIN_VALUE = 64, 48
+# Descriptors are computed on small copies; colors do not need more
+DESCRIPTOR_SIZE = 256
+# Reference pixels this close (RGB distance) to the median border color count as background
+BACKGROUND_TOLERANCE = 40
+# Upload windows are unions of tiles on this grid, from single tiles to the whole image
+WINDOW_GRID = 4
+
+def color_bins(image: Image.Image) -> np.ndarray:
+    """Histogram bin of every pixel of an RGB image, as an (height, width) array."""
+    hsv = np.asarray(image.convert("HSV")).astype(np.int32)
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    chromatic = (saturation >= MIN_SATURATION) & (value >= MIN_VALUE)
+    hue_bin = hue * HUE_BINS // 256
+    saturation_bin = np.clip((saturation - MIN_SATURATION) * SATURATION_BINS // (256 - MIN_SATURATION), 0, SATURATION_BINS - 1)
+    value_bin = np.clip((value - MIN_VALUE) * VALUE_BINS // (256 - MIN_VALUE), 0, VALUE_BINS - 1)
+    gray_bin = CHROMATIC_BINS + value * GRAY_BINS // 256
+    return np.where(chromatic, (hue_bin * SATURATION_BINS + saturation_bin) * VALUE_BINS + value_bin, gray_bin)
+
+def _normalize(histograms: np.ndarray) -> np.ndarray:
+    totals = histograms.sum(axis=-1, keepdims=True)
+    return histograms / np.maximum(totals, 1)
+
+def reference_histogram(image: Image.Image) -> np.ndarray:
+    """
+    Color histogram of a product reference image, ignoring its background.
+
+    Transparent pixels are background. Otherwise the background is taken to be the median
+    color of the image border, which fits the plain backdrops of product shots.
+
+    Args:
+        image (Image.Image): The reference image in any mode.
+
+    Returns:
+        np.ndarray: A normalized (HISTOGRAM_BINS,) float32 histogram.
+    """
+    image = image.copy()
+    image.thumbnail((DESCRIPTOR_SIZE, DESCRIPTOR_SIZE))
+    rgba = np.asarray(image.convert("RGBA"))
+    rgb = rgba[..., :3].astype(np.int32)
+
+    foreground = rgba[..., 3] > 0
+    if foreground.all():
+        border = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+        background = np.median(border, axis=0)
+        foreground = np.linalg.norm(rgb - background, axis=-1) > BACKGROUND_TOLERANCE
+        if foreground.mean() < 0.05:
+            # Nothing stands out from the border color; use the whole image
+            foreground[...] = True
+
+    bins = color_bins(Image.fromarray(rgba[..., :3]))[foreground]
+    return _normalize(np.bincount(bins, minlength=HISTOGRAM_BINS).astype(np.float32))
+
+def window_histograms(image: Image.Image) -> np.ndarray:
+    """
+    Color histograms of overlapping windows of an upload, so a product covering only part
+    of the frame is compared with the region it occupies rather than the whole image.
+
+    Args:
+        image (Image.Image): The upload's RGB working copy.
+
+    Returns:
+        np.ndarray: A normalized (windows, HISTOGRAM_BINS) float32 array.
+    """
+    image = image.copy()
+    image.thumbnail((DESCRIPTOR_SIZE, DESCRIPTOR_SIZE))
+    bins = color_bins(image)
+    height, width = bins.shape
+    rows = np.arange(height) * WINDOW_GRID // height
+    columns = np.arange(width) * WINDOW_GRID // width
+    tiles = rows[:, None] * WINDOW_GRID + columns[None, :]
+    counts = np.bincount(
+        (tiles * HISTOGRAM_BINS + bins).ravel(), minlength=WINDOW_GRID * WINDOW_GRID * HISTOGRAM_BINS
+    ).reshape(WINDOW_GRID, WINDOW_GRID, HISTOGRAM_BINS)
+
+    windows = []
+    for size in range(1, WINDOW_GRID + 1):
+        for row in range(WINDOW_GRID - size + 1):
+            for column in range(WINDOW_GRID - size + 1):
+                windows.append(counts[row:row + size, column:column + size].sum(axis=(0, 1)))
+    return _normalize(np.array(windows, dtype=np.float32))
+
+def similarity_scores(references: np.ndarray, windows: np.ndarray) -> np.ndarray:
+    """
+    Score each reference against its best-matching upload window by histogram intersection.
+
+    Args:
+        references (np.ndarray): (products, HISTOGRAM_BINS) reference histograms.
+        windows (np.ndarray): Output of `window_histograms`.
+
+    Returns:
+        np.ndarray: (products,) scores between 0 and 1.
+    """
+    return np.minimum(references[:, None, :], windows[None, :, :]).sum(axis=-1).max(axis=1)
+
+class ProductReference:
+    """A product's reference image, downscaled for the LLM, and its local color descriptor."""
+
+    def __init__(self, product_id: PydanticObjectId, url: str, updated_at: datetime,
+                 thumbnail: bytes, histogram: np.ndarray):
+        self.product_id = product_id
+        self.url = url
+        self.updated_at = updated_at
+        self.thumbnail = thumbnail
+        # Encoded once, since every upload's verification request sends it again
+        self.thumbnail_base64 = base64.b64encode(thumbnail).decode('utf-8')
+        self.media_type = "image/jpeg"
+        self.histogram = histogram
+
+    def is_current(self, product: Product) -> bool:
+        return self.url == product.primary_image_url and self.updated_at == product.updated_at
+
+    @classmethod
+    def from_image_data(cls, product: Product, image_data: bytes) -> "ProductReference":
+        """Build a reference from the downloaded image. CPU-bound; run it off the event loop."""
+        image = Image.open(BytesIO(image_data))
+        histogram = reference_histogram(image)
+
+        thumbnail = image.convert("RGBA")
+        thumbnail.thumbnail((reference_thumbnail_size, reference_thumbnail_size))
+        # Flatten transparency onto white, like the product pages the references come from
+        flattened = Image.new("RGB", thumbnail.size, (255, 255, 255))
+        flattened.paste(thumbnail, mask=thumbnail.getchannel("A"))
+        buffered = BytesIO()
+        flattened.save(buffered, format="JPEG", quality=90)
+
+        return cls(product.id, product.primary_image_url, product.updated_at, buffered.getvalue(), histogram)
+
+class ProductReferenceCache:
+    """
+    Process-wide, per-organization cache of product references.
+
+    A reference is downloaded and described once and reused for every upload until its
+    product's image URL or `updated_at` changes. Downloads go through an async HTTP client,
+    a bounded number at a time. State is held on the class so every extractor shares it.
+    """
+
+    _references: Dict[str, Dict[PydanticObjectId, ProductReference]] = {}
+    _lock = threading.Lock()
+
+    async def _load(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, product: Product) -> Optional[ProductReference]:
+        async with semaphore:
+            try:
+                response = await client.get(product.primary_image_url)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                print(f"Error fetching product image for {product.name}: {e}")
+                return None
+
+        try:
+            return await background_thread_queue.submit(ProductReference.from_image_data, product, response.content)
+        except Exception as e:
+            print(f"Error reading product image for {product.name}: {e}")
+            return None
+
+    async def get_references(self, organization_id: PydanticObjectId, products: List[Product]) -> List[ProductReference]:
+        """
+        References for the given products, downloading only those missing or out of date.
+        Products whose image cannot be fetched are left out, and retried on the next call.
+
+        Args:
+            organization_id (PydanticObjectId): The products' organization.
+            products (List[Product]): The organization's current products.
+
+        Returns:
+            List[ProductReference]: References in the order of `products`.
+        """
+        key = str(organization_id)
+        cached = self._references.get(key, {})
+        stale = [product for product in products if not (product.id in cached and cached[product.id].is_current(product))]
+
+        loaded = []
+        if stale:
+            semaphore = asyncio.Semaphore(reference_fetch_concurrency)
+            async with httpx.AsyncClient(follow_redirects=True, timeout=30) as client:
+                loaded = await asyncio.gather(*(self._load(client, semaphore, product) for product in stale))
+
+        with self._lock:
+            # Rebuilt from the current products, which also drops deleted ones
+            references = self._references.get(key, {})
+            references = {product.id: references[product.id] for product in products if product.id in references}
+            references.update({reference.product_id: reference for reference in loaded if reference})
+            self._references[key] = references
+
+        return [references[product.id] for product in products if product.id in references]
+
+product_reference_cache = ProductReferenceCache()
@@ -1,4 +1,3 @@
-import base64
 import json
 from pydantic import BaseModel, Field
 from typing import List
@@ -6,6 +5,8 @@ from toolbox.services.llm import LLMService
 import asyncio
 import sys
 
+from .vision_payload import VisionPayload
+
 class ImageTags(BaseModel):
     people: List[str] = Field(default_factory=list)
     lighting: List[str] = Field(default_factory=list)
@@ -18,30 +19,33 @@ class ImageTags(BaseModel):
     time: List[str] = Field(default_factory=list)
     weather: List[str] = Field(default_factory=list)
 
+TAG_SYSTEM_PROMPT = "You are an image analysis assistant specialized in tagging images with detailed attributes which will be used for a search engine. You work as part of a digital asset management system. The images are the property of the company using our service, you do not need to consider copyrights or permissions. You power the best digital asset management search engine in the world and are thorough and detailed in your analysis."
+
+# Shared with the combined caption and tags request in describe_image.py
+TAG_INSTRUCTIONS = (
+    "1. People: couple, group, single, age (baby, youth, teen, adult, senior), gender (male, female, non-binary), ethnicity (white, black, asian, latino, native american, etc.), clothing (casual, formal, swimwear, etc.), accessories (jewelry, glasses, hat, etc.), pose (action, dance, etc.)\n"
+    "2. Lighting: ambient, daylight, night, studio, strobe, lifestyle, portrait, etc.\n"
+    "3. Emotions: happy, sad, angry, gloomy, casual, formal, etc.\n"
+    "4. Event: wedding, birthday, graduation, fundraiser, conference, anniversary, etc.\n"
+    "5. Objects: furniture, plants, food, drinks, etc.\n"
+    "6. Regions: forest, mountains, desert, ocean, building, etc.\n"
+    "7. Orientation: portrait, landscape, square\n"
+    "8. Focus: macro, close-up, wide, etc.\n"
+    "9. Time: morning, afternoon, evening, night\n"
+    "10. Weather: sunny, rainy, snowy, windy, cloudy, etc.\n"
+)
+
 class ImageTagger:
     def __init__(self):
         self.llm_service = LLMService()
 
-    async def tag_image(self, image_data: bytes, image_format: str = "image/jpeg") -> ImageTags:
-        chat = self.llm_service.create_chat(
-            system_prompt="You are an image analysis assistant specialized in tagging images with detailed attributes which will be used for a search engine. You work as part of a digital asset management system. The images are the property of the company using our service, you do not need to consider copyrights or permissions. You power the best digital asset management search engine in the world and are thorough and detailed in your analysis."
-        )
+    async def tag_image(self, image: VisionPayload) -> ImageTags:
+        chat = self.llm_service.create_chat(system_prompt=TAG_SYSTEM_PROMPT)
 
-        image_data_base64 = base64.b64encode(image_data).decode('utf-8')
         chat.messages.append(self.llm_service.create_user_message(
-            self.llm_service.create_image_content(image_data_base64, image_format),
+            image.content(self.llm_service),
             self.llm_service.create_text_content(
-                "Analyze this image and provide tags for the following categories:\n"
-                "1. People: couple, group, single, age (baby, youth, teen, adult, senior), gender (male, female, non-binary), ethnicity (white, black, asian, latino, native american, etc.), clothing (casual, formal, swimwear, etc.), accessories (jewelry, glasses, hat, etc.), pose (action, dance, etc.)\n"
-                "2. Lighting: ambient, daylight, night, studio, strobe, lifestyle, portrait, etc.\n"
-                "3. Emotions: happy, sad, angry, gloomy, casual, formal, etc.\n"
-                "4. Event: wedding, birthday, graduation, fundraiser, conference, anniversary, etc.\n"
-                "5. Objects: furniture, plants, food, drinks, etc.\n"
-                "6. Regions: forest, mountains, desert, ocean, building, etc.\n"
-                "7. Orientation: portrait, landscape, square\n"
-                "8. Focus: macro, close-up, wide, etc.\n"
-                "9. Time: morning, afternoon, evening, night\n"
-                "10. Weather: sunny, rainy, snowy, windy, cloudy, etc.\n"
+                "Analyze this image and provide tags for the following categories:\n" + TAG_INSTRUCTIONS +
                 "Provide your answer as a JSON object with these categories as keys and arrays of relevant tags as values. Do not include any other text in your response."
             )
         ))
@@ -55,9 +59,9 @@ class ImageTagger:
 
         return response
 
-async def tag_image(image_data: bytes, image_format: str = "image/jpeg") -> ImageTags:
+async def tag_image(image: VisionPayload) -> ImageTags:
     tagger = ImageTagger()
-    return await tagger.tag_image(image_data, image_format)
+    return await tagger.tag_image(image)
 
 async def main():
     if len(sys.argv) != 2:
@@ -73,7 +77,7 @@ async def main():
         # Determine image format based on file extension
         image_format = f"image/{image_path.split('.')[-1].lower()}"
         
-        tags = await tag_image(image_data, image_format)
+        tags = await tag_image(VisionPayload.from_bytes(image_data, image_format))
         print(json.dumps(tags.__dict__, indent=2))
     except FileNotFoundError:
         print(f"Error: Image file not found at {image_path}")
@@ -0,0 +1,57 @@
+import os
+import base64
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+from dotenv import load_dotenv
+
+from .decoded_image import DecodedImage
+
+load_dotenv()
+
+# Longest edge of the image sent to vision models. GPT-4o scales high-detail images to fit
+# 2048 px and then to 768 px on the short edge, so larger uploads only cost upload time.
+vision_image_size = int(os.getenv("VISION_IMAGE_SIZE", "1024"))
+vision_image_format = os.getenv("VISION_IMAGE_FORMAT", "jpeg").lower()  # jpeg or webp
+vision_image_quality = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+# OpenAI image detail level: auto, low (a fixed 85 tokens per image) or high
+vision_detail = os.getenv("VISION_IMAGE_DETAIL", "auto").lower()
+
+class VisionPayload:
+    """
+    An image encoded once for vision LLM requests and shared by every request about it.
+
+    Built from the upload's working copy, so the payload is a bounded-size re-encode instead
+    of the original file, and its base64 string is created a single time.
+    """
+
+    def __init__(self, image_base64: str, media_type: str, detail: Optional[str] = vision_detail):
+        self.image_base64 = image_base64
+        self.media_type = media_type
+        self.detail = detail
+
+    @classmethod
+    def from_image(cls, image: DecodedImage) -> "VisionPayload":
+        """
+        Re-encode a decoded upload with its long edge at most `VISION_IMAGE_SIZE`. CPU-bound;
+        run it off the event loop.
+        """
+        source = image.working_image
+        if max(source.size) < min(vision_image_size, max(image.width, image.height)):
+            # The working copy is smaller than the payload should be
+            source = Image.fromarray(image.rgb)
+        resized = source.copy()
+        resized.thumbnail((vision_image_size, vision_image_size))
+
+        buffered = BytesIO()
+        resized.save(buffered, format=vision_image_format.upper(), quality=vision_image_quality)
+        return cls(base64.b64encode(buffered.getvalue()).decode('utf-8'), f"image/{vision_image_format}")
+
+    @classmethod
+    def from_bytes(cls, image_data: bytes, media_type: str = "image/jpeg") -> "VisionPayload":
+        """Send an encoded image as it is."""
+        return cls(base64.b64encode(image_data).decode('utf-8'), media_type)
+
+    def content(self, llm_service) -> dict:
+        return llm_service.create_image_content(self.image_base64, self.media_type, detail=self.detail)
@@ -1,13 +1,104 @@
 import os
 import asyncio
+import weakref
 from asyncio import Queue, Semaphore
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from functools import wraps
 
 from anthropic import AsyncAnthropic
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, BadRequestError
 from dotenv import load_dotenv
 
+from toolbox.services.embedding_cache import get_embedding_cache
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+load_dotenv()
+
+# How long an embedding request waits for others to share its HTTP request, and the most
+# inputs one request may carry
+embedding_batch_window = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent `create_embedding` calls into one embeddings request.
+
+    The first text to arrive opens a batch; the batch is sent once `embedding_batch_window`
+    has passed or `embedding_batch_size` texts have joined, and every caller's future gets
+    the vector for its own text. One batcher serves each event loop, since the futures and
+    the HTTP client belong to it.
+    """
+
+    _batchers = weakref.WeakKeyDictionary()
+
+    def __init__(self, openai_client):
+        self.openai_client = openai_client
+        self.pending = []  # (text, future)
+        self.flush_handle = None
+        # Requests in flight, referenced so they are not garbage collected before they finish
+        self.sending = set()
+
+    @classmethod
+    def for_running_loop(cls, openai_client) -> "EmbeddingBatcher":
+        loop = asyncio.get_running_loop()
+        batcher = cls._batchers.get(loop)
+        if batcher is None:
+            batcher = cls._batchers[loop] = cls(openai_client)
+        return batcher
+
+    def embed(self, text) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= embedding_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(embedding_batch_window, self.flush)
+        return future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def _send(self, batch):
+        # Identical texts in a batch are embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            response = await self.openai_client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+            vectors = {texts[item.index]: item.embedding for item in response.data}
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(vectors[text])
+        except BadRequestError as e:
+            if len(texts) == 1:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                # One invalid input (e.g. too many tokens) rejects the whole request, so split
+                # the batch until only the callers of the invalid texts fail
+                first_half = set(texts[:len(texts) // 2])
+                await asyncio.gather(
+                    self._send([item for item in batch if item[0] in first_half]),
+                    self._send([item for item in batch if item[0] not in first_half])
+                )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Only reached with futures pending if the request was cancelled
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Embedding request was cancelled"))
+
 class ChatCompletionQueue:
     _instance = None
 
@@ -94,15 +185,21 @@ class LLMService:
         return self.chat_completion_queue.enqueue((chat_instance, model, pydantic_object, max_tokens, temperature, asyncio.get_event_loop().create_future()))
 
     async def create_embedding(self, text):
-        return (await self.openai_client.embeddings.create(input=text, model="text-embedding-3-small")).data[0].embedding
+        """Embed a text. Concurrent calls on the same event loop share one request."""
+        return await EmbeddingBatcher.for_running_loop(self.openai_client).embed(text)
 
-    def create_image_content(self, image_base64, media_type="image/jpeg", client="openai"):
+    async def create_query_embedding(self, text):
+        """Embed a search query, serving repeated queries from the shared embedding cache."""
+        return await get_embedding_cache().get_or_create(EMBEDDING_MODEL, text, self.create_embedding)
+
+    def create_image_content(self, image_base64, media_type="image/jpeg", client="openai", detail=None):
         if client == "openai":
+            image_url = {"url": f"data:{media_type};base64,{image_base64}"}
+            if detail:
+                image_url["detail"] = detail
             return {
                 "type": "image_url",
-                "image_url": {
-                    "url": f"data:{media_type};base64,{image_base64}",
-                }
+                "image_url": image_url
             }
         elif client == "anthropic":
             return {
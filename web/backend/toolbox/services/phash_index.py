@@ -0,0 +1,256 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from beanie import PydanticObjectId
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Images whose perceptual hashes differ in at most this many of 64 bits are duplicates.
+# Re-encoded and resized copies of a photo typically land within a few bits.
+image_duplicate_distance = int(os.getenv("PHASH_IMAGE_DISTANCE", "4"))
+# Same for face crops, which must also come from a duplicate image
+face_duplicate_distance = int(os.getenv("PHASH_FACE_DISTANCE", "4"))
+
+HASH_BITS = 64
+
+
+class PhashIndex:
+    """
+    Multi-index hash over 64-bit perceptual hashes, answering "every item within Hamming
+    distance d" for d up to `max_distance`.
+
+    Hashes are split into max_distance + 1 disjoint bit ranges with one exact-match table
+    each. Two hashes within max_distance bits of each other must agree exactly on at least
+    one range, so a query only checks the items sharing a range value with it instead of
+    the whole organization.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        edges = [HASH_BITS * i // chunks for i in range(chunks + 1)]
+        self.ranges = [(low, (1 << (high - low)) - 1) for low, high in zip(edges, edges[1:])]
+        self.tables: List[Dict[int, List[int]]] = [{} for _ in self.ranges]
+        self.hashes: List[int] = []
+        self.image_hashes: List[Optional[int]] = []
+        self.ids: List[PydanticObjectId] = []
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def add(self, item_id: PydanticObjectId, phash: int, image_phash: Optional[int] = None):
+        position = len(self.ids)
+        self.ids.append(item_id)
+        self.hashes.append(phash)
+        self.image_hashes.append(image_phash)
+        for table, (shift, mask) in zip(self.tables, self.ranges):
+            table.setdefault((phash >> shift) & mask, []).append(position)
+
+    def query(self, phash: int, distance: int, image_phash: Optional[int] = None) -> List[Tuple[PydanticObjectId, int]]:
+        """
+        Find the items within `distance` bits of a hash.
+
+        Args:
+            phash (int): The query hash.
+            distance (int): Maximum Hamming distance, at most `max_distance`.
+            image_phash (Optional[int]): If given, only items whose image hash is also within
+                `distance` of it match.
+
+        Returns:
+            List[Tuple[PydanticObjectId, int]]: Matching item ids and their distances, closest first.
+        """
+        if distance > self.max_distance:
+            raise ValueError(f"Index answers distances up to {self.max_distance}, not {distance}")
+
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.ranges):
+            candidates.update(table.get((phash >> shift) & mask, ()))
+
+        matches = []
+        for position in candidates:
+            bits = (self.hashes[position] ^ phash).bit_count()
+            if bits > distance:
+                continue
+            if image_phash is not None:
+                other = self.image_hashes[position]
+                if other is None or (other ^ image_phash).bit_count() > distance:
+                    continue
+            matches.append((self.ids[position], bits))
+        return sorted(matches, key=lambda match: match[1])
+
+
+def parse_phash(phash: str) -> int:
+    """Parse the hex string form of an imagehash hash."""
+    return int(phash, 16)
+
+
+class PhashIndexService:
+    """
+    Process-wide registry of per-organization phash indexes for near-duplicate detection,
+    one over images and one over faces.
+
+    Indexes are built lazily from Mongo on first use and kept current by the indexer, which
+    adds every image and face it stores. Uploads still being indexed hold their image hash
+    as a reservation, so near-duplicates uploaded together are caught before either is
+    stored. State is held on the class so every Toolbox shares the same indexes.
+    """
+
+    _indexes: Dict[Tuple[str, str], PhashIndex] = {}
+    # Builds in progress by organization, shared by every caller meanwhile, and the items
+    # stored during them, which the build's read of Mongo may have missed
+    _building: Dict[str, Future] = {}
+    _added_during_build: Dict[str, List[Tuple[str, PydanticObjectId, int, Optional[int]]]] = {}
+    # Organization -> {upload key: image hash} for uploads analyzed but not yet stored
+    _reserved: Dict[str, Dict[str, int]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _new_index() -> PhashIndex:
+        return PhashIndex(max(image_duplicate_distance, face_duplicate_distance))
+
+    async def _build(self, organization_id: PydanticObjectId) -> Tuple[PhashIndex, PhashIndex]:
+        from models import Image, Face
+
+        images, faces = self._new_index(), self._new_index()
+        # Faces only link back to their image through Image.faces
+        face_image_hashes: Dict[PydanticObjectId, int] = {}
+        async for image in Image.get_motor_collection().find({"organization.$id": organization_id}, {"phash": 1, "faces": 1}):
+            phash = parse_phash(image["phash"])
+            images.add(image["_id"], phash)
+            for face in image.get("faces", []):
+                face_image_hashes[face.id] = phash
+
+        async for face in Face.get_motor_collection().find({"organization.$id": organization_id}, {"phash": 1}):
+            faces.add(face["_id"], parse_phash(face["phash"]), face_image_hashes.get(face["_id"]))
+
+        print(f"Built phash indexes for organization {organization_id}: {images.size} images, {faces.size} faces")
+        return images, faces
+
+    async def _get_indexes(self, organization_id: PydanticObjectId) -> Tuple[PhashIndex, PhashIndex]:
+        key = str(organization_id)
+        with self._lock:
+            images, faces = self._indexes.get(("image", key)), self._indexes.get(("face", key))
+            if images is not None and faces is not None:
+                return images, faces
+            building = self._building.get(key)
+            if building is None:
+                # Thread-safe, since the API and the background I/O thread run separate loops
+                self._building[key] = building = Future()
+                self._added_during_build[key] = []
+                builder = True
+            else:
+                builder = False
+        if not builder:
+            return await asyncio.wrap_future(building)
+
+        try:
+            images, faces = await self._build(organization_id)
+            with self._lock:
+                indexes = {"image": images, "face": faces}
+                added = self._added_during_build[key]
+                known = {name: set(indexes[name].ids) for name in {item[0] for item in added}}
+                for name, item_id, phash, image_phash in added:
+                    if item_id not in known[name]:
+                        indexes[name].add(item_id, phash, image_phash)
+                self._indexes[("image", key)] = images
+                self._indexes[("face", key)] = faces
+        except BaseException as e:
+            building.set_exception(e)
+            raise
+        else:
+            building.set_result((images, faces))
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+                self._added_during_build.pop(key, None)
+        return images, faces
+
+    async def find_image(self, organization_id: PydanticObjectId, phash: str) -> Optional[PydanticObjectId]:
+        """Return the closest of the organization's images that `phash` duplicates, if any."""
+        images, _ = await self._get_indexes(organization_id)
+        matches = images.query(parse_phash(phash), image_duplicate_distance)
+        return matches[0][0] if matches else None
+
+    async def reserve_image(self, organization_id: PydanticObjectId, upload_key: str, phash: str, check: bool = True) -> bool:
+        """
+        Hold an upload's image hash until it is stored or given up on, so uploads in flight
+        at the same time are checked against each other as well as the stored images.
+
+        Args:
+            organization_id (PydanticObjectId): The uploading organization.
+            upload_key (str): Identifies the upload, e.g. its blob path.
+            phash (str): The upload's phash.
+            check (bool): Whether to check for duplicates first; False re-holds the hash of
+                an upload that was already checked.
+
+        Returns:
+            bool: False, holding nothing, if the hash duplicates a stored or reserved image.
+        """
+        images, _ = await self._get_indexes(organization_id)
+        image_hash = parse_phash(phash)
+        key = str(organization_id)
+        with self._lock:
+            reserved = self._reserved.setdefault(key, {})
+            if check and upload_key not in reserved:
+                if images.query(image_hash, image_duplicate_distance):
+                    return False
+                if any((held ^ image_hash).bit_count() <= image_duplicate_distance for held in reserved.values()):
+                    return False
+            reserved[upload_key] = image_hash
+        return True
+
+    def release_image(self, organization_id: PydanticObjectId, upload_key: str):
+        """Drop an upload's reservation, once it is stored or given up on. Safe to repeat."""
+        key = str(organization_id)
+        with self._lock:
+            reserved = self._reserved.get(key)
+            if reserved is not None:
+                reserved.pop(upload_key, None)
+                if not reserved:
+                    del self._reserved[key]
+
+    async def find_faces(self, organization_id: PydanticObjectId, faces: List[Tuple[PydanticObjectId, str]], image_phash: str) -> Dict[PydanticObjectId, PydanticObjectId]:
+        """
+        Check all faces of one image for duplicates at once.
+
+        Args:
+            organization_id (PydanticObjectId): The image's organization.
+            faces (List[Tuple[PydanticObjectId, str]]): Ids and phashes of the image's new faces.
+            image_phash (str): The image's phash.
+
+        Returns:
+            Dict[PydanticObjectId, PydanticObjectId]: For each duplicate face, the stored
+                face it duplicates. Faces of the same image are never duplicates of each
+                other: two people's aligned crops can hash alike, and the image hash cannot
+                tell them apart.
+        """
+        _, index = await self._get_indexes(organization_id)
+        image_hash = parse_phash(image_phash)
+        duplicates = {}
+        for face_id, phash in faces:
+            matches = index.query(parse_phash(phash), face_duplicate_distance, image_hash)
+            if matches:
+                duplicates[face_id] = matches[0][0]
+        return duplicates
+
+    def _add(self, name: str, organization_id: PydanticObjectId, item_id: PydanticObjectId, phash: str, image_phash: Optional[str] = None):
+        # Unloaded indexes pick the item up from Mongo when they are built
+        key = str(organization_id)
+        item = (name, item_id, parse_phash(phash), parse_phash(image_phash) if image_phash else None)
+        with self._lock:
+            index = self._indexes.get((name, key))
+            if index is not None:
+                index.add(*item[1:])
+            elif key in self._added_during_build:
+                self._added_during_build[key].append(item)
+
+    def add_image(self, organization_id: PydanticObjectId, image_id: PydanticObjectId, phash: str):
+        self._add("image", organization_id, image_id, phash)
+
+    def add_face(self, organization_id: PydanticObjectId, face_id: PydanticObjectId, phash: str, image_phash: str):
+        self._add("face", organization_id, face_id, phash, image_phash)
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from beanie import PydanticObjectId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+
+from models import SearchGeneration
+from toolbox.services.embedding_cache import normalize_query
+
+load_dotenv()
+
+search_cache_size = int(os.getenv("SEARCH_CACHE_SIZE", "10000"))
+search_query_cache_size = int(os.getenv("SEARCH_QUERY_CACHE_SIZE", "1000"))
+# How long a search generation read from Mongo is trusted. Bumps made in this process are
+# seen at once; ones made by indexers in other processes within this many seconds.
+search_generation_ttl = float(os.getenv("SEARCH_GENERATION_TTL", "1"))
+
+# Request fields that only select a page of a search
+PAGING_FIELDS = {"page", "page_size", "cursor"}
+
+class SearchResultCache:
+    """
+    Bounded LRU of search result pages, shared by every request in the process.
+
+    Only image ids, scores and paging metadata are stored; documents are hydrated on the
+    way out so cached pages stay small. Keys include the organization's search generation,
+    so indexing a new image makes every older entry for that organization unreachable and
+    it ages out of the LRU.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+search_result_cache = SearchResultCache(search_cache_size)
+# Work shared by every page of a search, such as its facet counts, computed on the first page
+search_query_cache = SearchResultCache(search_query_cache_size)
+
+def search_cache_key(organization_id: str, generation: int, image_search_request, paged: bool = True) -> str:
+    """
+    Key a search by organization, generation and the request with order-insensitive fields
+    normalized. With `paged` False the paging fields are left out, so every page of the
+    search gets the same key.
+    """
+    request = image_search_request.model_dump(exclude_none=True, exclude=None if paged else PAGING_FIELDS)
+    if "text" in request:
+        request["text"] = normalize_query(request["text"])
+    if "dominant_colors" in request:
+        request["dominant_colors"] = sorted(color.lstrip("#").lower() for color in request["dominant_colors"])
+    for field in ("faces", "products", "tags"):
+        if field in request:
+            request[field] = sorted(set(request[field]))
+    if "face_image" in request:
+        request["face_image"] = hashlib.sha256(request["face_image"].encode()).hexdigest()
+
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+    return f"{organization_id}:{generation}:{digest}"
+
+# Organization id -> (generation, monotonic time it was read)
+_generations = {}
+_generations_lock = threading.Lock()
+
+def _remember_generation(organization_id: PydanticObjectId, generation: int) -> int:
+    # Generations only grow, so a slower read never replaces a newer value
+    with _generations_lock:
+        cached = _generations.get(organization_id)
+        if cached is not None and cached[0] > generation:
+            generation = cached[0]
+        _generations[organization_id] = (generation, time.monotonic())
+    return generation
+
+async def get_search_generation(organization_id: PydanticObjectId) -> int:
+    cached = _generations.get(organization_id)
+    if cached is not None and time.monotonic() - cached[1] < search_generation_ttl:
+        return cached[0]
+    document = await SearchGeneration.get_motor_collection().find_one({"_id": organization_id}, {"generation": 1})
+    return _remember_generation(organization_id, document["generation"] if document else 0)
+
+async def bump_search_generation(organization_id: PydanticObjectId):
+    """Invalidate cached searches for an organization after its library changes."""
+    document = await SearchGeneration.get_motor_collection().find_one_and_update(
+        {"_id": organization_id},
+        {"$inc": {"generation": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    _remember_generation(organization_id, document["generation"])
@@ -5,6 +5,10 @@ import toolbox.services.image as image
 import toolbox.services.logger as logger
 import toolbox.services.llm as llm
 import toolbox.services.flags as flags
+import toolbox.services.vector_index as vector_index
+import toolbox.services.tag_index as tag_index
+import toolbox.services.tag_dictionary as tag_dictionary
+import toolbox.services.phash_index as phash_index
 
 class Services:
     _blob_storage: blob_storage.BlobStorageService | None = None
@@ -12,6 +16,10 @@ class Services:
     _llm: llm.LLMService | None = None
     _image_service: image.ImageService | None = None
     _flags: flags.FeatureFlags | None = None
+    _vector_index: vector_index.VectorIndexService | None = None
+    _tag_index: tag_index.TagIndexService | None = None
+    _tag_dictionary: tag_dictionary.TagDictionaryService | None = None
+    _phash_index: phash_index.PhashIndexService | None = None
 
     def __init__(self):
         load_dotenv()  # Load environment variables from .env file
@@ -42,6 +50,30 @@ class Services:
             self._image_service = image.ImageService(flags=self.flags)
         return self._image_service
 
+    @property
+    def vector_index(self) -> vector_index.VectorIndexService:
+        if self._vector_index is None:
+            self._vector_index = vector_index.VectorIndexService()
+        return self._vector_index
+
+    @property
+    def tag_index(self) -> tag_index.TagIndexService:
+        if self._tag_index is None:
+            self._tag_index = tag_index.TagIndexService()
+        return self._tag_index
+
+    @property
+    def tag_dictionary(self) -> tag_dictionary.TagDictionaryService:
+        if self._tag_dictionary is None:
+            self._tag_dictionary = tag_dictionary.TagDictionaryService()
+        return self._tag_dictionary
+
+    @property
+    def phash_index(self) -> phash_index.PhashIndexService:
+        if self._phash_index is None:
+            self._phash_index = phash_index.PhashIndexService()
+        return self._phash_index
+
     @property
     def flags(self) -> flags.FeatureFlags:
         if self._flags is None:
@@ -0,0 +1,105 @@
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from beanie import PydanticObjectId
+from bson import DBRef
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+TagKey = Tuple[str, str]  # (category, name)
+
+
+class TagDictionaryService:
+    """
+    Process-wide, per-organization map from (category, name) to tag id, shared by the
+    indexing workers.
+
+    A dictionary is loaded from Mongo with one query the first time an organization's tags
+    are resolved. Afterwards known tags resolve without touching the database and new ones
+    are created with a single unordered bulk upsert. The unique (organization, category,
+    name) index on tags makes concurrent workers converge on one document per tag.
+    """
+
+    _dictionaries: Dict[str, Dict[TagKey, PydanticObjectId]] = {}
+    _lock = threading.Lock()
+
+    async def _load(self, organization_id: PydanticObjectId) -> Dict[TagKey, PydanticObjectId]:
+        from models import Tag
+
+        tags = Tag.get_motor_collection().find({"organization.$id": organization_id}, {"name": 1, "category": 1})
+        dictionary = {(tag["category"], tag["name"]): tag["_id"] async for tag in tags}
+        print(f"Loaded tag dictionary for organization {organization_id}: {len(dictionary)} tags")
+        return dictionary
+
+    async def _get_dictionary(self, organization_id: PydanticObjectId) -> Dict[TagKey, PydanticObjectId]:
+        key = str(organization_id)
+        dictionary = self._dictionaries.get(key)
+        if dictionary is not None:
+            return dictionary
+
+        dictionary = await self._load(organization_id)
+        with self._lock:
+            return self._dictionaries.setdefault(key, dictionary)
+
+    async def _create(self, organization_id: PydanticObjectId, keys: List[TagKey]) -> Dict[TagKey, PydanticObjectId]:
+        """Upsert tags in one round trip and return their ids, whoever created them."""
+        from models import Tag, Organization
+
+        collection = Tag.get_motor_collection()
+        organization = DBRef(Organization.Settings.name, organization_id)
+        upserts = [
+            UpdateOne(
+                {"organization": organization, "category": category, "name": name},
+                {"$setOnInsert": {"category": category, "name": name}},
+                upsert=True
+            )
+            for category, name in keys
+        ]
+        try:
+            result = await collection.bulk_write(upserts, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            # Another worker inserted some of these tags between our upserts' match and insert
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+            upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+
+        ids = {keys[position]: tag_id for position, tag_id in upserted.items()}
+        existing = [key for key in keys if key not in ids]
+        if existing:
+            # Matched rather than inserted: created since the dictionary was loaded
+            tags = collection.find(
+                {"organization": organization, "$or": [{"category": category, "name": name} for category, name in existing]},
+                {"name": 1, "category": 1}
+            )
+            ids.update({(tag["category"], tag["name"]): tag["_id"] async for tag in tags})
+        return ids
+
+    async def resolve(self, organization_id: PydanticObjectId, keys: Iterable[TagKey]) -> List["Tag"]:
+        """
+        Get or create the organization's tags for the given (category, name) pairs.
+
+        Args:
+            organization_id (PydanticObjectId): The organization owning the tags.
+            keys (Iterable[TagKey]): (category, name) pairs; duplicates are ignored.
+
+        Returns:
+            List[Tag]: One unfetched Tag per distinct pair, in first-seen order, suitable
+            for linking from an Image.
+        """
+        from models import Tag
+
+        keys = list(dict.fromkeys(keys))
+        dictionary = await self._get_dictionary(organization_id)
+        missing = [key for key in keys if key not in dictionary]
+        if missing:
+            created = await self._create(organization_id, missing)
+            with self._lock:
+                dictionary.update(created)
+
+        return [
+            Tag(id=dictionary[key], category=key[0], name=key[1], organization=organization_id)
+            for key in keys if key in dictionary
+        ]
@@ -0,0 +1,175 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from beanie import PydanticObjectId
+
+INITIAL_POSTINGS_CAPACITY = 16
+
+
+class _Postings:
+    """Growable sorted array of image ordinals for one tag."""
+
+    def __init__(self):
+        self.data = np.empty(INITIAL_POSTINGS_CAPACITY, dtype=np.uint32)
+        self.size = 0
+
+    def append(self, ordinal: int):
+        if self.size == len(self.data):
+            grown = np.empty(len(self.data) * 2, dtype=np.uint32)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size] = ordinal
+        self.size += 1
+
+    def view(self) -> np.ndarray:
+        # Appends only write past `size` or into a new buffer, so the view stays a valid snapshot
+        return self.data[:self.size]
+
+
+class TagIndex:
+    """
+    Inverted index from tag ids to the tagged images of one organization.
+
+    Tagged images are numbered in the order they are added and every tag keeps a sorted
+    uint32 array of those ordinals, so filters are array unions and intersections and facet
+    counts are a mask lookup per tag. Image ids are kept alongside in their 12-byte binary
+    form, which sorts in ObjectId order.
+    """
+
+    def __init__(self):
+        self.image_ids: List[bytes] = []
+        self.ordinals: Dict[bytes, int] = {}
+        self.postings: Dict[PydanticObjectId, _Postings] = {}
+        self.tags: Dict[PydanticObjectId, Tuple[str, str]] = {}  # tag id -> (category, name)
+
+    @property
+    def size(self) -> int:
+        return len(self.image_ids)
+
+    def add_tag(self, tag_id: PydanticObjectId, category: str, name: str):
+        self.tags[tag_id] = (category, name)
+
+    def add(self, image_id: PydanticObjectId, tag_ids: Iterable[PydanticObjectId]):
+        key = image_id.binary
+        if key in self.ordinals:
+            return
+        ordinal = len(self.image_ids)
+        self.image_ids.append(key)
+        self.ordinals[key] = ordinal
+        for tag_id in set(tag_ids):
+            self.postings.setdefault(tag_id, _Postings()).append(ordinal)
+
+    def match(self, tag_ids: List[PydanticObjectId]) -> np.ndarray:
+        """
+        Return the sorted ordinals of images matching a tag filter. Tags in the same category
+        are alternatives and categories must all match, e.g. (sunny OR cloudy) AND outdoor.
+        """
+        by_category: Dict[str, List[np.ndarray]] = {}
+        for tag_id in tag_ids:
+            if tag_id not in self.tags:
+                return np.empty(0, dtype=np.uint32)
+            postings = self.postings.get(tag_id)
+            by_category.setdefault(self.tags[tag_id][0], []).append(postings.view() if postings else np.empty(0, dtype=np.uint32))
+
+        # Intersect the smallest unions first so every step works on as little as possible
+        unions = sorted((np.unique(np.concatenate(arrays)) for arrays in by_category.values()), key=len)
+        matched = unions[0]
+        for union in unions[1:]:
+            if not len(matched):
+                break
+            matched = np.intersect1d(matched, union, assume_unique=True)
+        return matched
+
+    def ordinals_of(self, image_ids: Iterable[PydanticObjectId]) -> np.ndarray:
+        """Map image ids to ordinals, dropping images that have no tags."""
+        ordinals = [self.ordinals.get(image_id.binary) for image_id in image_ids]
+        return np.array(sorted(ordinal for ordinal in ordinals if ordinal is not None), dtype=np.uint32)
+
+    def ids_of(self, ordinals: np.ndarray) -> List[bytes]:
+        """Map ordinals to image ids in their 12-byte binary form."""
+        return [self.image_ids[ordinal] for ordinal in ordinals]
+
+    def facets(self, ordinals: Optional[np.ndarray] = None) -> Dict[str, List[dict]]:
+        """
+        Count images per tag, grouped by category and most frequent first.
+
+        Args:
+            ordinals (Optional[np.ndarray]): Restrict the counts to these images; all tagged
+                images when omitted.
+
+        Returns:
+            Dict[str, List[dict]]: category -> [{"id", "name", "count"}] for tags with a
+                non-zero count.
+        """
+        mask = None
+        if ordinals is not None:
+            mask = np.zeros(self.size, dtype=bool)
+            mask[ordinals] = True
+
+        facets: Dict[str, List[dict]] = {}
+        for tag_id, postings in list(self.postings.items()):
+            if tag_id not in self.tags:
+                continue
+            view = postings.view()
+            count = len(view) if mask is None else int(np.count_nonzero(mask[view[view < len(mask)]]))
+            if count:
+                category, name = self.tags[tag_id]
+                facets.setdefault(category, []).append({"id": tag_id, "name": name, "count": count})
+        for values in facets.values():
+            values.sort(key=lambda facet: (-facet["count"], facet["name"]))
+        return facets
+
+
+class TagIndexService:
+    """
+    Process-wide registry of per-organization tag indexes.
+
+    Indexes are built lazily from Mongo on first use and kept current by the indexer, which
+    adds every newly tagged image. State is held on the class so every Toolbox (API requests
+    and the background I/O thread) shares the same indexes.
+    """
+
+    _indexes: Dict[str, TagIndex] = {}
+    _lock = threading.Lock()
+
+    async def _build(self, organization_id: PydanticObjectId) -> TagIndex:
+        from models import Image, Tag
+
+        index = TagIndex()
+        tags = Tag.get_motor_collection().find({"organization.$id": organization_id}, {"name": 1, "category": 1})
+        async for tag in tags:
+            index.add_tag(tag["_id"], tag["category"], tag["name"])
+
+        images = Image.get_motor_collection().find(
+            {"organization.$id": organization_id, "tags.0": {"$exists": True}},
+            {"tags": 1}
+        ).sort("_id", 1)
+        async for image in images:
+            index.add(image["_id"], [tag.id for tag in image["tags"]])
+
+        print(f"Built tag index for organization {organization_id}: {index.size} images, {len(index.tags)} tags")
+        return index
+
+    async def get_index(self, organization_id: PydanticObjectId) -> TagIndex:
+        key = str(organization_id)
+        index = self._indexes.get(key)
+        if index is not None:
+            return index
+
+        index = await self._build(organization_id)
+        with self._lock:
+            return self._indexes.setdefault(key, index)
+
+    async def add(self, organization_id: PydanticObjectId, image_id: PydanticObjectId, tags: list):
+        """
+        Add a freshly saved image and its tags to the organization's index, if that index is
+        loaded. Unloaded indexes pick the image up from Mongo when they are next built.
+        """
+        with self._lock:
+            index = self._indexes.get(str(organization_id))
+            if index is None or not tags:
+                return
+            for tag in tags:
+                index.add_tag(tag.id, tag.category, tag.name)
+            index.add(image_id, [tag.id for tag in tags])
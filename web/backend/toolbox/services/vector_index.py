@@ -0,0 +1,496 @@
+import os
+import json
+import shutil
+import asyncio
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from beanie import PydanticObjectId
+from dotenv import load_dotenv
+
+load_dotenv()
+
+index_root = os.getenv("VECTOR_INDEX_DIR", "indexes")
+default_nprobe = int(os.getenv("VECTOR_INDEX_NPROBE", "32"))
+
+# Below this many vectors a single partition (i.e. exact search) is cheaper than training
+MIN_TRAIN_SIZE = 1024
+MAX_LISTS = 4096
+# The delta segment is merged once it grows past max(MIN_DELTA_MERGE, DELTA_MERGE_RATIO * main size)
+MIN_DELTA_MERGE = 1024
+DELTA_MERGE_RATIO = 0.1
+LOAD_BATCH_SIZE = 10000
+# Catching up from Mongo re-reads documents written up to this long before the newest one in
+# the index, since a document can be saved well after the `created_at` it was built with
+catch_up_overlap = timedelta(seconds=int(os.getenv("VECTOR_INDEX_CATCH_UP_OVERLAP", "600")))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+def _train_centroids(vectors: np.ndarray, n_lists: int, iterations: int = 8, seed: int = 42) -> np.ndarray:
+    """Spherical k-means over a sample of the vectors."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * 32)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        counts = np.bincount(assignments, minlength=n_lists)
+        nonempty = counts > 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums = np.add.reduceat(sample[np.argsort(assignments, kind="stable")], starts, axis=0)
+        # Empty partitions keep their previous centroid
+        centroids[nonempty] = _normalize(sums)
+
+    return centroids
+
+
+def _meta_last_written(meta: dict) -> Optional[datetime]:
+    if meta.get("last_written"):
+        return datetime.fromisoformat(meta["last_written"])
+    if meta.get("last_id"):
+        # Indexes saved before write times were tracked; an ObjectId starts with its creation time
+        return PydanticObjectId(bytes.fromhex(meta["last_id"])).generation_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) index over unit-normalised vectors for a single organization.
+
+    Vectors are bucketed by their nearest coarse centroid and stored contiguously per
+    bucket, so a query only scores the `nprobe` buckets closest to it. Vectors added after
+    the index was built live in an in-memory delta segment that is scanned exhaustively
+    until it is merged into the main segment.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray, offsets: np.ndarray, trained_size: int, last_written: Optional[datetime]):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids  # (N, 12) uint8 ObjectId bytes
+        self.offsets = offsets  # (n_lists + 1,) start of each partition in vectors/ids
+        self.trained_size = trained_size
+        self.last_written = last_written  # Newest write time in the index, used to catch up from Mongo
+
+        self._lock = threading.Lock()
+        self._delta_vectors: Optional[np.ndarray] = None
+        self._delta_ids: Optional[np.ndarray] = None
+        self._delta_count = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.ids) + self._delta_count
+
+    @property
+    def needs_merge(self) -> bool:
+        return self._delta_count > max(MIN_DELTA_MERGE, DELTA_MERGE_RATIO * len(self.ids))
+
+    @classmethod
+    def build(cls, ids: np.ndarray, vectors: np.ndarray, centroids: Optional[np.ndarray] = None, trained_size: Optional[int] = None, last_written: Optional[datetime] = None) -> "IVFIndex":
+        """
+        Build an index from scratch. Centroids are retrained unless existing ones are passed in.
+
+        Args:
+            ids (np.ndarray): (N, 12) uint8 array of ObjectId bytes.
+            vectors (np.ndarray): (N, D) array of vectors.
+            centroids (Optional[np.ndarray]): Coarse centroids to reuse instead of retraining.
+            trained_size (Optional[int]): Number of vectors the reused centroids were trained on.
+            last_written (Optional[datetime]): Write time of the newest document in `ids`.
+
+        Returns:
+            IVFIndex: The packed index.
+        """
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if centroids is None:
+            n_lists = 1 if len(vectors) < MIN_TRAIN_SIZE else min(MAX_LISTS, int(4 * np.sqrt(len(vectors))))
+            if len(vectors) == 0:
+                centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            elif n_lists == 1:
+                centroids = _normalize(vectors.mean(axis=0, keepdims=True))
+            else:
+                centroids = _train_centroids(vectors, n_lists)
+            trained_size = len(vectors)
+
+        assignments = _assign(vectors, centroids) if len(centroids) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+
+        ids = np.asarray(ids, dtype=np.uint8)
+        return cls(centroids, vectors[order], ids[order], offsets, trained_size or 0, last_written)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["IVFIndex"]:
+        """Memory-map a persisted index, or return None if there is none at `path`."""
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return cls(
+            centroids=np.load(os.path.join(path, "centroids.npy")),
+            vectors=np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            ids=np.load(os.path.join(path, "ids.npy"), mmap_mode="r"),
+            offsets=np.load(os.path.join(path, "offsets.npy")),
+            trained_size=meta["trained_size"],
+            last_written=_meta_last_written(meta)
+        )
+
+    def save(self, path: str):
+        """Persist the main segment. Files are written to a sibling directory and swapped in."""
+        tmp_path = f"{path}.tmp"
+        old_path = f"{path}.old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(tmp_path, "vectors.npy"), self.vectors)
+        np.save(os.path.join(tmp_path, "ids.npy"), self.ids)
+        np.save(os.path.join(tmp_path, "offsets.npy"), self.offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({
+                "trained_size": self.trained_size,
+                "size": len(self.ids),
+                "last_written": self.last_written.isoformat() if self.last_written else None
+            }, f)
+
+        # Readers that already mapped the old files keep their handles across the rename
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray, written_at: Optional[datetime] = None):
+        """
+        Append vectors to the delta segment. Safe to call while other threads search.
+        `written_at` is when the documents were written; freshly saved ones default to now.
+        """
+        ids = np.asarray(ids, dtype=np.uint8).reshape(-1, 12)
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+
+        with self._lock:
+            count = self._delta_count
+            if self._delta_vectors is None or count + len(ids) > len(self._delta_vectors):
+                # Grow into a fresh buffer so in-flight searches keep a consistent view of the old one
+                capacity = max(256, 2 * (count + len(ids)))
+                delta_vectors = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+                delta_ids = np.empty((capacity, 12), dtype=np.uint8)
+                if count:
+                    delta_vectors[:count] = self._delta_vectors[:count]
+                    delta_ids[:count] = self._delta_ids[:count]
+                self._delta_vectors, self._delta_ids = delta_vectors, delta_ids
+
+            self._delta_vectors[count:count + len(ids)] = vectors
+            self._delta_ids[count:count + len(ids)] = ids
+            self._delta_count = count + len(ids)
+
+            written_at = written_at or datetime.utcnow()
+            if self.last_written is None or written_at > self.last_written:
+                self.last_written = written_at
+
+    def contains(self, ids: np.ndarray) -> np.ndarray:
+        """Mask of the given ids that are already in either segment."""
+        ids = np.ascontiguousarray(np.asarray(ids, dtype=np.uint8).reshape(-1, 12))
+        with self._lock:
+            count = self._delta_count
+            delta_ids = self._delta_ids[:count] if count else np.zeros((0, 12), dtype=np.uint8)
+        known = np.concatenate([np.asarray(self.ids).reshape(-1, 12), delta_ids])
+        return np.isin(ids.view("V12").ravel(), np.ascontiguousarray(known).view("V12").ravel())
+
+    def delta_since(self, start: int) -> Tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            count = self._delta_count
+            return self._delta_ids[start:count], self._delta_vectors[start:count]
+
+    def merged(self, count: int) -> "IVFIndex":
+        """
+        Return a new index with the first `count` delta vectors folded into the main segment.
+
+        Centroids are retrained once the index has doubled since they were last trained
+        (or has outgrown exact search), otherwise the existing partitions are reused.
+        """
+        with self._lock:
+            delta_vectors = self._delta_vectors[:count] if count else None
+            delta_ids = self._delta_ids[:count] if count else None
+
+        vectors = np.asarray(self.vectors) if delta_vectors is None else np.concatenate([np.asarray(self.vectors).reshape(-1, delta_vectors.shape[1]), delta_vectors])
+        ids = np.asarray(self.ids) if delta_ids is None else np.concatenate([np.asarray(self.ids), delta_ids])
+
+        retrain = (
+            len(self.centroids) == 0
+            or len(ids) >= 2 * max(self.trained_size, 1)
+            or (len(self.centroids) == 1 and len(ids) >= MIN_TRAIN_SIZE)
+        )
+        if retrain:
+            return IVFIndex.build(ids, vectors, last_written=self.last_written)
+        return IVFIndex.build(ids, vectors, centroids=self.centroids, trained_size=self.trained_size, last_written=self.last_written)
+
+    def search(self, query: List[float], k: int, nprobe: int) -> List[Tuple[PydanticObjectId, float]]:
+        """
+        Return up to `k` (id, cosine similarity) pairs, best first.
+
+        Args:
+            query (List[float]): The query vector.
+            k (int): Number of results to return.
+            nprobe (int): Number of partitions to scan. Higher values raise recall at the cost of latency.
+        """
+        q = _normalize(np.asarray(query, dtype=np.float32))
+
+        with self._lock:
+            count = self._delta_count
+            delta_vectors = self._delta_vectors[:count] if count else None
+            delta_ids = self._delta_ids[:count] if count else None
+
+        score_parts, id_parts = [], []
+        if len(self.centroids):
+            for list_no in _top_k(self.centroids @ q, max(1, nprobe)):
+                start, end = self.offsets[list_no], self.offsets[list_no + 1]
+                if start == end:
+                    continue
+                score_parts.append(self.vectors[start:end] @ q)
+                id_parts.append(self.ids[start:end])
+        if delta_vectors is not None:
+            score_parts.append(delta_vectors @ q)
+            id_parts.append(delta_ids)
+
+        if not score_parts:
+            return []
+
+        scores = np.concatenate(score_parts)
+        ids = np.concatenate(id_parts)
+
+        results = []
+        seen = set()
+        # A document can be in both segments while an index is catching up; keep its best score
+        for i in _top_k(scores, k + count):
+            key = ids[i].tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append((PydanticObjectId(key), float(scores[i])))
+            if len(results) == k:
+                break
+        return results
+
+
+class VectorIndexService:
+    """
+    Process-wide registry of per-organization ANN indexes.
+
+    Indexes are loaded lazily on first search: the persisted main segment is memory-mapped
+    from disk and any documents inserted since it was written are read back from Mongo into
+    the delta segment. State is held on the class so every Toolbox (API requests and the
+    background I/O thread) shares the same indexes.
+
+    Indexes are append-only: a deleted document keeps its vector until the index file is
+    removed and rebuilt, so callers must check hits against Mongo before trusting them.
+    """
+
+    # name -> (document model, embedding field)
+    SOURCES = {
+        "caption": ("Image", "caption_embedding"),
+        "face": ("Face", "face_embedding"),
+    }
+
+    _indexes: Dict[Tuple[str, str], IVFIndex] = {}
+    _merging: set = set()
+    # Running merges, referenced so they are not garbage collected before they finish
+    _merge_tasks: set = set()
+    # Loads in progress, shared by every caller that asks for the same index meanwhile. They
+    # are thread-safe futures because the API and the background I/O thread run separate loops.
+    _loading: Dict[Tuple[str, str], Future] = {}
+    _lock = threading.Lock()
+
+    def _path(self, name: str, organization_id: PydanticObjectId) -> str:
+        return os.path.join(index_root, name, str(organization_id))
+
+    def _model(self, name: str):
+        import models
+        model_name, field = self.SOURCES[name]
+        return getattr(models, model_name), field
+
+    async def _read_from_db(self, name: str, organization_id: PydanticObjectId, written_after: Optional[datetime]) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[datetime]]:
+        """
+        Read an organization's vectors from Mongo, only those written since `written_after`
+        (less the catch-up overlap) if given. Ids are generated before documents are saved,
+        sometimes long before, so they cannot mark how far the index has caught up.
+
+        Returns:
+            Tuple: (N, 12) ids, (N, D) vectors or None if there are none, and the newest write time.
+        """
+        model, field = self._model(name)
+        match = {"organization.$id": organization_id, field: {"$ne": None}}
+        if written_after is not None:
+            match["created_at"] = {"$gte": written_after - catch_up_overlap}
+
+        id_batches, vector_batches = [], []
+        ids, vectors = [], []
+        last_written = None
+        async for doc in model.aggregate([{"$match": match}, {"$sort": {"_id": 1}}, {"$project": {field: 1, "created_at": 1}}]):
+            ids.append(np.frombuffer(doc["_id"].binary, dtype=np.uint8))
+            vectors.append(np.asarray(doc[field], dtype=np.float32))
+            written_at = doc.get("created_at")
+            if written_at is not None and (last_written is None or written_at > last_written):
+                last_written = written_at
+            if len(ids) == LOAD_BATCH_SIZE:
+                id_batches.append(np.stack(ids))
+                vector_batches.append(np.stack(vectors))
+                ids, vectors = [], []
+        if ids:
+            id_batches.append(np.stack(ids))
+            vector_batches.append(np.stack(vectors))
+
+        if not id_batches:
+            return np.zeros((0, 12), dtype=np.uint8), None, None
+        return np.concatenate(id_batches), np.concatenate(vector_batches), last_written
+
+    async def get_index(self, name: str, organization_id: PydanticObjectId) -> Optional[IVFIndex]:
+        key = (name, str(organization_id))
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                return index
+            loading = self._loading.get(key)
+            if loading is None:
+                self._loading[key] = loading = Future()
+                loader = True
+            else:
+                loader = False
+        if not loader:
+            return await asyncio.wrap_future(loading)
+
+        try:
+            index = await self._load(name, organization_id)
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        else:
+            loading.set_result(index)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        if index is not None:
+            self._schedule_merge(name, organization_id, index)
+        return index
+
+    async def _load(self, name: str, organization_id: PydanticObjectId) -> Optional[IVFIndex]:
+        """Load, catch up or build an index and register it; only one caller runs this per index."""
+        key = (name, str(organization_id))
+        loop = asyncio.get_running_loop()
+        path = self._path(name, organization_id)
+        index = await loop.run_in_executor(None, IVFIndex.load, path)
+
+        ids, vectors, last_written = await self._read_from_db(name, organization_id, index.last_written if index else None)
+        if index is None:
+            if vectors is None:
+                return None
+            print(f"Building {name} index for organization {organization_id} over {len(ids)} vectors")
+            index = await loop.run_in_executor(None, lambda: IVFIndex.build(ids, vectors, last_written=last_written))
+            await loop.run_in_executor(None, index.save, path)
+        elif vectors is not None:
+            # The overlap re-reads documents the index already holds
+            new = ~await loop.run_in_executor(None, index.contains, ids)
+            if new.any():
+                index.add(ids[new], vectors[new], written_at=last_written)
+
+        with self._lock:
+            self._indexes[key] = index
+        return index
+
+    def _schedule_merge(self, name: str, organization_id: PydanticObjectId, index: IVFIndex):
+        key = (name, str(organization_id))
+        with self._lock:
+            if not index.needs_merge or key in self._merging:
+                return
+            self._merging.add(key)
+        task = asyncio.get_running_loop().create_task(self._merge(name, organization_id, index))
+        self._merge_tasks.add(task)
+        task.add_done_callback(self._merge_tasks.discard)
+
+    async def _merge(self, name: str, organization_id: PydanticObjectId, index: IVFIndex):
+        key = (name, str(organization_id))
+        loop = asyncio.get_running_loop()
+        try:
+            count = index.delta_since(0)[0].shape[0]
+            merged = await loop.run_in_executor(None, index.merged, count)
+            await loop.run_in_executor(None, merged.save, self._path(name, organization_id))
+            with self._lock:
+                # Carry over anything added while the merge was running
+                late_ids, late_vectors = index.delta_since(count)
+                if len(late_ids):
+                    merged.add(late_ids, late_vectors)
+                self._indexes[key] = merged
+            print(f"Merged {name} index for organization {organization_id}: {merged.size} vectors in {len(merged.centroids)} partitions")
+        except Exception as e:
+            print(f"Error merging {name} index for organization {organization_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._merging.discard(key)
+
+    async def add(self, name: str, organization_id: PydanticObjectId, document_id: PydanticObjectId, vector: List[float]):
+        """
+        Add a freshly saved document to the organization's index, if that index is loaded.
+        Unloaded indexes pick the document up from Mongo when they are next loaded.
+        """
+        with self._lock:
+            index = self._indexes.get((name, str(organization_id)))
+            if index is None:
+                return
+            index.add(np.frombuffer(document_id.binary, dtype=np.uint8), np.asarray(vector, dtype=np.float32))
+        self._schedule_merge(name, organization_id, index)
+
+    async def add_many(self, name: str, organization_id: PydanticObjectId, document_ids: List[PydanticObjectId], vectors: List[List[float]]):
+        """Add several freshly saved documents at once, like `add`."""
+        if not document_ids:
+            return
+        with self._lock:
+            index = self._indexes.get((name, str(organization_id)))
+            if index is None:
+                return
+            ids = np.frombuffer(b"".join(document_id.binary for document_id in document_ids), dtype=np.uint8)
+            index.add(ids, np.asarray(vectors, dtype=np.float32))
+        self._schedule_merge(name, organization_id, index)
+
+    async def search(self, name: str, organization_id: PydanticObjectId, vector: List[float], limit: int, nprobe: Optional[int] = None) -> List[Tuple[PydanticObjectId, float]]:
+        """
+        Approximate nearest-neighbour search within an organization.
+
+        Args:
+            name (str): The index to search (e.g. "caption").
+            organization_id (PydanticObjectId): The organization to search in.
+            vector (List[float]): The query vector.
+            limit (int): Maximum number of results.
+            nprobe (Optional[int]): Partitions to scan; defaults to VECTOR_INDEX_NPROBE.
+
+        Returns:
+            List[Tuple[PydanticObjectId, float]]: Document ids and cosine similarities, best first.
+        """
+        index = await self.get_index(name, organization_id)
+        if index is None:
+            return []
+        # Scanning the partitions is CPU-bound, so it stays off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, index.search, vector, limit, nprobe or default_nprobe)
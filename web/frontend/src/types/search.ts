@@ -6,18 +6,30 @@ export const ImageSearchRequestSchema = z.object({
   dominant_colors: z.array(z.string()).optional(),
   faces: z.array(z.string()).optional(),
   products: z.array(z.string()).optional(),
+  tags: z.array(z.string()).optional(),
   page: z.number().int().positive().optional().default(1),
   page_size: z.number().int().positive().optional().default(20),
+  cursor: z.string().optional(),
 });
 
 export type ImageSearchRequest = z.infer<typeof ImageSearchRequestSchema>;
 
+export const TagFacetSchema = z.object({
+  id: z.string(),
+  name: z.string(),
+  count: z.number(),
+});
+
+export type TagFacet = z.infer<typeof TagFacetSchema>;
+
 export const ImageSearchResponseSchema = z.object({
   images: z.array(ImageSchema),
   total: z.number(),
   page: z.number(),
   pageSize: z.number(),
   totalPages: z.number(),
+  nextCursor: z.string().nullish(),
+  facets: z.record(z.array(TagFacetSchema)).optional(),
 });
 
 export type ImageSearchResponse = z.infer<typeof ImageSearchResponseSchema>;